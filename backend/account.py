@@ -1,37 +1,47 @@
 # account.py - Handles account management operations
 from fastapi import APIRouter, HTTPException, Depends
-from sqlalchemy.orm import Session
-from db import get_db
+from sqlalchemy import delete
+from sqlalchemy.ext.asyncio import AsyncSession
+from db import get_async_db
 from models import Todo, Profile, CallUsage, User
-from otp import verify_token, get_user_identifier, get_user
+from otp import verify_token, get_user
+from identity_cache import identity_cache, user_cache_keys
+from usage_counters import flush_usage, forget_usage
+import state_version
 
 router = APIRouter(prefix="/account", tags=["account"])
 
 
 @router.delete("/delete")
-def delete_account(
-    db: Session = Depends(get_db),
+async def delete_account(
+    db: AsyncSession = Depends(get_async_db),
     user_id: str = Depends(verify_token)
 ):
     """
     Delete user account and all associated data.
     """
-    phone = get_user_identifier(user_id, db)
-    user = get_user(user_id, db)
-    print(f"🗑️ Deleting account for user {user.id} (phone={phone})")
+    user = await get_user(user_id, db)
+    print(f"🗑️ Deleting account for user {user.id} (phone={user.phone})")
     
-    todos_deleted = db.query(Todo).filter(Todo.phone == phone).delete()
+    # Persist pending Redis counter increments so they are deleted below
+    await flush_usage()
+    
+    todos_deleted = (await db.execute(delete(Todo).where(Todo.user_id == user.id))).rowcount
     print(f"  - Deleted {todos_deleted} todos")
     
-    profile_deleted = db.query(Profile).filter(Profile.phone == phone).delete()
+    profile_deleted = (await db.execute(delete(Profile).where(Profile.user_id == user.id))).rowcount
     print(f"  - Deleted {profile_deleted} profile(s)")
     
-    call_usage_deleted = db.query(CallUsage).filter(CallUsage.phone == phone).delete()
+    call_usage_deleted = (await db.execute(delete(CallUsage).where(CallUsage.user_id == user.id))).rowcount
     print(f"  - Deleted {call_usage_deleted} call usage records")
 
-    db.delete(user)
+    stale_keys = user_cache_keys(user) + [user_id]
+    await db.delete(user)
     
-    db.commit()
+    await db.commit()
+    await identity_cache.invalidate(*stale_keys)
+    await forget_usage(user.id)
+    await state_version.bump(user.id)
     
     print(f"✅ Account deletion complete for user {user.id}")
     
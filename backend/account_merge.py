@@ -0,0 +1,194 @@
+# account_merge.py - Set-based account merge (moves all user-owned rows in bulk)
+import os
+from typing import Optional
+
+from fastapi import BackgroundTasks
+from sqlalchemy import select, update, delete, func, exists, and_, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db import AsyncSessionLocal
+from models import (
+    User, Todo, Profile, CallUsage, ChatUsage, CallSession, ManualUnblockUsage,
+    TodoCompletion, TodoCompletionDaily,
+)
+from identity_cache import identity_cache, user_cache_keys
+from usage_counters import flush_usage, forget_usage
+import state_version
+
+# Above this many owned rows the row moves run after the response is sent
+MERGE_BACKGROUND_ROW_THRESHOLD = int(os.getenv("MERGE_BACKGROUND_ROW_THRESHOLD", "5000"))
+
+# Tables whose rows simply change owner
+MOVED_MODELS = [Todo, CallSession, TodoCompletion]
+# Daily counter tables: (model, counter column). Days both users have are summed.
+DAILY_COUNTER_MODELS = [
+    (CallUsage, "seconds_used"),
+    (ChatUsage, "message_count"),
+    (ManualUnblockUsage, "unblock_count"),
+    (TodoCompletionDaily, "completed_count"),
+]
+
+
+def _identifier(user: User) -> str:
+    return user.phone if user.phone else f"apple_{user.id}"
+
+
+async def count_owned_rows(db: AsyncSession, owner_id: int) -> int:
+    """Total rows owned by owner_id across every user-owned table, in one query."""
+    models = MOVED_MODELS + [m for m, _ in DAILY_COUNTER_MODELS] + [Profile]
+    counts = [
+        select(func.count()).select_from(m).where(m.user_id == owner_id).scalar_subquery()
+        for m in models
+    ]
+    return (await db.execute(select(sum(counts[1:], counts[0])))).scalar() or 0
+
+
+def _needs_move(table, src: int, dst: int, dst_identifier: str):
+    """src's rows, plus dst's rows still carrying an old phone label."""
+    return or_(table.c.user_id == src, and_(table.c.user_id == dst, table.c.phone != dst_identifier))
+
+
+async def move_owned_rows(db: AsyncSession, src: int, dst: int, dst_identifier: str):
+    """
+    Re-own every row of user src to user dst with bulk statements (no ORM
+    loads), relabelling dst's rows with dst_identifier. Does not commit; the
+    caller owns the transaction.
+    """
+    # Moved todos get fresh change sequence numbers on dst so dst's devices sync them
+    todos, users = Todo.__table__, User.__table__
+    moving = _needs_move(todos, src, dst, dst_identifier)
+    first_id, last_id = (await db.execute(select(func.min(todos.c.id), func.max(todos.c.id)).where(moving))).one()
+    if first_id is not None:
+        span = last_id - first_id + 1
+        base = (await db.execute(
+            update(users).where(users.c.id == dst).values(todo_seq=users.c.todo_seq + span)
+            .returning(users.c.todo_seq)
+        )).scalar_one() - span
+        await db.execute(update(todos).where(moving).values(change_seq=todos.c.id - first_id + 1 + base))
+
+    for model in MOVED_MODELS:
+        await db.execute(
+            update(model).where(_needs_move(model.__table__, src, dst, dst_identifier))
+            .values(user_id=dst, phone=dst_identifier)
+            .execution_options(synchronize_session=False)
+        )
+
+    for model, column in DAILY_COUNTER_MODELS:
+        table = model.__table__
+        other = table.alias("src_rows")
+        same_day_src = and_(other.c.user_id == src, other.c.usage_date == table.c.usage_date)
+        # 1. Fold src's counts into dst's rows for days both have
+        await db.execute(
+            update(table)
+            .where(table.c.user_id == dst, exists().where(same_day_src))
+            .values({
+                column: table.c[column] + select(func.sum(other.c[column])).where(same_day_src).scalar_subquery(),
+                "updated_at": func.now(),
+            })
+        )
+        # 2. Drop the src rows that were folded in
+        dst_days = select(other.c.usage_date).where(other.c.user_id == dst)
+        await db.execute(delete(table).where(table.c.user_id == src, table.c.usage_date.in_(dst_days)))
+        # 3. Move the remaining src days over
+        await db.execute(
+            update(table).where(_needs_move(table, src, dst, dst_identifier)).values(user_id=dst, phone=dst_identifier)
+        )
+
+    # Profile: keep dst's row, OR in premium, keep a cloned voice if dst has none
+    profiles = Profile.__table__
+    src_profile = (await db.execute(select(profiles).where(profiles.c.user_id == src))).first()
+    if src_profile is not None:
+        has_dst = (await db.execute(select(profiles.c.id).where(profiles.c.user_id == dst))).first()
+        if has_dst is None:
+            await db.execute(update(profiles).where(profiles.c.user_id == src).values(user_id=dst))
+        else:
+            # Delete first: the phone label is unique and may be taken over by dst's row
+            await db.execute(delete(profiles).where(profiles.c.user_id == src))
+            await db.execute(
+                update(profiles).where(profiles.c.user_id == dst).values(
+                    is_premium=profiles.c.is_premium | src_profile.is_premium,
+                    eleven_voice_id=func.coalesce(profiles.c.eleven_voice_id, src_profile.eleven_voice_id),
+                )
+            )
+    await db.execute(
+        update(profiles).where(profiles.c.user_id == dst, profiles.c.phone != dst_identifier)
+        .values(phone=dst_identifier)
+    )
+
+
+async def _hand_off_identifiers(db: AsyncSession, source: User, target: User) -> str:
+    """
+    Copy Apple ID / phone / email to target if missing and return target's
+    new label. The source's copies are cleared first so the unique
+    phone/apple_id constraints are never violated. Does not commit.
+    """
+    apple_id, phone, email = source.apple_id, source.phone, source.email
+    source.apple_id = None
+    source.phone = None
+    await db.flush()
+    if apple_id and not target.apple_id:
+        target.apple_id = apple_id
+    if phone and not target.phone:
+        target.phone = phone
+    if email and not target.email:
+        target.email = email
+    # Gaining a phone changes the target's label, so its own rows are relabelled too
+    return _identifier(target)
+
+
+async def _merge_into(db: AsyncSession, source: User, target: User):
+    """Hand off identifiers, move the rows and delete source in one transaction."""
+    stale_keys = user_cache_keys(source) + user_cache_keys(target)
+    source_id, target_id = source.id, target.id
+    final_identifier = await _hand_off_identifiers(db, source, target)
+    await move_owned_rows(db, source_id, target_id, final_identifier)
+    # Bulk delete: source owns nothing any more, so there is nothing to cascade
+    await db.execute(delete(User).where(User.id == source_id))
+    await db.commit()
+    await identity_cache.invalidate(*stale_keys)
+    await forget_usage(source_id, target_id)
+    await state_version.bump(source_id, target_id)
+
+
+async def _merge_job(source_id: int, target_id: int):
+    """
+    Background variant of the whole merge. Nothing is committed unless every
+    step succeeds, so on failure source still holds its Apple ID / phone and
+    linking again retries the merge.
+    """
+    async with AsyncSessionLocal() as db:
+        try:
+            source, target = await db.get(User, source_id), await db.get(User, target_id)
+            if source is None or target is None:
+                print(f"⚠️ Background merge skipped: user {source_id} or {target_id} no longer exists")
+                return
+            await flush_usage()
+            await _merge_into(db, source, target)
+            print(f"🔗 Background merge finished: user {source_id} -> {target_id}")
+        except Exception as e:
+            await db.rollback()
+            print(f"❌ Background merge failed for user {source_id} -> {target_id} (both accounts unchanged): {e}")
+
+
+async def merge_users(source: User, target: User, db: AsyncSession,
+                      background_tasks: Optional[BackgroundTasks] = None) -> bool:
+    """
+    Merge source user's data into target user, then delete source.
+
+    Everything happens in one transaction. If the source owns more than
+    MERGE_BACKGROUND_ROW_THRESHOLD rows and background_tasks is given, that
+    transaction runs after the response instead, and until it commits both
+    accounts stay as they were. Returns True if the merge was deferred.
+    """
+    # Pending Redis counter increments must reach the tables before rows move
+    await flush_usage()
+
+    if background_tasks is not None and await count_owned_rows(db, source.id) > MERGE_BACKGROUND_ROW_THRESHOLD:
+        background_tasks.add_task(_merge_job, source.id, target.id)
+        print(f"🔗 Merging user {source.id} into user {target.id} in the background")
+        return True
+
+    source_id, target_id = source.id, target.id
+    await _merge_into(db, source, target)
+    print(f"🔗 Merged user {source_id} into user {target_id}")
+    return False
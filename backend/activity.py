@@ -0,0 +1,102 @@
+# activity.py - Debounced profiles.last_active tracking (write-behind, batched)
+import asyncio
+import os
+import time
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+from sqlalchemy import bindparam, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from db import AsyncSessionLocal
+from models import Profile, User
+from otp import Owner
+import state_version
+
+load_dotenv(override=True)
+
+# A user's last_active is written at most once per ACTIVITY_DEBOUNCE_SECONDS
+# (per worker); pending touches are flushed every ACTIVITY_FLUSH_SECONDS.
+ACTIVITY_DEBOUNCE_SECONDS = float(os.getenv("ACTIVITY_DEBOUNCE_SECONDS", "300"))
+ACTIVITY_FLUSH_SECONDS = float(os.getenv("ACTIVITY_FLUSH_SECONDS", "30"))
+
+_INSERTS = {"postgresql": pg_insert, "sqlite": sqlite_insert}
+
+# owner id -> (label, last seen) waiting for the next flush
+_pending = {}
+# owner id -> monotonic time of the last write queued for that user
+_last_queued = {}
+
+_stats = {"touches": 0, "debounced": 0, "flushes": 0, "rows_written": 0, "flush_failures": 0}
+
+
+def touch(owner: Owner):
+    """Note that owner was active now. Never touches the database itself."""
+    now = time.monotonic()
+    _stats["touches"] += 1
+    if owner.id not in _pending and now - _last_queued.get(owner.id, float("-inf")) < ACTIVITY_DEBOUNCE_SECONDS:
+        _stats["debounced"] += 1
+        return
+    _pending[owner.id] = (owner.identifier, datetime.now(timezone.utc))
+    _last_queued[owner.id] = now
+    if len(_last_queued) > 10000:
+        for owner_id in [o for o, at in _last_queued.items() if now - at >= ACTIVITY_DEBOUNCE_SECONDS]:
+            del _last_queued[owner_id]
+
+
+async def flush_activity() -> int:
+    """
+    Write pending last_active values: one executemany UPDATE, plus an insert
+    for users that have no profile yet. Returns rows written.
+    """
+    if not _pending:
+        return 0
+    batch = dict(_pending)
+    _pending.clear()
+    profiles = Profile.__table__
+    try:
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(profiles).where(profiles.c.user_id == bindparam("owner_id"))
+                .values(last_active=bindparam("seen")),
+                [{"owner_id": owner_id, "seen": seen} for owner_id, (_, seen) in batch.items()],
+            )
+            # Users without a profile that still exist (a merge or deletion may have removed them)
+            needs_profile = set((await db.execute(
+                select(User.id).where(User.id.in_(batch), User.id.not_in(select(profiles.c.user_id).where(
+                    profiles.c.user_id.in_(batch))))
+            )).scalars())
+            missing = [
+                {"user_id": owner_id, "phone": label, "is_premium": False, "last_active": seen}
+                for owner_id, (label, seen) in batch.items() if owner_id in needs_profile
+            ]
+            if missing:
+                insert = _INSERTS[db.get_bind().dialect.name]
+                await db.execute(insert(profiles).values(missing).on_conflict_do_nothing())
+            await db.commit()
+    except Exception as e:
+        # Put the touches back unless newer ones arrived meanwhile
+        _stats["flush_failures"] += 1
+        for owner_id, entry in batch.items():
+            _pending.setdefault(owner_id, entry)
+        print(f"❌ Activity flush failed ({len(batch)} users): {str(e)}")
+        return 0
+    await state_version.bump(*batch)  # premium-status reports last_active
+    _stats["flushes"] += 1
+    _stats["rows_written"] += len(batch)
+    return len(batch)
+
+
+async def flush_forever():
+    """Background loop started from main.lifespan."""
+    while True:
+        await asyncio.sleep(ACTIVITY_FLUSH_SECONDS)
+        try:
+            await flush_activity()
+        except Exception as e:
+            print(f"❌ Activity flusher error: {str(e)}")
+
+
+def stats() -> dict:
+    return {"pending": len(_pending), **_stats}
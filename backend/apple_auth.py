@@ -1,24 +1,24 @@
 # apple_auth.py - Sign in with Apple verification
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, BackgroundTasks
 from pydantic import BaseModel
 from typing import Optional
-from sqlalchemy.orm import Session
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 import jwt
-from jwt import PyJWKClient
 import os
 
-from db import get_db
+from db import get_async_db
 from models import User
-from otp import create_jwt, verify_token, get_user, get_user_identifier
+from otp import create_jwt, verify_token, get_user
+from account_merge import merge_users
+from apple_keys import apple_keystore
 
 router = APIRouter(prefix="/auth", tags=["auth"])
 
-APPLE_KEYS_URL = "https://appleid.apple.com/auth/keys"
 APPLE_ISSUER = "https://appleid.apple.com"
 APPLE_CLIENT_ID = os.getenv("APPLE_CLIENT_ID")  # Your app's bundle identifier
 
-jwk_client = PyJWKClient(APPLE_KEYS_URL, cache_keys=True)
-
 
 class AppleSignInRequest(BaseModel):
     identity_token: str
@@ -39,7 +39,7 @@ def _verify_apple_token(identity_token: str) -> dict:
         )
 
     try:
-        signing_key = jwk_client.get_signing_key_from_jwt(identity_token)
+        signing_key = apple_keystore.get_signing_key_from_jwt(identity_token)
         payload = jwt.decode(
             identity_token,
             signing_key.key,
@@ -58,22 +58,22 @@ def _verify_apple_token(identity_token: str) -> dict:
 
 
 @router.post("/apple")
-def apple_sign_in(
+async def apple_sign_in(
     request: AppleSignInRequest,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Authenticate with Apple Sign-In.
     Verifies the identity token, finds or creates a user, returns a JWT.
     """
-    payload = _verify_apple_token(request.identity_token)
+    payload = await run_in_threadpool(_verify_apple_token, request.identity_token)
     apple_id = payload.get("sub")
     token_email = payload.get("email")
 
     if not apple_id:
         raise HTTPException(status_code=401, detail="No user identifier in Apple token")
 
-    user = db.query(User).filter(User.apple_id == apple_id).first()
+    user = (await db.execute(select(User).where(User.apple_id == apple_id))).scalars().first()
 
     if not user:
         user = User(
@@ -82,15 +82,15 @@ def apple_sign_in(
             full_name=request.full_name,
         )
         db.add(user)
-        db.commit()
-        db.refresh(user)
+        await db.commit()
+        await db.refresh(user)
         print(f"🍎 New Apple user created: id={user.id}")
     else:
         if request.email and not user.email:
             user.email = request.email
         if request.full_name and not user.full_name:
             user.full_name = request.full_name
-        db.commit()
+        await db.commit()
         print(f"🍎 Existing Apple user logged in: id={user.id}")
 
     token = create_jwt(user.id)
@@ -98,36 +98,37 @@ def apple_sign_in(
 
 
 @router.post("/link-apple")
-def link_apple_to_account(
+async def link_apple_to_account(
     request: LinkAppleRequest,
+    background_tasks: BackgroundTasks,
     user_id: str = Depends(verify_token),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Link an Apple ID to an existing account (e.g. phone user adds Apple Sign-In).
     If the Apple ID already belongs to another user, merges the accounts.
     """
-    payload = _verify_apple_token(request.identity_token)
+    payload = await run_in_threadpool(_verify_apple_token, request.identity_token)
     apple_id = payload.get("sub")
     if not apple_id:
         raise HTTPException(status_code=401, detail="No user identifier in Apple token")
 
-    current_user = get_user(user_id, db)
+    current_user = await get_user(user_id, db)
 
     if current_user.apple_id == apple_id:
         return {"message": "Apple ID already linked", "user_id": str(current_user.id)}
 
-    existing_apple_user = db.query(User).filter(User.apple_id == apple_id).first()
+    existing_apple_user = (await db.execute(select(User).where(User.apple_id == apple_id))).scalars().first()
 
     if existing_apple_user and existing_apple_user.id != current_user.id:
-        _merge_users(source=existing_apple_user, target=current_user, db=db)
+        await _merge_users(source=existing_apple_user, target=current_user, db=db, background_tasks=background_tasks)
         return {"message": "Accounts merged", "user_id": str(current_user.id)}
 
     current_user.apple_id = apple_id
     token_email = payload.get("email")
     if token_email and not current_user.email:
         current_user.email = token_email
-    db.commit()
+    await db.commit()
 
     return {"message": "Apple ID linked", "user_id": str(current_user.id)}
 
@@ -135,7 +136,7 @@ def link_apple_to_account(
 @router.post("/link-phone")
 def link_phone_to_account(
     user_id: str = Depends(verify_token),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     Link a phone number to an existing Apple account.
@@ -151,43 +152,6 @@ def link_phone_to_account(
     pass
 
 
-def _merge_users(source: User, target: User, db: Session):
-    """Merge source user's data into target user, then delete source."""
-    from models import Todo, Profile, CallUsage, ChatUsage, ManualUnblockUsage
-
-    source_id = get_user_identifier(str(source.id), db) if not source.phone else source.phone
-    if source.phone and not source.phone.startswith("apple_"):
-        source_phone = source.phone
-    else:
-        source_phone = f"apple_{source.id}"
-
-    target_phone = target.phone if target.phone else f"apple_{target.id}"
-
-    # Move all data from source's phone identifier to target's identifier
-    for model in [Todo, CallUsage, ChatUsage, ManualUnblockUsage]:
-        db.query(model).filter(model.phone == source_phone).update(
-            {"phone": target_phone}, synchronize_session="fetch"
-        )
-
-    # Merge profile: keep target's, delete source's
-    source_profile = db.query(Profile).filter(Profile.phone == source_phone).first()
-    if source_profile:
-        target_profile = db.query(Profile).filter(Profile.phone == target_phone).first()
-        if not target_profile:
-            source_profile.phone = target_phone
-        else:
-            if source_profile.is_premium and not target_profile.is_premium:
-                target_profile.is_premium = True
-            db.delete(source_profile)
-
-    # Copy Apple ID / phone to target if missing
-    if source.apple_id and not target.apple_id:
-        target.apple_id = source.apple_id
-    if source.phone and not target.phone:
-        target.phone = source.phone
-    if source.email and not target.email:
-        target.email = source.email
-
-    db.delete(source)
-    db.commit()
-    print(f"🔗 Merged user {source.id} into user {target.id}")
+async def _merge_users(source: User, target: User, db: AsyncSession, background_tasks: Optional[BackgroundTasks] = None) -> bool:
+    """Merge source user's data into target user, then delete source (see account_merge)."""
+    return await merge_users(source, target, db, background_tasks)
@@ -0,0 +1,103 @@
+# apple_keys.py - Prefetched, background-refreshed Apple JWKS keystore
+import asyncio
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+import httpx
+import jwt
+from jwt import PyJWK, PyJWKSet
+
+APPLE_KEYS_URL = "https://appleid.apple.com/auth/keys"
+APPLE_KEYS_REFRESH_SECONDS = float(os.getenv("APPLE_KEYS_REFRESH_SECONDS", "3600"))
+APPLE_KEYS_RETRY_SECONDS = 60.0       # background retry delay after a failed refresh
+APPLE_KEYS_MISS_REFETCH_SECONDS = 30.0  # at most one kid-miss fetch per interval
+APPLE_KEYS_FETCH_TIMEOUT = 5.0
+
+
+class AppleKeyStore:
+    """
+    Holds Apple's signing keys by kid.
+
+    Keys are fetched at startup and refreshed in the background, so lookups
+    on the request path are a dict read. An unknown kid (key rotation)
+    triggers one synchronous refetch shared by all concurrent callers. A
+    failed fetch never discards the last-known-good keys.
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self._keys: Dict[str, PyJWK] = {}
+        self._fetched_at: Optional[float] = None
+        self._last_attempt = 0.0
+        self._fetch_lock = threading.Lock()
+        self.fetches = 0
+        self.fetch_failures = 0
+        self.miss_fetches = 0
+
+    def refresh(self) -> bool:
+        """Fetch the key set now. Returns False (keeping old keys) on failure."""
+        with self._fetch_lock:
+            return self._fetch_locked()
+
+    def get_signing_key_from_jwt(self, token: str) -> PyJWK:
+        kid = jwt.get_unverified_header(token).get("kid")
+        key = self._keys.get(kid)
+        if key is not None:
+            return key
+
+        # Single-flight: whoever takes the lock fetches, everyone else waits
+        # and then re-checks the refreshed key set.
+        with self._fetch_lock:
+            key = self._keys.get(kid)
+            if key is None and time.monotonic() - self._last_attempt >= APPLE_KEYS_MISS_REFETCH_SECONDS:
+                self.miss_fetches += 1
+                self._fetch_locked()
+                key = self._keys.get(kid)
+
+        if key is None:
+            if not self._keys:
+                raise RuntimeError("Apple signing keys unavailable")
+            raise jwt.InvalidTokenError(f"Unable to find a signing key that matches kid '{kid}'")
+        return key
+
+    async def refresh_forever(self):
+        """
+        Background task started after the startup prefetch: refresh before keys
+        go stale, and retry sooner while the last fetch is failing.
+        """
+        ok = bool(self._keys)
+        while True:
+            await asyncio.sleep(APPLE_KEYS_REFRESH_SECONDS if ok else APPLE_KEYS_RETRY_SECONDS)
+            ok = await asyncio.to_thread(self.refresh)
+
+    def stats(self) -> dict:
+        return {
+            "kids": sorted(self._keys),
+            "age_seconds": time.monotonic() - self._fetched_at if self._fetched_at else None,
+            "fetches": self.fetches,
+            "fetch_failures": self.fetch_failures,
+            "miss_fetches": self.miss_fetches,
+        }
+
+    def _fetch_locked(self) -> bool:
+        self._last_attempt = time.monotonic()
+        self.fetches += 1
+        try:
+            response = httpx.get(self.url, timeout=APPLE_KEYS_FETCH_TIMEOUT)
+            response.raise_for_status()
+            key_set = PyJWKSet.from_dict(response.json())
+            keys = {k.key_id: k for k in key_set.keys if k.key_id}
+            if not keys:
+                raise ValueError("Apple JWKS response contained no usable keys")
+        except Exception as e:
+            self.fetch_failures += 1
+            print(f"⚠️ Apple JWKS refresh failed, keeping {len(self._keys)} cached keys: {str(e)}")
+            return False
+        self._keys = keys
+        self._fetched_at = time.monotonic()
+        return True
+
+
+apple_keystore = AppleKeyStore(APPLE_KEYS_URL)
@@ -8,11 +8,19 @@
 #   3. Verify each cert is signed by its parent
 #   4. Verify the JWS signature using the leaf cert's EC public key
 #   5. Decode the payload and verify bundle ID + active subscription
+#
+# Steps 2-3 are cached: a chain that already verified is remembered by its
+# fingerprint (with its leaf public key) until the earliest certificate in it
+# expires, so repeat calls only check the leaf JWS signature.
 
 import base64
+import hashlib
 import json
 import os
+import threading
+from collections import OrderedDict
 from datetime import datetime, timezone
+from typing import List
 
 from cryptography import x509
 from cryptography.hazmat.backends import default_backend
@@ -25,6 +33,12 @@ from cryptography.exceptions import InvalidSignature
 
 
 BUNDLE_ID = os.getenv("APPLE_CLIENT_ID", "OrgIdentifier.ai-anti-doomscroll")
+CHAIN_CACHE_MAX_ENTRIES = 64
+
+# chain fingerprint -> (leaf public key, valid_from, valid_until)
+_chain_cache: "OrderedDict[str, tuple]" = OrderedDict()
+_chain_cache_lock = threading.Lock()
+chain_cache_stats = {"hits": 0, "misses": 0}
 
 
 def _b64url_decode(s: str) -> bytes:
@@ -41,6 +55,120 @@ def _decode_payload_unverified(payload_b64: str) -> dict:
         raise ValueError("Failed to decode JWS payload")
 
 
+def _cert_validity(cert) -> tuple:
+    """(not_before, not_after) as aware UTC datetimes across cryptography versions."""
+    if hasattr(cert, "not_valid_before_utc"):
+        return cert.not_valid_before_utc, cert.not_valid_after_utc
+    return (
+        cert.not_valid_before.replace(tzinfo=timezone.utc),
+        cert.not_valid_after.replace(tzinfo=timezone.utc),
+    )
+
+
+def _verified_leaf_key(x5c: List[str]):
+    """
+    Return the leaf public key of an x5c chain that terminates at an Apple CA
+    and is correctly signed link by link. Verified chains are cached by
+    fingerprint and only served while every certificate in them is valid.
+    """
+    if not isinstance(x5c, list) or not all(isinstance(c, str) for c in x5c):
+        raise ValueError("JWS x5c header must be a list of base64 certificates")
+    if len(x5c) < 2:
+        raise ValueError("JWS must contain a certificate chain of at least 2 certs")
+
+    fingerprint = hashlib.sha256("|".join(x5c).encode("utf-8")).hexdigest()
+    now = datetime.now(tz=timezone.utc)
+
+    with _chain_cache_lock:
+        entry = _chain_cache.get(fingerprint)
+        if entry is not None:
+            leaf_public_key, valid_from, valid_until = entry
+            if valid_from <= now <= valid_until:
+                _chain_cache.move_to_end(fingerprint)
+                chain_cache_stats["hits"] += 1
+                return leaf_public_key
+            del _chain_cache[fingerprint]
+        chain_cache_stats["misses"] += 1
+
+    # ── 3. Load certificate chain ──────────────────────────────────────
+    certs = []
+    for cert_b64 in x5c:
+        try:
+            cert_bytes = base64.b64decode(cert_b64)  # x5c uses standard base64
+            cert = x509.load_der_x509_certificate(cert_bytes, default_backend())
+            certs.append(cert)
+        except Exception as e:
+            raise ValueError(f"Failed to parse certificate in chain: {e}")
+
+    # ── 4. Verify root is an Apple CA ──────────────────────────────────
+    root_cert = certs[-1]
+    cn_attrs = root_cert.subject.get_attributes_for_oid(x509.NameOID.COMMON_NAME)
+    root_cn = cn_attrs[0].value if cn_attrs else ""
+    if "Apple" not in root_cn:
+        raise ValueError(f"Root certificate is not an Apple CA: '{root_cn}'")
+
+    # ── 5. Verify each cert is signed by the next in the chain ────────
+    # Apple Sandbox intermediates may use RSA or ECDSA with SHA-256/384/512.
+    # Use certificate.signature_hash_algorithm (the authoritative API) rather
+    # than trying to parse OID strings, and branch on the parent key type.
+    for i in range(len(certs) - 1):
+        child = certs[i]
+        parent = certs[i + 1]
+        parent_key = parent.public_key()
+        hash_algo = child.signature_hash_algorithm or SHA256()
+        try:
+            if isinstance(parent_key, RSAPublicKey):
+                parent_key.verify(
+                    child.signature,
+                    child.tbs_certificate_bytes,
+                    PKCS1v15(),
+                    hash_algo,
+                )
+            else:
+                parent_key.verify(
+                    child.signature,
+                    child.tbs_certificate_bytes,
+                    ECDSA(hash_algo),
+                )
+        except InvalidSignature:
+            raise ValueError(f"Certificate chain broken at index {i}")
+        except Exception as e:
+            raise ValueError(f"Certificate chain verification error: {e}")
+
+    leaf_public_key = certs[0].public_key()
+    windows = [_cert_validity(c) for c in certs]
+    valid_from = max(w[0] for w in windows)
+    valid_until = min(w[1] for w in windows)
+
+    with _chain_cache_lock:
+        _chain_cache[fingerprint] = (leaf_public_key, valid_from, valid_until)
+        _chain_cache.move_to_end(fingerprint)
+        while len(_chain_cache) > CHAIN_CACHE_MAX_ENTRIES:
+            _chain_cache.popitem(last=False)
+
+    return leaf_public_key
+
+
+def _verify_jws_signature(leaf_public_key, header_b64: str, payload_b64: str, signature_b64: str):
+    """Verify the ES256 JWS signature with the leaf cert's public key."""
+    # JWS ES256 uses raw format (r||s, 64 bytes). cryptography's verify()
+    # requires DER-encoded format, so convert before verifying.
+    signing_input = f"{header_b64}.{payload_b64}".encode("utf-8")
+    try:
+        raw_sig = _b64url_decode(signature_b64)
+        if len(raw_sig) == 64:
+            r = int.from_bytes(raw_sig[:32], "big")
+            s = int.from_bytes(raw_sig[32:], "big")
+            der_sig = encode_dss_signature(r, s)
+        else:
+            der_sig = raw_sig
+        leaf_public_key.verify(der_sig, signing_input, ECDSA(SHA256()))
+    except InvalidSignature:
+        raise ValueError("JWS signature is invalid — token has been tampered with")
+    except Exception as e:
+        raise ValueError(f"Signature verification error: {e}")
+
+
 def verify_app_store_jws(jws_token: str) -> dict:
     """
     Verify an Apple App Store JWS transaction token (StoreKit 2).
@@ -77,73 +205,11 @@ def verify_app_store_jws(jws_token: str) -> dict:
     if environment == "Xcode":
         print(f"ℹ️  [verify_jws] Xcode StoreKit environment — skipping cert chain verification")
     else:
-        # ── 3. Load certificate chain ──────────────────────────────────────
-        x5c = header.get("x5c", [])
-        if len(x5c) < 2:
-            raise ValueError("JWS must contain a certificate chain of at least 2 certs")
-
-        certs = []
-        for cert_b64 in x5c:
-            try:
-                cert_bytes = base64.b64decode(cert_b64)  # x5c uses standard base64
-                cert = x509.load_der_x509_certificate(cert_bytes, default_backend())
-                certs.append(cert)
-            except Exception as e:
-                raise ValueError(f"Failed to parse certificate in chain: {e}")
-
-        # ── 4. Verify root is an Apple CA ──────────────────────────────────
-        root_cert = certs[-1]
-        cn_attrs = root_cert.subject.get_attributes_for_oid(x509.NameOID.COMMON_NAME)
-        root_cn = cn_attrs[0].value if cn_attrs else ""
-        if "Apple" not in root_cn:
-            raise ValueError(f"Root certificate is not an Apple CA: '{root_cn}'")
-
-        # ── 5. Verify each cert is signed by the next in the chain ────────
-        # Apple Sandbox intermediates may use RSA or ECDSA with SHA-256/384/512.
-        # Use certificate.signature_hash_algorithm (the authoritative API) rather
-        # than trying to parse OID strings, and branch on the parent key type.
-        for i in range(len(certs) - 1):
-            child = certs[i]
-            parent = certs[i + 1]
-            parent_key = parent.public_key()
-            hash_algo = child.signature_hash_algorithm or SHA256()
-            try:
-                if isinstance(parent_key, RSAPublicKey):
-                    parent_key.verify(
-                        child.signature,
-                        child.tbs_certificate_bytes,
-                        PKCS1v15(),
-                        hash_algo,
-                    )
-                else:
-                    parent_key.verify(
-                        child.signature,
-                        child.tbs_certificate_bytes,
-                        ECDSA(hash_algo),
-                    )
-            except InvalidSignature:
-                raise ValueError(f"Certificate chain broken at index {i}")
-            except Exception as e:
-                raise ValueError(f"Certificate chain verification error: {e}")
+        # ── 3-5. Verify certificate chain (cached by fingerprint) ──────────
+        leaf_public_key = _verified_leaf_key(header.get("x5c", []))
 
         # ── 6. Verify JWS signature with leaf cert's public key ───────────
-        # JWS ES256 uses raw format (r||s, 64 bytes). cryptography's verify()
-        # requires DER-encoded format, so convert before verifying.
-        leaf_public_key = certs[0].public_key()
-        signing_input = f"{header_b64}.{payload_b64}".encode("utf-8")
-        try:
-            raw_sig = _b64url_decode(signature_b64)
-            if len(raw_sig) == 64:
-                r = int.from_bytes(raw_sig[:32], "big")
-                s = int.from_bytes(raw_sig[32:], "big")
-                der_sig = encode_dss_signature(r, s)
-            else:
-                der_sig = raw_sig
-            leaf_public_key.verify(der_sig, signing_input, ECDSA(SHA256()))
-        except InvalidSignature:
-            raise ValueError("JWS signature is invalid — token has been tampered with")
-        except Exception as e:
-            raise ValueError(f"Signature verification error: {e}")
+        _verify_jws_signature(leaf_public_key, header_b64, payload_b64, signature_b64)
 
         print(f"✅ [verify_jws] {environment} cert chain + signature verified")
 
@@ -164,3 +230,21 @@ def verify_app_store_jws(jws_token: str) -> dict:
             )
 
     return payload
+
+
+def verify_app_store_jws_batch(jws_tokens: List[str]) -> List[dict]:
+    """
+    Verify many transaction JWS tokens (e.g. a restore-purchases flow).
+    Tokens signed by the same chain share one chain verification via the
+    cache, so each extra token costs one signature check.
+
+    Returns one result per token, in order: {"ok": True, "payload": {...}}
+    or {"ok": False, "error": "..."}.
+    """
+    results = []
+    for jws_token in jws_tokens:
+        try:
+            results.append({"ok": True, "payload": verify_app_store_jws(jws_token)})
+        except ValueError as e:
+            results.append({"ok": False, "error": str(e)})
+    return results
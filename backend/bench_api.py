@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+No-network benchmark for the HTTP routers.
+
+Runs the app in-process (FastAPI TestClient) against the SQLite backend in a
+throwaway file, logs in with TEST_PHONE / TEST_OTP, seeds a few todos, then
+times each route. Redis is optional: without it the in-process fallbacks are
+measured. The lifespan (Apple key prefetch, background tasks) is skipped;
+migrations are applied directly.
+
+Run: python bench_api.py [iterations]
+"""
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+_tmpdir = tempfile.mkdtemp(prefix="bench_api_")
+os.environ["DB_BACKEND"] = "sqlite"
+os.environ["SQLITE_PATH"] = os.path.join(_tmpdir, "bench.db")
+os.environ.pop("DATABASE_URL", None)
+os.environ.setdefault("SECRET_KEY", "bench-secret-key-bench-secret-key")
+os.environ.setdefault("TEST_PHONE", "+15550000000")
+os.environ.setdefault("TEST_OTP", "000000")
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import db  # noqa: E402
+import main  # noqa: E402
+import otp  # noqa: E402
+
+
+def _time(label, iterations, fn):
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):  # silence per-request logging
+        for _ in range(iterations):
+            response = fn()
+            if response.status_code >= 400:
+                raise RuntimeError(f"{label}: HTTP {response.status_code} {response.text}")
+    per_call_us = (time.perf_counter() - started) / iterations * 1e6
+    print(f"{label:<34} {per_call_us:9.1f} µs/call")
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    db.init_db()
+    client = TestClient(main.app)
+
+    token = client.post("/otp/verify", json={"phone": otp.TEST_PHONE, "otp": otp.TEST_OTP}).json()["token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    for i in range(20):
+        client.post("/todos", json={"task": f"seed task {i}"}, headers=headers)
+
+    print(f"backend: {db.describe_backend()}")
+    _time("GET  /todos", iterations, lambda: client.get("/todos", headers=headers))
+    _time("POST /todos", iterations, lambda: client.post("/todos", json={"task": "bench"}, headers=headers))
+    _time("GET  /profile/premium-status", iterations,
+          lambda: client.get("/profile/premium-status", headers=headers))
+    _time("GET  /call-usage/check-limit", iterations,
+          lambda: client.get("/call-usage/check-limit", headers=headers))
+    _time("POST /call-usage/record-duration", iterations,
+          lambda: client.post("/call-usage/record-duration", json={"duration_seconds": 0.1}, headers=headers))
+    _time("GET  /manual-unblock/check-limit", iterations,
+          lambda: client.get("/manual-unblock/check-limit", headers=headers))
+    _time("GET  /voice/status", iterations, lambda: client.get("/voice/status", headers=headers))
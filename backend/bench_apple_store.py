@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark for apple_store.verify_app_store_jws.
+
+Builds a throwaway 3-cert EC chain (root CN contains "Apple" so it passes the
+root check), signs a Sandbox transaction JWS with the leaf key, then times
+verification with the chain cache cleared before every call (old per-call
+cost) versus a warm cache (leaf signature only).
+
+Run: python bench_apple_store.py [iterations]
+"""
+import base64
+import json
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature
+from cryptography.x509.oid import NameOID
+
+import apple_store
+
+
+def _b64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _cert(subject_cn, subject_key, issuer_cn, issuer_key, is_ca):
+    now = datetime.now(timezone.utc)
+    return (
+        x509.CertificateBuilder()
+        .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, subject_cn)]))
+        .issuer_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, issuer_cn)]))
+        .public_key(subject_key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - timedelta(days=1))
+        .not_valid_after(now + timedelta(days=30))
+        .add_extension(x509.BasicConstraints(ca=is_ca, path_length=None), critical=True)
+        .sign(issuer_key, hashes.SHA256())
+    )
+
+
+def build_jws() -> str:
+    root_key = ec.generate_private_key(ec.SECP256R1())
+    inter_key = ec.generate_private_key(ec.SECP256R1())
+    leaf_key = ec.generate_private_key(ec.SECP256R1())
+    root = _cert("Bench Apple Root CA", root_key, "Bench Apple Root CA", root_key, True)
+    inter = _cert("Bench Intermediate", inter_key, "Bench Apple Root CA", root_key, True)
+    leaf = _cert("Bench Leaf", leaf_key, "Bench Intermediate", inter_key, False)
+
+    header = {
+        "alg": "ES256",
+        "x5c": [base64.b64encode(c.public_bytes(serialization.Encoding.DER)).decode() for c in (leaf, inter, root)],
+    }
+    payload = {
+        "bundleId": apple_store.BUNDLE_ID,
+        "environment": "Sandbox",
+        "productId": "bench.premium",
+        "expiresDate": int((time.time() + 86400) * 1000),
+    }
+    signing_input = f"{_b64url(json.dumps(header).encode())}.{_b64url(json.dumps(payload).encode())}"
+    r, s = decode_dss_signature(leaf_key.sign(signing_input.encode(), ec.ECDSA(hashes.SHA256())))
+    return f"{signing_input}.{_b64url(r.to_bytes(32, 'big') + s.to_bytes(32, 'big'))}"
+
+
+def _time(label, iterations, fn):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    per_call_us = (time.perf_counter() - started) / iterations * 1e6
+    print(f"{label:<28} {per_call_us:9.1f} µs/call")
+    return per_call_us
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    jws = build_jws()
+    apple_store.print = lambda *a, **k: None  # silence per-call logging
+
+    def cold():
+        apple_store._chain_cache.clear()
+        apple_store.verify_app_store_jws(jws)
+
+    cold_us = _time("full chain (cache cleared)", iterations, cold)
+    warm_us = _time("cached chain", iterations, lambda: apple_store.verify_app_store_jws(jws))
+    _time("batch of 10 (cached chain)", max(1, iterations // 10),
+          lambda: apple_store.verify_app_store_jws_batch([jws] * 10))
+    print(f"speedup: {cold_us / warm_us:.1f}x")
@@ -1,12 +1,13 @@
 # call_usage.py - Handles daily call limit tracking
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Request, Response
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
-from sqlalchemy import and_
-from db import get_db
-from models import CallUsage
-from otp import verify_token, get_user_identifier
-from datetime import datetime, timezone
+from sqlalchemy.ext.asyncio import AsyncSession
+from db import get_async_db
+from read_routing import get_read_db
+from usage_counters import add_usage, read_usage
+from otp import verify_token, get_owner, Owner
+import state_version
+from datetime import datetime
 from zoneinfo import ZoneInfo
 
 EASTERN = ZoneInfo("America/New_York")
@@ -27,18 +28,13 @@ class RecordCallDurationRequest(BaseModel):
     duration_seconds: float
 
 
-def _check_limit_by_phone(db: Session, phone: str) -> CallLimitResponse:
-    """Business logic for checking call limits by phone identifier."""
+async def _check_limit_for_owner(db: AsyncSession, owner: Owner) -> CallLimitResponse:
+    """Business logic for checking call limits for a user."""
     today = datetime.now(EASTERN).date()
     
-    usage = db.query(CallUsage).filter(
-        and_(
-            CallUsage.phone == phone,
-            CallUsage.usage_date == today
-        )
-    ).first()
+    used = await read_usage(db, "call", owner, today)
     
-    if not usage:
+    if not used:
         return CallLimitResponse(
             can_call=True,
             remaining_seconds=DAILY_LIMIT_SECONDS,
@@ -46,70 +42,54 @@ def _check_limit_by_phone(db: Session, phone: str) -> CallLimitResponse:
             limit_seconds=DAILY_LIMIT_SECONDS
         )
     
-    remaining = max(0.0, DAILY_LIMIT_SECONDS - usage.seconds_used)
+    remaining = max(0.0, DAILY_LIMIT_SECONDS - used)
     can_call = remaining > 0
     
     return CallLimitResponse(
         can_call=can_call,
         remaining_seconds=remaining,
-        used_seconds=usage.seconds_used,
+        used_seconds=used,
         limit_seconds=DAILY_LIMIT_SECONDS
     )
 
 
 @router.get("/check-limit")
-def check_call_limit(
-    db: Session = Depends(get_db),
+async def check_call_limit(
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(get_read_db),
     user_id: str = Depends(verify_token)
 ):
-    phone = get_user_identifier(user_id, db)
-    return _check_limit_by_phone(db, phone)
+    owner = await get_owner(user_id, db)
+    cached = await state_version.not_modified(request, response, owner.id, datetime.now(EASTERN).date())
+    if cached:
+        return cached
+    return await _check_limit_for_owner(db, owner)
 
 
 @router.post("/record-duration")
-def record_call_duration(
+async def record_call_duration(
     request: RecordCallDurationRequest,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     user_id: str = Depends(verify_token)
 ):
-    phone = get_user_identifier(user_id, db)
+    owner = await get_owner(user_id, db)
     duration_seconds = request.duration_seconds
-    print(f"📞 Recording call duration: {duration_seconds:.2f} seconds for user {user_id} (phone={phone})")
+    print(f"📞 Recording call duration: {duration_seconds:.2f} seconds for user {user_id} (phone={owner.identifier})")
     
     today = datetime.now(EASTERN).date()
     
-    usage = db.query(CallUsage).filter(
-        and_(
-            CallUsage.phone == phone,
-            CallUsage.usage_date == today
-        )
-    ).first()
-    
-    if not usage:
-        usage = CallUsage(
-            phone=phone,
-            usage_date=today,
-            seconds_used=0.0
-        )
-        db.add(usage)
-        print(f"📊 Created new usage record for {phone} on {today}")
-    else:
-        print(f"📊 Found existing usage record: {usage.seconds_used:.2f}s already used today")
-    
-    old_used = usage.seconds_used
-    usage.seconds_used += duration_seconds
-    usage.updated_at = datetime.now(timezone.utc)
-    
-    db.commit()
-    db.refresh(usage)
+    used = await add_usage(db, "call", owner, today, duration_seconds)
+    await db.commit()
+    await state_version.bump(owner.id)
     
-    remaining = max(0.0, DAILY_LIMIT_SECONDS - usage.seconds_used)
+    remaining = max(0.0, DAILY_LIMIT_SECONDS - used)
     
-    print(f"✅ Call duration recorded: {duration_seconds:.2f}s added. Total used: {old_used:.2f}s → {usage.seconds_used:.2f}s. Remaining: {remaining:.2f}s")
+    print(f"✅ Call duration recorded: {duration_seconds:.2f}s added. Total used: {used - duration_seconds:.2f}s → {used:.2f}s. Remaining: {remaining:.2f}s")
     
     return {
         "message": "Call duration recorded",
-        "used_seconds": usage.seconds_used,
+        "used_seconds": used,
         "remaining_seconds": remaining,
         "limit_seconds": DAILY_LIMIT_SECONDS
     }
@@ -1,26 +1,55 @@
 # chat.py - Handles Gemini text chat with conversation memory
 from fastapi import APIRouter, HTTPException, Depends
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
 from typing import List, Optional
 import httpx
+import asyncio
+import json
 import os
-from datetime import datetime, date, timezone
-from sqlalchemy.orm import Session
-from sqlalchemy import and_
-from db import get_db
-from models import ChatUsage, Profile
-from otp import verify_token, get_user_identifier
+import time
+from collections import deque
+from datetime import date
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from db import get_async_db, AsyncSessionLocal, pin_to_primary
+from models import Profile
+from usage_counters import add_usage, read_usage
+from otp import verify_token, get_owner, Owner
+from rate_limit import chat_message_limiter
+import upstreams
+import conversation_store
 
 router = APIRouter(prefix="/chat", tags=["chat"])
 
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-lite:generateContent"
+GEMINI_STREAM_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-lite:streamGenerateContent"
 
 MAX_MESSAGES_PER_DAY = 1000
 MAX_CHARACTERS_PER_MESSAGE = 3000
 
-# In-memory conversation storage keyed by user_id
-conversations = {}
+# History compaction (approximate tokens). Past CHAT_SUMMARIZE_AT_TOKENS of
+# unsummarized history, older turns are folded into a rolling summary in the
+# background; the latest CHAT_RECENT_TOKENS (at least MIN_RECENT_MESSAGES
+# messages) always stay verbatim. Until the summary lands, a request that
+# would exceed CHAT_HISTORY_TOKEN_BUDGET drops its oldest turns instead.
+CHAT_HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKEN_BUDGET", "4000"))
+CHAT_SUMMARIZE_AT_TOKENS = int(os.getenv("CHAT_SUMMARIZE_AT_TOKENS", "2500"))
+CHAT_RECENT_TOKENS = int(os.getenv("CHAT_RECENT_TOKENS", "1200"))
+MIN_RECENT_MESSAGES = 4
+MAX_STORED_MESSAGES = 200
+
+# Streaming: time from request to first relayed chunk, last 1000 streams
+_first_token_ms = deque(maxlen=1000)
+_stream_stats = {"streams": 0, "completed": 0, "aborted": 0, "upstream_errors": 0, "save_errors": 0}
+
+# Request size (estimated history tokens sent), last 1000 turns
+_prompt_tokens = deque(maxlen=1000)
+_compaction_stats = {"summaries": 0, "summary_failures": 0, "summaries_discarded": 0, "truncated_turns": 0}
+# user id -> summary task running in this worker
+_summarizing = {}
 
 
 class ChatMessage(BaseModel):
@@ -70,61 +99,29 @@ def detect_conversation_end(user_message: str) -> bool:
     return any(phrase in message_lower for phrase in end_phrases)
 
 
-def check_chat_limits(db: Session, phone: str):
+async def check_chat_limits(db: AsyncSession, owner: Owner):
     today = date.today()
     
-    usage = db.query(ChatUsage).filter(
-        and_(
-            ChatUsage.phone == phone,
-            ChatUsage.usage_date == today
-        )
-    ).first()
-    
-    if not usage:
-        return (True, 0)
+    message_count = await read_usage(db, "chat", owner, today)
     
-    can_send = usage.message_count < MAX_MESSAGES_PER_DAY
-    return (can_send, usage.message_count)
+    can_send = message_count < MAX_MESSAGES_PER_DAY
+    return (can_send, message_count)
 
 
-def record_chat_message(db: Session, phone: str):
-    today = date.today()
-    
-    usage = db.query(ChatUsage).filter(
-        and_(
-            ChatUsage.phone == phone,
-            ChatUsage.usage_date == today
-        )
-    ).first()
-    
-    if not usage:
-        usage = ChatUsage(
-            phone=phone,
-            usage_date=today,
-            message_count=0
-        )
-        db.add(usage)
-    
-    usage.message_count += 1
-    usage.updated_at = datetime.now(timezone.utc)
-    
-    db.commit()
-    db.refresh(usage)
+async def record_chat_message(db: AsyncSession, owner: Owner):
+    await add_usage(db, "chat", owner, date.today())
+    await db.commit()
 
 
-@router.post("/message")
-async def send_chat_message(
-    request: ChatRequest,
-    user_id: str = Depends(verify_token),
-    db: Session = Depends(get_db)
-):
+async def _start_turn(request: ChatRequest, user_id: str, db: AsyncSession):
+    """Checks premium and limits and loads the conversation. Returns (owner, conversation, user_entry, ended)."""
     if not GEMINI_API_KEY:
         raise HTTPException(status_code=500, detail="Gemini API key not configured")
     
-    phone = get_user_identifier(user_id, db)
+    owner = await get_owner(user_id, db)
 
     # Require premium subscription to access AI chat
-    profile = db.query(Profile).filter(Profile.phone == phone).first()
+    profile = (await db.execute(select(Profile).where(Profile.user_id == owner.id))).scalars().first()
     if not profile or not profile.is_premium:
         raise HTTPException(
             status_code=403,
@@ -137,80 +134,188 @@ async def send_chat_message(
             detail=f"Message too long. Maximum {MAX_CHARACTERS_PER_MESSAGE} characters allowed."
         )
     
-    can_send, messages_sent = check_chat_limits(db, phone)
+    can_send, messages_sent = await check_chat_limits(db, owner)
     if not can_send:
         raise HTTPException(
             status_code=429,
             detail=f"Daily message limit reached. You've sent {messages_sent} messages today (limit: {MAX_MESSAGES_PER_DAY})."
         )
     
-    if request.is_new_conversation or user_id not in conversations:
-        conversations[user_id] = {
-            "history": [],
-            "todos": request.todos,
-            "started_at": datetime.now()
-        }
-        system_prompt = build_system_prompt(request.todos)
-        conversations[user_id]["history"].append({
-            "role": "user",
-            "parts": [{"text": system_prompt}]
-        })
-        conversations[user_id]["history"].append({
-            "role": "model",
-            "parts": [{"text": "I see you have some tasks to complete. Let's talk about them. What have you been up to?"}]
-        })
-    
-    conversation = conversations[user_id]
+    if request.is_new_conversation:
+        # Saving a new conversation only creates one, so the old one goes first
+        await conversation_store.pop(user_id)
+        conversation = None
+    else:
+        conversation = await conversation_store.get(user_id)
+    if conversation is None:
+        conversation = conversation_store.new_conversation(request.todos, [
+            {"role": "user", "parts": [{"text": build_system_prompt(request.todos)}]},
+            {"role": "model", "parts": [{"text": "I see you have some tasks to complete. Let's talk about them. What have you been up to?"}]},
+        ])
     
-    conversation["history"].append({
-        "role": "user",
-        "parts": [{"text": request.message}]
-    })
+    user_entry = {"role": "user", "parts": [{"text": request.message}]}
     
     conversation_ended = detect_conversation_end(request.message)
+    return owner, conversation, user_entry, conversation_ended
+
+
+def estimate_tokens(message: dict) -> int:
+    """Rough Gemini token count for one history entry (~4 characters per token)."""
+    return len(message["parts"][0]["text"]) // 4 + 4
+
+
+def _prompt_contents(conversation: dict, user_entry: dict) -> list:
+    """
+    The contents sent to Gemini: system prompt (plus the summary of earlier
+    turns, if any), greeting, then as many recent turns as fit the budget.
+    """
+    system, greeting = conversation["history"][:2]
+    if conversation["summary"]:
+        system = {"role": "user", "parts": [{"text": (
+            f"{system['parts'][0]['text']}\n\nSummary of the conversation so far:\n{conversation['summary']}"
+        )}]}
+    room = CHAT_HISTORY_TOKEN_BUDGET - estimate_tokens(system) - estimate_tokens(greeting) - estimate_tokens(user_entry)
+    turns = conversation["history"][2:]
+    kept = 0
+    for message in reversed(turns):
+        room -= estimate_tokens(message)
+        if room < 0:
+            break
+        kept += 1
+    if kept and turns[-kept]["role"] == "model":
+        kept -= 1  # start on a user turn, right after the greeting
+    if kept < len(turns):
+        _compaction_stats["truncated_turns"] += 1
+    contents = [system, greeting] + (turns[-kept:] if kept else []) + [user_entry]
+    _prompt_tokens.append(sum(estimate_tokens(m) for m in contents))
+    return contents
+
+
+def _turns_to_summarize(history: list) -> int:
+    """How many turns after the greeting should be folded into the summary (0 = none yet)."""
+    turns = history[2:]
+    if sum(estimate_tokens(m) for m in turns) <= CHAT_SUMMARIZE_AT_TOKENS:
+        return 0
+    recent, recent_tokens = 0, 0
+    for message in reversed(turns):
+        if recent >= MIN_RECENT_MESSAGES and recent_tokens + estimate_tokens(message) > CHAT_RECENT_TOKENS:
+            break
+        recent += 1
+        recent_tokens += estimate_tokens(message)
+    fold = len(turns) - recent
+    if fold and turns[fold]["role"] == "model":
+        fold -= 1  # keep the question with its answer
+    return fold
+
+
+async def _summarize(previous: Optional[str], turns: list) -> Optional[str]:
+    earlier = f"Summary of the conversation before this part:\n{previous}\n\n" if previous else ""
+    lines = "\n".join(f"{'User' if m['role'] == 'user' else 'AI'}: {m['parts'][0]['text']}" for m in turns)
+    prompt = f"""Summarize this part of a conversation between a user and an AI friend who is holding them accountable for their tasks. Keep which tasks the user claims to have finished and the evidence they gave, what the AI accepted or doubted, and anything the user promised. Write at most 150 words in plain prose.
+
+{earlier}Conversation:
+{lines}"""
+    try:
+        response = await upstreams.client("gemini").post(
+            f"{GEMINI_API_URL}?key={GEMINI_API_KEY}",
+            json={"contents": [{"role": "user", "parts": [{"text": prompt}]}]},
+        )
+        if response.status_code != 200:
+            print(f"❌ Gemini Summary Error: {response.text}")
+            return None
+        return response.json()["candidates"][0]["content"]["parts"][0]["text"].strip()
+    except (httpx.HTTPError, ValueError, KeyError, IndexError) as e:
+        print(f"❌ Gemini Summary Exception: {str(e)}")
+        return None
+
+
+async def _compact(user_id: str):
+    """Background task: fold older turns into the conversation's cached summary."""
+    try:
+        conversation = await conversation_store.get(user_id)
+        fold = _turns_to_summarize(conversation["history"]) if conversation else 0
+        if not fold:
+            return
+        folded = conversation["history"][2:2 + fold]
+        summary = await _summarize(conversation["summary"], folded)
+        if summary is None:
+            _compaction_stats["summary_failures"] += 1
+            return
+
+        def apply(latest: dict) -> Optional[dict]:
+            # Only if the conversation still starts with what was summarized
+            # (not restarted or already compacted by another worker)
+            if latest["summary"] != conversation["summary"] or latest["history"][:2 + fold] != conversation["history"][:2 + fold]:
+                return None
+            return dict(latest, summary=summary, history=latest["history"][:2] + latest["history"][2 + fold:])
+
+        if await conversation_store.update(user_id, apply) is None:
+            _compaction_stats["summaries_discarded"] += 1
+        else:
+            _compaction_stats["summaries"] += 1
+    finally:
+        _summarizing.pop(user_id, None)
+
+
+def _trim_history(history: list) -> list:
+    # Backstop on storage only; compaction normally keeps history far shorter
+    if len(history) > MAX_STORED_MESSAGES:
+        return history[:2] + history[-(MAX_STORED_MESSAGES - 2):]
+    return history
+
+
+async def _save_turn(user_id: str, conversation: dict, user_entry: dict, ai_response: str):
+    """Stores the user's message and the reply (nothing is stored for a failed turn)."""
+    saved = await conversation_store.append(
+        user_id, conversation, [user_entry, {"role": "model", "parts": [{"text": ai_response}]}],
+        trim=_trim_history,
+    )
+    if user_id not in _summarizing and _turns_to_summarize(saved["history"]):
+        _summarizing[user_id] = asyncio.create_task(_compact(user_id))
+
+
+@router.post("/message")
+async def send_chat_message(
+    request: ChatRequest,
+    user_id: str = Depends(chat_message_limiter.dependency(verify_token)),
+    db: AsyncSession = Depends(get_async_db)
+):
+    owner, conversation, user_entry, conversation_ended = await _start_turn(request, user_id, db)
     
     url = f"{GEMINI_API_URL}?key={GEMINI_API_KEY}"
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                url,
-                json={
-                    "contents": conversation["history"]
-                },
-                timeout=30.0
+        client = upstreams.client("gemini")
+        response = await client.post(
+            url,
+            json={
+                "contents": _prompt_contents(conversation, user_entry)
+            },
+        )
+        
+        if response.status_code != 200:
+            error_text = response.text
+            print(f"❌ Gemini Chat Error: {error_text}")
+            raise HTTPException(
+                status_code=response.status_code,
+                detail=f"Gemini API error: {error_text}"
             )
+        
+        result = response.json()
+        
+        if "candidates" in result and len(result["candidates"]) > 0:
+            ai_response = result["candidates"][0]["content"]["parts"][0]["text"]
+            await _save_turn(user_id, conversation, user_entry, ai_response)
             
-            if response.status_code != 200:
-                error_text = response.text
-                print(f"❌ Gemini Chat Error: {error_text}")
-                raise HTTPException(
-                    status_code=response.status_code,
-                    detail=f"Gemini API error: {error_text}"
-                )
+            await record_chat_message(db, owner)
             
-            result = response.json()
+            return {
+                "response": ai_response,
+                "conversation_ended": conversation_ended
+            }
+        else:
+            raise HTTPException(status_code=500, detail="No response from Gemini")
             
-            if "candidates" in result and len(result["candidates"]) > 0:
-                ai_response = result["candidates"][0]["content"]["parts"][0]["text"]
-                
-                conversation["history"].append({
-                    "role": "model",
-                    "parts": [{"text": ai_response}]
-                })
-                
-                if len(conversation["history"]) > 20:
-                    conversation["history"] = conversation["history"][:2] + conversation["history"][-18:]
-                
-                record_chat_message(db, phone)
-                
-                return {
-                    "response": ai_response,
-                    "conversation_ended": conversation_ended
-                }
-            else:
-                raise HTTPException(status_code=500, detail="No response from Gemini")
-                
     except httpx.HTTPError as e:
         print(f"❌ Gemini Chat HTTP Error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to connect to Gemini: {str(e)}")
@@ -219,20 +324,124 @@ async def send_chat_message(
         raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
 
 
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@router.post("/message/stream")
+async def stream_chat_message(
+    request: ChatRequest,
+    user_id: str = Depends(chat_message_limiter.dependency(verify_token)),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Same as /chat/message, but relays Gemini's reply as Server-Sent Events
+    while it is generated: "delta" events ({"text"}) and then one "done"
+    event ({"response", "conversation_ended"}), or an "error" event. The
+    reply joins the history and the message is counted once the stream
+    completes.
+    """
+    started = time.perf_counter()
+    owner, conversation, user_entry, conversation_ended = await _start_turn(request, user_id, db)
+    _stream_stats["streams"] += 1
+
+    client = upstreams.client("gemini")
+    upstream_request = client.build_request(
+        "POST", f"{GEMINI_STREAM_URL}?alt=sse&key={GEMINI_API_KEY}",
+        json={"contents": _prompt_contents(conversation, user_entry)},
+    )
+    try:
+        response = await client.send(upstream_request, stream=True)
+    except httpx.HTTPError as e:
+        _stream_stats["upstream_errors"] += 1
+        print(f"❌ Gemini Stream HTTP Error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to connect to Gemini: {str(e)}")
+    if response.status_code != 200:
+        error_text = (await response.aread()).decode(errors="replace")
+        await response.aclose()
+        _stream_stats["upstream_errors"] += 1
+        print(f"❌ Gemini Stream Error: {error_text}")
+        raise HTTPException(status_code=response.status_code, detail=f"Gemini API error: {error_text}")
+
+    async def relay():
+        parts = []
+        completed = False
+        try:
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                chunk = json.loads(line[5:])
+                candidates = chunk.get("candidates") or [{}]
+                text = "".join(p.get("text", "") for p in candidates[0].get("content", {}).get("parts", []))
+                if not text:
+                    continue
+                if not parts:
+                    _first_token_ms.append((time.perf_counter() - started) * 1000)
+                parts.append(text)
+                yield _sse("delta", {"text": text})
+
+            ai_response = "".join(parts)
+            if not ai_response:
+                yield _sse("error", {"detail": "No response from Gemini"})
+                return
+            try:
+                async with AsyncSessionLocal() as session:
+                    await record_chat_message(session, owner)
+                await pin_to_primary(user_id)
+                await _save_turn(user_id, conversation, user_entry, ai_response)
+            except Exception as e:
+                _stream_stats["save_errors"] += 1
+                print(f"❌ Chat Stream save failed: {str(e)}")
+                yield _sse("error", {"detail": "Could not save the reply, please try again"})
+                return
+            completed = True
+            _stream_stats["completed"] += 1
+            yield _sse("done", {"response": ai_response, "conversation_ended": conversation_ended})
+        except (httpx.HTTPError, ValueError) as e:
+            print(f"❌ Gemini Stream Exception: {str(e)}")
+            yield _sse("error", {"detail": f"Gemini stream failed: {str(e)}"})
+        finally:
+            await response.aclose()
+            if not completed:
+                # Client went away or Gemini failed: the unanswered message was never stored
+                _stream_stats["aborted"] += 1
+
+    # The background task also closes the upstream response when the client
+    # disconnects before relay() ever starts (its finally would not run)
+    return StreamingResponse(relay(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+                             background=BackgroundTask(response.aclose))
+
+
+def stats() -> dict:
+    return {
+        **_stream_stats,
+        "conversations": conversation_store.stats(),
+        "first_token_p50_ms": upstreams.percentile(list(_first_token_ms), 0.50),
+        "first_token_p99_ms": upstreams.percentile(list(_first_token_ms), 0.99),
+        "compaction": {
+            **_compaction_stats,
+            "summarizing": len(_summarizing),
+            "prompt_tokens_p50": upstreams.percentile(list(_prompt_tokens), 0.50),
+            "prompt_tokens_p99": upstreams.percentile(list(_prompt_tokens), 0.99),
+        },
+    }
+
+
 @router.post("/end")
 async def end_conversation(
     user_id: str = Depends(verify_token)
 ):
     print(f"📞 Received request to end conversation for user: {user_id}")
-    print(f"📞 Active conversations: {list(conversations.keys())}")
     
-    if user_id not in conversations:
+    conversation = await conversation_store.pop(user_id)
+    if conversation is None:
         print(f"❌ No active conversation found for user: {user_id}")
         raise HTTPException(status_code=404, detail="No active conversation found")
     
-    conversation = conversations[user_id]
-    
     transcript_parts = []
+    if conversation["summary"]:
+        transcript_parts.append(f"(Earlier in the conversation: {conversation['summary']})")
     for msg in conversation["history"][2:]:
         role = "You" if msg["role"] == "user" else "AI"
         content = msg["parts"][0]["text"]
@@ -240,8 +449,6 @@ async def end_conversation(
     
     transcript = "\n".join(transcript_parts)
     print(f"✅ Built transcript with {len(transcript_parts)} messages. Transcript length: {len(transcript)}")
-    
-    del conversations[user_id]
     print(f"✅ Conversation ended and cleaned up for user: {user_id}")
     
     return {
@@ -254,6 +461,5 @@ async def end_conversation(
 async def cancel_conversation(
     user_id: str = Depends(verify_token)
 ):
-    if user_id in conversations:
-        del conversations[user_id]
+    await conversation_store.pop(user_id)
     return {"message": "Conversation cancelled"}
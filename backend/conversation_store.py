@@ -0,0 +1,278 @@
+# conversation_store.py - Chat conversation storage (Redis, or in-process for a single worker)
+"""
+Conversations are dicts {"history": [Gemini contents], "todos": [...],
+"started_at": iso string, "summary": str or None, "version": int or None}. They are stored as
+compact JSON with an idle TTL that every save renews.
+
+Saves are optimistic: save() only succeeds if the stored version is still
+the one that was loaded (version None only creates, if nothing is stored).
+append() retries on a conflict by re-applying its entries to the latest
+copy, so two workers answering the same user at once do not drop each
+other's messages. Replacing a conversation means pop() and then a create.
+
+CONVERSATION_STORE=redis (default when Redis is configured) shares
+conversations across workers and restarts; CONVERSATION_STORE=memory keeps
+them in this process only. While Redis is unreachable a single worker falls
+back to the in-process store; with several workers (WEB_CONCURRENCY > 1)
+that would split conversations between them, so requests get a 503 instead.
+"""
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Optional
+
+from dotenv import load_dotenv
+from fastapi import HTTPException
+
+import redis_pool
+
+load_dotenv(override=True)
+
+CONVERSATION_IDLE_TTL_SECONDS = int(os.getenv("CONVERSATION_IDLE_TTL_SECONDS", "3600"))
+MAX_APPEND_ATTEMPTS = 5
+
+_REDIS_PREFIX = "chat:conv:"
+
+# KEYS: conversation hash. ARGV: expected version ('' = create if absent), data, ttl.
+# Returns the new version, or false when another writer got there first.
+_SAVE_LUA = """
+local version = 1
+if ARGV[1] == '' then
+    if redis.call('EXISTS', KEYS[1]) == 1 then return false end
+else
+    if redis.call('HGET', KEYS[1], 'v') ~= ARGV[1] then return false end
+    version = tonumber(ARGV[1]) + 1
+end
+redis.call('HSET', KEYS[1], 'v', version, 'd', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return version
+"""
+
+
+def new_conversation(todos: list, history: list) -> dict:
+    return {"history": history, "todos": todos, "started_at": datetime.now().isoformat(),
+            "summary": None, "version": None}
+
+
+def _pack(conversation: dict) -> str:
+    # [role, text] pairs instead of Gemini's {"role", "parts": [{"text"}]}
+    return json.dumps({
+        "h": [[m["role"], m["parts"][0]["text"]] for m in conversation["history"]],
+        "t": conversation["todos"],
+        "s": conversation["started_at"],
+        "m": conversation["summary"],
+    }, separators=(",", ":"))
+
+
+def _unpack(data: str, version: int) -> dict:
+    packed = json.loads(data)
+    return {
+        "history": [{"role": role, "parts": [{"text": text}]} for role, text in packed["h"]],
+        "todos": packed["t"],
+        "started_at": packed["s"],
+        "summary": packed.get("m"),
+        "version": version,
+    }
+
+
+class MemoryConversationStore:
+    """Per-process store; only correct with a single worker."""
+
+    name = "memory"
+
+    def __init__(self, idle_ttl: int):
+        self.idle_ttl = idle_ttl
+        self._entries = {}  # user_id -> (version, packed, expires_at)
+        self._lock = threading.Lock()
+
+    async def get(self, user_id: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            if entry[2] <= time.monotonic():
+                del self._entries[user_id]
+                return None
+            return _unpack(entry[1], entry[0])
+
+    async def save(self, user_id: str, conversation: dict) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            current = self._entries.get(user_id)
+            if current is not None and current[2] <= now:
+                current = None
+            if conversation["version"] is None:
+                if current is not None:
+                    return False
+                version = 1
+            elif current is None or current[0] != conversation["version"]:
+                return False
+            else:
+                version = current[0] + 1
+            self._entries[user_id] = (version, _pack(conversation), now + self.idle_ttl)
+            if len(self._entries) > 10000:
+                for uid in [u for u, e in self._entries.items() if e[2] <= now]:
+                    del self._entries[uid]
+        conversation["version"] = version
+        return True
+
+    async def pop(self, user_id: str) -> Optional[dict]:
+        conversation = await self.get(user_id)
+        with self._lock:
+            self._entries.pop(user_id, None)
+        return conversation
+
+    def count(self) -> int:
+        return len(self._entries)
+
+
+class RedisConversationStore:
+    """Shared store: one hash per user (v = version, d = packed conversation)."""
+
+    name = "redis"
+
+    def __init__(self, idle_ttl: int, fallback: Optional[MemoryConversationStore]):
+        self.idle_ttl = idle_ttl
+        self.fallback = fallback  # None: answer 503 while Redis is down
+        self.degraded = False
+        self._save_script = redis_pool.redis.register_script(_SAVE_LUA)
+
+    def _fall_back(self) -> MemoryConversationStore:
+        """Redis cannot serve this call: the in-process store, or a 503."""
+        _stats["fallbacks"] += 1
+        if not self.degraded:
+            self.degraded = True
+            print("⚠️ Conversation store: Redis unreachable, "
+                  + ("using in-process conversations" if self.fallback else "chat unavailable"))
+        if self.fallback is None:
+            raise HTTPException(status_code=503, detail="Chat is temporarily unavailable, please try again")
+        return self.fallback
+
+    def _recovered(self):
+        if self.degraded:
+            self.degraded = False
+            print("✅ Conversation store: Redis reachable again")
+
+    async def get(self, user_id: str) -> Optional[dict]:
+        if not redis_pool.available():
+            return await self._fall_back().get(user_id)
+        try:
+            stored = await redis_pool.redis.hmget(_REDIS_PREFIX + user_id, "v", "d")
+        except Exception as e:
+            redis_pool.mark_error("conversation load", e)
+            return await self._fall_back().get(user_id)
+        self._recovered()
+        if stored[1] is None:
+            return None
+        return _unpack(stored[1], int(stored[0]))
+
+    async def save(self, user_id: str, conversation: dict) -> bool:
+        if not redis_pool.available():
+            return await self._fall_back().save(user_id, conversation)
+        expected = "" if conversation["version"] is None else str(conversation["version"])
+        try:
+            version = await self._save_script(
+                keys=[_REDIS_PREFIX + user_id], args=[expected, _pack(conversation), self.idle_ttl]
+            )
+        except Exception as e:
+            redis_pool.mark_error("conversation save", e)
+            return await self._fall_back().save(user_id, conversation)
+        self._recovered()
+        if version is None:
+            return False
+        conversation["version"] = int(version)
+        return True
+
+    async def pop(self, user_id: str) -> Optional[dict]:
+        if not redis_pool.available():
+            return await self._fall_back().pop(user_id)
+        try:
+            async with redis_pool.redis.pipeline(transaction=True) as pipe:
+                pipe.hmget(_REDIS_PREFIX + user_id, "v", "d")
+                pipe.delete(_REDIS_PREFIX + user_id)
+                stored, _ = await pipe.execute()
+        except Exception as e:
+            redis_pool.mark_error("conversation delete", e)
+            return await self._fall_back().pop(user_id)
+        self._recovered()
+        if stored[1] is None:
+            return None
+        return _unpack(stored[1], int(stored[0]))
+
+    def count(self) -> Optional[int]:
+        return None  # would need a SCAN
+
+
+_stats = {"saves": 0, "conflicts": 0, "lost_appends": 0, "fallbacks": 0}
+
+
+async def append(user_id: str, conversation: dict, entries: list,
+                 trim: Callable[[list], list] = lambda history: history) -> dict:
+    """
+    Save conversation with entries appended (then trimmed). On a version
+    conflict the entries are re-applied to the latest stored copy. Returns
+    the conversation as saved.
+    """
+    for _ in range(MAX_APPEND_ATTEMPTS):
+        updated = dict(conversation, history=trim(conversation["history"] + entries))
+        if await store.save(user_id, updated):
+            _stats["saves"] += 1
+            return updated
+        _stats["conflicts"] += 1
+        latest = await store.get(user_id)
+        if latest is None:
+            break  # ended or expired in the meantime; do not resurrect it
+        conversation = latest
+    _stats["lost_appends"] += 1
+    print(f"⚠️ Conversation append for user {user_id} not saved (ended or contended)")
+    return updated
+
+
+async def update(user_id: str, change: Callable[[dict], Optional[dict]]) -> Optional[dict]:
+    """
+    Apply change to the stored conversation and save it, re-reading and
+    re-applying on a version conflict. change returns the new conversation,
+    or None to leave it alone. Returns what was saved, or None.
+    """
+    for _ in range(MAX_APPEND_ATTEMPTS):
+        latest = await store.get(user_id)
+        if latest is None:
+            return None
+        updated = change(latest)
+        if updated is None:
+            return None
+        if await store.save(user_id, updated):
+            _stats["saves"] += 1
+            return updated
+        _stats["conflicts"] += 1
+    return None
+
+
+def _create_store():
+    memory = MemoryConversationStore(CONVERSATION_IDLE_TTL_SECONDS)
+    several_workers = int(os.getenv("WEB_CONCURRENCY", "1")) > 1
+    backend = os.getenv("CONVERSATION_STORE", "redis" if redis_pool.redis is not None else "memory").lower()
+    if backend == "redis" and redis_pool.redis is not None:
+        return RedisConversationStore(CONVERSATION_IDLE_TTL_SECONDS, fallback=None if several_workers else memory)
+    if several_workers:
+        print("⚠️ In-process conversation store with several workers: chats break across workers")
+    return memory
+
+
+store = _create_store()
+
+
+async def get(user_id: str) -> Optional[dict]:
+    return await store.get(user_id)
+
+
+async def pop(user_id: str) -> Optional[dict]:
+    """Remove and return the user's conversation."""
+    return await store.pop(user_id)
+
+
+def stats() -> dict:
+    return {"backend": store.name, "conversations": store.count(),
+            "degraded": getattr(store, "degraded", False), **_stats}
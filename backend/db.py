@@ -1,58 +1,160 @@
 # db.py
+import itertools
 import os
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import time
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker, Session
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
+from pool_stats import PoolStats, TimedQueuePool, TimedAsyncAdaptedQueuePool
+import redis_pool
 
 # ==========================================
-# 🚀 DEPLOYMENT SWITCH
-# ==========================================
-IS_LOCAL = False  # Set to False when deploying to cloud
+# 🚀 BACKEND SELECTION
+# DB_BACKEND=postgres (default): DATABASE_URL, or a local Postgres built from POSTGRES_*
+# DB_BACKEND=sqlite: a local file (SQLITE_PATH), no network needed (tests, benchmarks)
 # ==========================================
+DATABASE_URL = os.getenv("DATABASE_URL")
+DB_BACKEND = os.getenv("DB_BACKEND") or ("sqlite" if (DATABASE_URL or "").startswith("sqlite") else "postgres")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "local.db")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
 
-# Postgres Configuration
-if IS_LOCAL:
-    # Local Postgres (default connection)
-    POSTGRES_USER = os.getenv("POSTGRES_USER", "postgres")
-    POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD", "postgres")
-    POSTGRES_HOST = os.getenv("POSTGRES_HOST", "localhost")
-    POSTGRES_PORT = os.getenv("POSTGRES_PORT", "5432")
-    POSTGRES_DB = os.getenv("POSTGRES_DB", "anti_doomscroll")
-    DATABASE_URL = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
-    # Async URL for async operations
-    DATABASE_URL_ASYNC = f"postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
-else:
-    # Cloud Postgres (from environment variables, e.g., Render/Supabase)
-    DATABASE_URL = os.getenv("DATABASE_URL")
+
+def _to_async_url(url: str) -> str:
+    """Convert postgres:// or postgresql:// to postgresql+asyncpg:// for async."""
+    if url.startswith("postgres://"):
+        return url.replace("postgres://", "postgresql+asyncpg://", 1)
+    return url.replace("postgresql://", "postgresql+asyncpg://", 1)
+
+
+if DB_BACKEND == "sqlite":
+    if not (DATABASE_URL or "").startswith("sqlite"):
+        DATABASE_URL = f"sqlite:///{SQLITE_PATH}"
+    DATABASE_URL_ASYNC = DATABASE_URL.replace("sqlite://", "sqlite+aiosqlite://", 1)
+elif DB_BACKEND == "postgres":
     if not DATABASE_URL:
-        raise ValueError("DATABASE_URL environment variable must be set for cloud deployment")
-    # Convert postgres:// to postgresql+asyncpg:// for async
-    if DATABASE_URL.startswith("postgres://"):
-        DATABASE_URL_ASYNC = DATABASE_URL.replace("postgres://", "postgresql+asyncpg://", 1)
-    else:
-        DATABASE_URL_ASYNC = DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1)
-
-# Sync engine (for SQLAlchemy ORM)
-engine = create_engine(
-    DATABASE_URL,
-    pool_pre_ping=True,
-    pool_size=5,
-    max_overflow=10,
-)
+        # Local Postgres (default connection)
+        POSTGRES_USER = os.getenv("POSTGRES_USER", "postgres")
+        POSTGRES_PASSWORD = os.getenv("POSTGRES_PASSWORD", "postgres")
+        POSTGRES_HOST = os.getenv("POSTGRES_HOST", "localhost")
+        POSTGRES_PORT = os.getenv("POSTGRES_PORT", "5432")
+        POSTGRES_DB = os.getenv("POSTGRES_DB", "anti_doomscroll")
+        DATABASE_URL = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_HOST}:{POSTGRES_PORT}/{POSTGRES_DB}"
+    DATABASE_URL_ASYNC = _to_async_url(DATABASE_URL)
+else:
+    raise ValueError(f"Unknown DB_BACKEND '{DB_BACKEND}' (expected 'postgres' or 'sqlite')")
+
+# Optional read replicas (comma-separated), used by read-only routes via get_read_db
+DATABASE_REPLICA_URLS = [u.strip() for u in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if u.strip()]
+# After a user commits a write, their reads stay on the primary this long
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "5"))
+
+
+def _env_pool_setting(engine_name: str, key: str, default: str) -> str:
+    """Per-engine override (DB_SYNC_POOL_SIZE) falling back to shared (DB_POOL_SIZE)."""
+    return os.getenv(f"DB_{engine_name}_{key}", os.getenv(f"DB_{key}", default))
+
+
+def pool_settings(engine_name: str) -> dict:
+    """Pool keyword arguments for create_engine, read from the environment."""
+    return {
+        "pool_size": int(_env_pool_setting(engine_name, "POOL_SIZE", "5")),
+        "max_overflow": int(_env_pool_setting(engine_name, "MAX_OVERFLOW", "10")),
+        "pool_timeout": float(_env_pool_setting(engine_name, "POOL_TIMEOUT", "30")),
+        "pool_recycle": int(_env_pool_setting(engine_name, "POOL_RECYCLE", "1800")),
+        "pool_pre_ping": _env_pool_setting(engine_name, "POOL_PRE_PING", "true").lower() == "true",
+    }
 
-# Async engine (for async operations)
+
+SYNC_POOL_SETTINGS = pool_settings("SYNC")
+ASYNC_POOL_SETTINGS = pool_settings("ASYNC")
+REPLICA_POOL_SETTINGS = pool_settings("REPLICA")
+
+# SQLite drivers take the busy timeout in seconds; the PRAGMAs below tune
+# the file for concurrent readers alongside a single writer.
+_connect_args = {"timeout": SQLITE_BUSY_TIMEOUT_MS / 1000} if DB_BACKEND == "sqlite" else {}
+
+# Sync engine (scripts and startup migrations only; request handlers use the async engine)
+engine = create_engine(DATABASE_URL, poolclass=TimedQueuePool, connect_args=_connect_args, **SYNC_POOL_SETTINGS)
+
+# Async engine (used by every router via get_async_db)
 async_engine = create_async_engine(
-    DATABASE_URL_ASYNC,
-    pool_pre_ping=True,
-    pool_size=5,
-    max_overflow=10,
+    DATABASE_URL_ASYNC, poolclass=TimedAsyncAdaptedQueuePool, connect_args=_connect_args, **ASYNC_POOL_SETTINGS
 )
 
+
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+if DB_BACKEND == "sqlite":
+    event.listen(engine, "connect", _sqlite_pragmas)
+    event.listen(async_engine.sync_engine, "connect", _sqlite_pragmas)
+
+sync_pool_stats = PoolStats("sync")
+sync_pool_stats.attach(engine)
+async_pool_stats = PoolStats("async")
+async_pool_stats.attach(async_engine.sync_engine)
+
+if DATABASE_REPLICA_URLS and DB_BACKEND == "sqlite":
+    print("⚠️ DATABASE_REPLICA_URLS ignored with the sqlite backend")
+    DATABASE_REPLICA_URLS = []
+replica_engines = [
+    create_async_engine(_to_async_url(url), poolclass=TimedAsyncAdaptedQueuePool, **REPLICA_POOL_SETTINGS)
+    for url in DATABASE_REPLICA_URLS
+]
+replica_pool_stats = []
+for i, replica_engine in enumerate(replica_engines):
+    replica_pool_stats.append(PoolStats(f"replica_{i}"))
+    replica_pool_stats[-1].attach(replica_engine.sync_engine)
+
+
+class TrackedSession(Session):
+    """Session that remembers whether it committed a write (for read-your-writes)."""
+
+
+@event.listens_for(TrackedSession, "after_flush")
+def _note_flush(session, flush_context):
+    session.info["pending_write"] = True
+
+
+@event.listens_for(TrackedSession, "do_orm_execute")
+def _note_bulk_write(orm_execute_state):
+    # Core/bulk INSERT/UPDATE/DELETE bypass the flush
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info["pending_write"] = True
+
+
+@event.listens_for(TrackedSession, "after_commit")
+def _note_commit(session):
+    if session.info.pop("pending_write", False):
+        session.info["committed_write"] = True
+
+
+@event.listens_for(TrackedSession, "after_rollback")
+def _note_rollback(session):
+    session.info.pop("pending_write", None)
+
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
+AsyncSessionLocal = async_sessionmaker(
+    async_engine, class_=AsyncSession, sync_session_class=TrackedSession, expire_on_commit=False
+)
+ReplicaSessionLocals = [
+    async_sessionmaker(replica_engine, class_=AsyncSession, expire_on_commit=False)
+    for replica_engine in replica_engines
+]
+_replica_cycle = itertools.cycle(range(len(ReplicaSessionLocals))) if ReplicaSessionLocals else None
+
+# user_id -> monotonic deadline; Redis (if available) shares pins across workers
+_primary_pins = {}
 
 def get_db():
-    """Dependency for FastAPI to get database session."""
+    """Sync database session for scripts and startup tasks."""
     db = SessionLocal()
     try:
         yield db
@@ -62,9 +164,83 @@ def get_db():
 async def get_async_db():
     """Dependency for FastAPI to get async database session."""
     async with AsyncSessionLocal() as session:
-        yield session
+        try:
+            yield session
+        finally:
+            # get_owner tags the session with the caller's user_id
+            if session.info.get("committed_write") and session.info.get("user_id"):
+                await pin_to_primary(session.info["user_id"])
+
+
+async def pin_to_primary(user_id: str):
+    """Route this user's reads to the primary for READ_YOUR_WRITES_SECONDS."""
+    if not replica_engines:
+        return
+    now = time.monotonic()
+    _primary_pins[user_id] = now + READ_YOUR_WRITES_SECONDS
+    if len(_primary_pins) > 10000:
+        for uid in [u for u, until in _primary_pins.items() if until <= now]:
+            del _primary_pins[uid]
+    if redis_pool.available():
+        try:
+            await redis_pool.redis.set(f"rw_pin:{user_id}", 1, px=int(READ_YOUR_WRITES_SECONDS * 1000))
+        except Exception as e:
+            redis_pool.mark_error("read-your-writes pin", e)
+
+
+async def is_pinned_to_primary(user_id: str) -> bool:
+    if _primary_pins.get(user_id, 0) > time.monotonic():
+        return True
+    if redis_pool.available():
+        try:
+            return bool(await redis_pool.redis.exists(f"rw_pin:{user_id}"))
+        except Exception as e:
+            redis_pool.mark_error("read-your-writes check", e)
+    return False
+
+
+async def open_read_session(user_id: str) -> AsyncSession:
+    """
+    Session for a read-only request: a replica (round-robin) unless none are
+    configured or the user wrote recently. Replica sessions are tagged so
+    callers can fall back to the primary for lookups that may lag.
+    """
+    if _replica_cycle is None or await is_pinned_to_primary(user_id):
+        return AsyncSessionLocal()
+    session = ReplicaSessionLocals[next(_replica_cycle)]()
+    session.info["replica"] = True
+    return session
+
+def init_db():
+    """Apply pending schema migrations (see migrations.py) and log the setup."""
+    from migrations import run_migrations
+    run_migrations(engine)
+    print(f"✅ Database initialized: {describe_backend()}")
+    print(f"🏊 Connection pools: {describe_pools()}")
+
+
+def describe_backend() -> str:
+    """Backend and location, without credentials."""
+    if DB_BACKEND == "sqlite":
+        return f"sqlite {DATABASE_URL.split(':///', 1)[-1]} (WAL, busy_timeout={SQLITE_BUSY_TIMEOUT_MS}ms, synchronous=NORMAL)"
+    return f"postgres {DATABASE_URL.split('@')[-1]}"
+
+
+def pool_stats() -> dict:
+    """Live pool statistics for both engines."""
+    return {
+        "backend": DB_BACKEND,
+        "sync": {"settings": SYNC_POOL_SETTINGS, **sync_pool_stats.snapshot()},
+        "async": {"settings": ASYNC_POOL_SETTINGS, **async_pool_stats.snapshot()},
+        **{
+            stats.name: {"settings": REPLICA_POOL_SETTINGS, **stats.snapshot()}
+            for stats in replica_pool_stats
+        },
+    }
+
 
-def init_db(Base):
-    """Create tables if they don't exist."""
-    Base.metadata.create_all(bind=engine)
-    print(f"✅ Database initialized: {DATABASE_URL.split('@')[-1] if '@' in DATABASE_URL else 'local'}")
\ No newline at end of file
+def describe_pools() -> str:
+    description = f"sync pool {SYNC_POOL_SETTINGS}, async pool {ASYNC_POOL_SETTINGS}"
+    if replica_engines:
+        description += f", {len(replica_engines)} replica(s) {REPLICA_POOL_SETTINGS}"
+    return description
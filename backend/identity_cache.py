@@ -0,0 +1,126 @@
+# identity_cache.py - Caches user_id -> owner resolution ("<users.id>:<phone or apple_<id>>")
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+from dotenv import load_dotenv
+
+import redis_pool
+
+load_dotenv(override=True)
+
+IDENTITY_CACHE_TTL = float(os.getenv("IDENTITY_CACHE_TTL", "60"))           # seconds, per worker
+IDENTITY_CACHE_REDIS_TTL = int(os.getenv("IDENTITY_CACHE_REDIS_TTL", "600"))  # seconds, shared
+IDENTITY_CACHE_MAX_ENTRIES = int(os.getenv("IDENTITY_CACHE_MAX_ENTRIES", "10000"))
+
+_REDIS_PREFIX = "owner:"
+
+
+class IdentityCache:
+    """
+    Bounded TTL/LRU cache of user_id -> owner string, with an optional Redis tier.
+
+    The local tier is checked first; on a miss the shared Redis tier (if
+    available) is consulted and a hit there is copied into the local tier. Writes go to both.
+    The local TTL is kept short so an invalidation in another worker only leaves
+    a stale entry here for at most IDENTITY_CACHE_TTL seconds.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, redis_ttl: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.redis_ttl = redis_ttl
+        self._entries: "OrderedDict[str, tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    async def get(self, user_id: str) -> Optional[str]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                identifier, expires_at = entry
+                if expires_at > now:
+                    self._entries.move_to_end(user_id)
+                    self.hits += 1
+                    return identifier
+                del self._entries[user_id]
+
+        if redis_pool.available():
+            try:
+                identifier = await redis_pool.redis.get(_REDIS_PREFIX + user_id)
+            except Exception as e:
+                redis_pool.mark_error("identity cache lookup", e)
+                identifier = None
+            if identifier is not None:
+                self._set_local(user_id, identifier)
+                with self._lock:
+                    self.redis_hits += 1
+                return identifier
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    async def set(self, user_id: str, identifier: str):
+        self._set_local(user_id, identifier)
+        if redis_pool.available():
+            try:
+                await redis_pool.redis.set(_REDIS_PREFIX + user_id, identifier, ex=self.redis_ttl)
+            except Exception as e:
+                redis_pool.mark_error("identity cache write", e)
+
+    async def invalidate(self, *user_ids: str):
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+            self.invalidations += len(user_ids)
+        if redis_pool.available() and user_ids:
+            try:
+                await redis_pool.redis.delete(*[_REDIS_PREFIX + u for u in user_ids])
+            except Exception as e:
+                redis_pool.mark_error("identity cache invalidation", e)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.redis_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "redis_hits": self.redis_hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "hit_rate": (self.hits + self.redis_hits) / lookups if lookups else 0.0,
+                "redis_enabled": redis_pool.redis is not None,
+            }
+
+    def _set_local(self, user_id: str, identifier: str):
+        with self._lock:
+            self._entries[user_id] = (identifier, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+identity_cache = IdentityCache(
+    max_entries=IDENTITY_CACHE_MAX_ENTRIES,
+    ttl=IDENTITY_CACHE_TTL,
+    redis_ttl=IDENTITY_CACHE_REDIS_TTL,
+)
+
+
+def user_cache_keys(user) -> list:
+    """Every cache key that can resolve to this User row."""
+    keys = [str(user.id)]
+    if user.phone:
+        keys.append(f"phone:{user.phone}")
+    return keys
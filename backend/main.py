@@ -1,11 +1,13 @@
 # main.py
 import os
+import asyncio
 import base64
 import httpx
 from datetime import datetime, timezone
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, Request, HTTPException, Depends
-from otp import verify_token, get_user_identifier
+from fastapi import FastAPI, Request, HTTPException, Depends, Header
+from typing import Optional
+from otp import verify_token, get_owner, Owner
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 from todo import router as todo_router
@@ -17,61 +19,46 @@ from account import router as account_router
 from manual_unblock import router as manual_unblock_router
 from apple_auth import router as apple_auth_router
 from voice_clone import router as voice_clone_router
-from db import init_db, get_db
-from models import Base, User, Profile, CallSession, CallUsage
+from db import init_db, AsyncSessionLocal, pool_stats, pin_to_primary
+from sqlalchemy import select
+from models import Profile, CallSession
+from identity_cache import identity_cache
+import usage_counters
+import upstreams
+import chat
+import todo
+import activity
+import state_version
+from usage_counters import add_usage
+from twilio_verify import twilio_verify
+from apple_keys import apple_keystore
+import rate_limit
+import redis_pool
+from rate_limit import evaluate_transcript_limiter, create_session_limiter
 
 
 
 load_dotenv()
 
-def migrate_existing_phone_users():
-    """Create User records for phones that exist in profiles but not in users table."""
-    from sqlalchemy.orm import Session
-    db_gen = get_db()
-    db: Session = next(db_gen)
-    try:
-        profiles = db.query(Profile.phone).distinct().all()
-        created = 0
-        for (phone,) in profiles:
-            if not phone:
-                continue
-            existing = db.query(User).filter(User.phone == phone).first()
-            if not existing:
-                user = User(phone=phone)
-                db.add(user)
-                created += 1
-        if created:
-            db.commit()
-            print(f"🔄 Migrated {created} existing phone users to users table")
-        else:
-            print("✅ No phone users to migrate")
-    except Exception as e:
-        print(f"⚠️ Migration error (non-fatal): {e}")
-        db.rollback()
-    finally:
-        db.close()
-
-def migrate_add_eleven_voice_id():
-    """Add eleven_voice_id column to profiles if it doesn't exist."""
-    from sqlalchemy import text
-    db_gen = get_db()
-    db = next(db_gen)
-    try:
-        db.execute(text("ALTER TABLE profiles ADD COLUMN eleven_voice_id VARCHAR"))
-        db.commit()
-        print("✅ Added eleven_voice_id column to profiles")
-    except Exception:
-        db.rollback()  # Column already exists — non-fatal
-    finally:
-        db.close()
-
-
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    init_db(Base)
-    migrate_existing_phone_users()
-    migrate_add_eleven_voice_id()
+    await asyncio.to_thread(init_db)
+    await redis_pool.ping()
+    await asyncio.to_thread(apple_keystore.refresh)
+    apple_keys_task = asyncio.create_task(apple_keystore.refresh_forever())
+    usage_flush_task = asyncio.create_task(usage_counters.flush_forever())
+    activity_flush_task = asyncio.create_task(activity.flush_forever())
+    tombstone_purge_task = asyncio.create_task(todo.purge_tombstones_forever())
     yield
+    apple_keys_task.cancel()
+    usage_flush_task.cancel()
+    activity_flush_task.cancel()
+    tombstone_purge_task.cancel()
+    await usage_counters.flush_usage()
+    await activity.flush_activity()
+    await upstreams.aclose_all()
+    await twilio_verify.aclose()
+    await redis_pool.close()
 
 app = FastAPI(lifespan=lifespan)
 app.include_router(todo_router)
@@ -97,6 +84,7 @@ HUME_API_KEY = os.getenv("HUME_API_KEY")
 HUME_SECRET_KEY = os.getenv("HUME_SECRET_KEY")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 HUME_BASE_URL = "https://api.hume.ai"
+INTERNAL_STATS_TOKEN = os.getenv("INTERNAL_STATS_TOKEN")
 
 async def analyze_transcript_with_gemini(transcript: str) -> bool:
     """
@@ -121,31 +109,30 @@ async def analyze_transcript_with_gemini(transcript: str) -> bool:
     url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash-lite:generateContent?key={GEMINI_API_KEY}"
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                url,
-                json={
-                    "contents": [{
-                        "parts": [{"text": prompt}]
-                    }]
-                },
-                timeout=30.0
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                text = result['candidates'][0]['content']['parts'][0]['text'].strip().upper()
-                print(f"🤖 Gemini Evaluation: {text}")
-                return "YES" in text
-            else:
-                print(f"❌ Gemini Error: {response.text}")
-                return False
+        client = upstreams.client("gemini")
+        response = await client.post(
+            url,
+            json={
+                "contents": [{
+                    "parts": [{"text": prompt}]
+                }]
+            },
+        )
+        
+        if response.status_code == 200:
+            result = response.json()
+            text = result['candidates'][0]['content']['parts'][0]['text'].strip().upper()
+            print(f"🤖 Gemini Evaluation: {text}")
+            return "YES" in text
+        else:
+            print(f"❌ Gemini Error: {response.text}")
+            return False
     except Exception as e:
         print(f"❌ Gemini Exception: {str(e)}")
         return False
 
 @app.post("/hume/evaluate-transcript")
-async def evaluate_transcript(payload: dict, user_id: str = Depends(verify_token)):
+async def evaluate_transcript(payload: dict, user_id: str = Depends(evaluate_transcript_limiter.dependency(verify_token))):
     transcript = payload.get("transcript", "")
     if not transcript:
         return {"unblock": False, "message": "No transcript provided"}
@@ -176,57 +163,55 @@ async def get_hume_access_token():
     encoded_credentials = base64.b64encode(credentials.encode()).decode()
     
     try:
-        async with httpx.AsyncClient() as client:
-            print(f"🔗 Sending request to Hume OAuth... (using API Key: {HUME_API_KEY[:5]}***)")
-            response = await client.post(
-                "https://api.hume.ai/oauth2-cc/token",
-                headers={
-                    "Authorization": f"Basic {encoded_credentials}",
-                    "Content-Type": "application/x-www-form-urlencoded"
-                },
-                data={"grant_type": "client_credentials"},
-                timeout=10.0
+        client = upstreams.client("hume")
+        print(f"🔗 Sending request to Hume OAuth... (using API Key: {HUME_API_KEY[:5]}***)")
+        response = await client.post(
+            "https://api.hume.ai/oauth2-cc/token",
+            headers={
+                "Authorization": f"Basic {encoded_credentials}",
+                "Content-Type": "application/x-www-form-urlencoded"
+            },
+            data={"grant_type": "client_credentials"},
+        )
+        
+        print(f"📡 Hume OAuth Response Status: {response.status_code}")
+        if response.status_code != 200:
+            print(f"❌ Hume OAuth Error Body: {response.text}")
+            raise HTTPException(
+                status_code=response.status_code,
+                detail=f"Hume token exchange failed: {response.text}"
+            )
+        
+        token_data = response.json()
+        access_token = token_data.get("access_token")
+        
+        if not access_token:
+            raise HTTPException(
+                status_code=500,
+                detail="No access_token in Hume response"
             )
-            
-            print(f"📡 Hume OAuth Response Status: {response.status_code}")
-            if response.status_code != 200:
-                print(f"❌ Hume OAuth Error Body: {response.text}")
-                raise HTTPException(
-                    status_code=response.status_code,
-                    detail=f"Hume token exchange failed: {response.text}"
-                )
-            
-            token_data = response.json()
-            access_token = token_data.get("access_token")
-            
-            if not access_token:
-                raise HTTPException(
-                    status_code=500,
-                    detail="No access_token in Hume response"
-                )
-            
-            return access_token
-            
+        
+        return access_token
+        
     except httpx.HTTPError as e:
         raise HTTPException(
             status_code=500,
             detail=f"Hume token exchange HTTP error: {str(e)}"
         )
 
-def _close_open_session(db, phone: str, now: datetime) -> float:
+async def _close_open_session(db, owner: Owner, now: datetime) -> float:
     """
-    Close any open CallSession for this phone, recording its duration into CallUsage.
+    Close any open CallSession for this user, recording its duration into CallUsage.
     Returns the number of seconds recorded (0 if nothing was open).
     """
     from zoneinfo import ZoneInfo
     from call_usage import DAILY_LIMIT_SECONDS, EASTERN
 
-    open_session = (
-        db.query(CallSession)
-        .filter(CallSession.phone == phone, CallSession.ended_at.is_(None))
+    open_session = (await db.execute(
+        select(CallSession)
+        .where(CallSession.user_id == owner.id, CallSession.ended_at.is_(None))
         .order_by(CallSession.started_at.desc())
-        .first()
-    )
+    )).scalars().first()
     if not open_session:
         return 0.0
 
@@ -237,35 +222,27 @@ def _close_open_session(db, phone: str, now: datetime) -> float:
     open_session.duration_seconds = duration
 
     today = now.astimezone(EASTERN).date()
-    usage = db.query(CallUsage).filter(
-        CallUsage.phone == phone, CallUsage.usage_date == today
-    ).first()
-    if not usage:
-        usage = CallUsage(phone=phone, usage_date=today, seconds_used=0.0)
-        db.add(usage)
-    usage.seconds_used += duration
-    usage.updated_at = now
-
-    db.commit()
-    print(f"⚠️  Auto-closed orphan session for {phone}: recorded {duration:.1f}s")
+    await add_usage(db, "call", owner, today, duration, now=now)
+
+    await db.commit()
+    await state_version.bump(owner.id)
+    print(f"⚠️  Auto-closed orphan session for {owner.identifier}: recorded {duration:.1f}s")
     return duration
 
 
 @app.post("/hume/create-session")
-async def create_hume_session(payload: dict, user_id: str = Depends(verify_token)):
+async def create_hume_session(payload: dict, user_id: str = Depends(create_session_limiter.dependency(verify_token))):
     print("📥 Received request for /hume/create-session")
 
-    from sqlalchemy.orm import Session as SA_Session
-    from call_usage import _check_limit_by_phone
+    from call_usage import _check_limit_for_owner
     from models import Profile
 
     now = datetime.now(timezone.utc)
-    db = next(get_db())
-    try:
-        phone = get_user_identifier(user_id, db)
+    async with AsyncSessionLocal() as db:
+        owner = await get_owner(user_id, db)
 
         # Require premium subscription to access Hume AI calls
-        profile = db.query(Profile).filter(Profile.phone == phone).first()
+        profile = (await db.execute(select(Profile).where(Profile.user_id == owner.id))).scalars().first()
         if not profile or not profile.is_premium:
             raise HTTPException(
                 status_code=403,
@@ -273,9 +250,10 @@ async def create_hume_session(payload: dict, user_id: str = Depends(verify_token
             )
 
         # Auto-close any orphaned session from a crash / missed end-session call
-        _close_open_session(db, phone, now)
+        if await _close_open_session(db, owner, now):
+            await pin_to_primary(user_id)
 
-        limit_info = _check_limit_by_phone(db, phone)
+        limit_info = await _check_limit_for_owner(db, owner)
         if not limit_info.can_call:
             raise HTTPException(
                 status_code=429,
@@ -284,12 +262,11 @@ async def create_hume_session(payload: dict, user_id: str = Depends(verify_token
         print(f"✅ Call limit check passed: {limit_info.remaining_seconds:.1f}s remaining")
 
         # Record session start server-side so duration is measured here, not by the client
-        session_row = CallSession(phone=phone, started_at=now)
+        session_row = CallSession(user_id=owner.id, phone=owner.identifier, started_at=now)
         db.add(session_row)
-        db.commit()
-        print(f"🕐 Call session started for {phone} at {now.isoformat()}")
-    finally:
-        db.close()
+        await db.commit()
+        await pin_to_primary(user_id)
+        print(f"🕐 Call session started for {owner.identifier} at {now.isoformat()}")
     
     try:
         print("🔑 Fetching Hume access token...")
@@ -338,16 +315,14 @@ async def end_hume_session(user_id: str = Depends(verify_token)):
     from call_usage import DAILY_LIMIT_SECONDS, EASTERN
 
     now = datetime.now(timezone.utc)
-    db = next(get_db())
-    try:
-        phone = get_user_identifier(user_id, db)
+    async with AsyncSessionLocal() as db:
+        owner = await get_owner(user_id, db)
 
-        open_session = (
-            db.query(CallSession)
-            .filter(CallSession.phone == phone, CallSession.ended_at.is_(None))
+        open_session = (await db.execute(
+            select(CallSession)
+            .where(CallSession.user_id == owner.id, CallSession.ended_at.is_(None))
             .order_by(CallSession.started_at.desc())
-            .first()
-        )
+        )).scalars().first()
         if not open_session:
             raise HTTPException(status_code=404, detail="No active call session found")
 
@@ -358,35 +333,25 @@ async def end_hume_session(user_id: str = Depends(verify_token)):
         open_session.duration_seconds = duration
 
         today = now.astimezone(EASTERN).date()
-        usage = db.query(CallUsage).filter(
-            CallUsage.phone == phone, CallUsage.usage_date == today
-        ).first()
-        if not usage:
-            usage = CallUsage(phone=phone, usage_date=today, seconds_used=0.0)
-            db.add(usage)
-        old_used = usage.seconds_used
-        usage.seconds_used += duration
-        usage.updated_at = now
-
-        db.commit()
-        db.refresh(usage)
-
-        remaining = max(0.0, DAILY_LIMIT_SECONDS - usage.seconds_used)
+        used = await add_usage(db, "call", owner, today, duration, now=now)
+
+        await db.commit()
+        await pin_to_primary(user_id)
+        await state_version.bump(owner.id)
+
+        remaining = max(0.0, DAILY_LIMIT_SECONDS - used)
         print(
-            f"✅ Call ended for {phone}: {duration:.1f}s recorded. "
-            f"Total today: {old_used:.1f}s → {usage.seconds_used:.1f}s. Remaining: {remaining:.1f}s"
+            f"✅ Call ended for {owner.identifier}: {duration:.1f}s recorded. "
+            f"Total today: {used - duration:.1f}s → {used:.1f}s. Remaining: {remaining:.1f}s"
         )
 
         return {
             "message": "Call duration recorded",
             "duration_seconds": duration,
-            "used_seconds": usage.seconds_used,
+            "used_seconds": used,
             "remaining_seconds": remaining,
             "limit_seconds": DAILY_LIMIT_SECONDS,
         }
-    finally:
-        db.close()
-
 
 
 @app.post("/hume-webhook")
@@ -401,6 +366,25 @@ async def hume_webhook(request: Request):
     return {"ok": True}
 
 
+@app.get("/internal/stats")
+def internal_stats(x_internal_token: Optional[str] = Header(default=None)):
+    """Operational counters. Disabled (404) unless INTERNAL_STATS_TOKEN is set."""
+    if not INTERNAL_STATS_TOKEN or x_internal_token != INTERNAL_STATS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return {
+        "identity_cache": identity_cache.stats(),
+        "rate_limits": rate_limit.stats(),
+        "twilio_breaker": twilio_verify.breaker.stats(),
+        "apple_keys": apple_keystore.stats(),
+        "db_pools": pool_stats(),
+        "usage_counters": usage_counters.stats(),
+        "conditional_gets": state_version.stats(),
+        "activity": activity.stats(),
+        "upstreams": upstreams.stats(),
+        "chat_streaming": chat.stats(),
+    }
+
+
 @app.get("/")
 def homepage():
     return {"bananas": "okk"}
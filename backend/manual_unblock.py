@@ -1,12 +1,13 @@
 # manual_unblock.py - Handles daily manual unblock limit tracking
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Request, Response
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
-from sqlalchemy import and_
-from db import get_db
-from models import ManualUnblockUsage
-from otp import verify_token, get_user_identifier
-from datetime import datetime, date, timezone
+from sqlalchemy.ext.asyncio import AsyncSession
+from db import get_async_db
+from read_routing import get_read_db
+from usage_counters import add_usage, read_usage
+from otp import verify_token, get_owner
+import state_version
+from datetime import date
 
 router = APIRouter(prefix="/manual-unblock", tags=["manual-unblock"])
 
@@ -21,21 +22,21 @@ class ManualUnblockLimitResponse(BaseModel):
 
 
 @router.get("/check-limit")
-def check_manual_unblock_limit(
-    db: Session = Depends(get_db),
+async def check_manual_unblock_limit(
+    request: Request,
+    response: Response,
+    db: AsyncSession = Depends(get_read_db),
     user_id: str = Depends(verify_token)
 ):
-    phone = get_user_identifier(user_id, db)
+    owner = await get_owner(user_id, db)
     today = date.today()
+    cached = await state_version.not_modified(request, response, owner.id, today)
+    if cached:
+        return cached
     
-    usage = db.query(ManualUnblockUsage).filter(
-        and_(
-            ManualUnblockUsage.phone == phone,
-            ManualUnblockUsage.usage_date == today
-        )
-    ).first()
+    used = await read_usage(db, "manual_unblock", owner, today)
     
-    if not usage:
+    if not used:
         return ManualUnblockLimitResponse(
             can_unblock=True,
             remaining_count=DAILY_LIMIT_COUNT,
@@ -43,59 +44,38 @@ def check_manual_unblock_limit(
             limit_count=DAILY_LIMIT_COUNT
         )
     
-    remaining = max(0, DAILY_LIMIT_COUNT - usage.unblock_count)
+    remaining = max(0, DAILY_LIMIT_COUNT - used)
     can_unblock = remaining > 0
     
     return ManualUnblockLimitResponse(
         can_unblock=can_unblock,
         remaining_count=remaining,
-        used_count=usage.unblock_count,
+        used_count=used,
         limit_count=DAILY_LIMIT_COUNT
     )
 
 
 @router.post("/record")
-def record_manual_unblock(
-    db: Session = Depends(get_db),
+async def record_manual_unblock(
+    db: AsyncSession = Depends(get_async_db),
     user_id: str = Depends(verify_token)
 ):
-    phone = get_user_identifier(user_id, db)
-    print(f"🔓 Recording manual unblock for user {user_id} (phone={phone})")
+    owner = await get_owner(user_id, db)
+    print(f"🔓 Recording manual unblock for user {user_id} (phone={owner.identifier})")
     
     today = date.today()
     
-    usage = db.query(ManualUnblockUsage).filter(
-        and_(
-            ManualUnblockUsage.phone == phone,
-            ManualUnblockUsage.usage_date == today
-        )
-    ).first()
-    
-    if not usage:
-        usage = ManualUnblockUsage(
-            phone=phone,
-            usage_date=today,
-            unblock_count=0
-        )
-        db.add(usage)
-        print(f"📊 Created new manual unblock usage record for {phone} on {today}")
-    else:
-        print(f"📊 Found existing usage record: {usage.unblock_count} unblocks already used today")
-    
-    old_count = usage.unblock_count
-    usage.unblock_count += 1
-    usage.updated_at = datetime.now(timezone.utc)
-    
-    db.commit()
-    db.refresh(usage)
+    used = await add_usage(db, "manual_unblock", owner, today)
+    await db.commit()
+    await state_version.bump(owner.id)
     
-    remaining = max(0, DAILY_LIMIT_COUNT - usage.unblock_count)
+    remaining = max(0, DAILY_LIMIT_COUNT - used)
     
-    print(f"✅ Manual unblock recorded. Total used: {old_count} → {usage.unblock_count}. Remaining: {remaining}")
+    print(f"✅ Manual unblock recorded. Total used: {used - 1} → {used}. Remaining: {remaining}")
     
     return {
         "message": "Manual unblock recorded",
-        "used_count": usage.unblock_count,
+        "used_count": used,
         "remaining_count": remaining,
         "limit_count": DAILY_LIMIT_COUNT
     }
@@ -0,0 +1,290 @@
+# migrations.py - Versioned schema migrations, applied once at startup
+"""
+Each migration is a (version, name, function) entry in MIGRATIONS and runs
+on a sync Connection inside the runner's transaction. Applied versions are
+recorded in schema_migrations, so a boot with nothing pending costs a single
+SELECT. On Postgres a transaction-scoped advisory lock makes concurrent
+workers wait while one of them applies the pending migrations.
+
+Migration 1 creates the tables from the current models, so later
+migrations must be idempotent against a freshly created schema (check the
+column/index exists before adding it). Migrations that read or write
+existing tables use frozen table()/column() definitions or text(), never
+the ORM tables: those carry today's columns, which an older schema being
+upgraded does not have yet.
+
+Run manually: python migrations.py [--status]
+"""
+import sys
+from datetime import datetime, timezone
+
+from sqlalchemy import (
+    Column, DateTime, Integer, MetaData, String, Table, column, exists, inspect, insert, select, table, text,
+)
+
+from models import Base, TodoCompletion, TodoCompletionDaily
+
+# Arbitrary application-wide key for pg_advisory_xact_lock
+MIGRATION_LOCK_ID = 7_314_205
+
+schema_migrations = Table(
+    "schema_migrations",
+    MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("name", String, nullable=False),
+    Column("applied_at", DateTime(timezone=True), nullable=False),
+)
+
+
+def _has_column(conn, table: str, column: str) -> bool:
+    return any(c["name"] == column for c in inspect(conn).get_columns(table))
+
+
+def _create_base_schema(conn):
+    Base.metadata.create_all(bind=conn)
+
+
+def _add_profiles_eleven_voice_id(conn):
+    if not _has_column(conn, "profiles", "eleven_voice_id"):
+        conn.execute(text("ALTER TABLE profiles ADD COLUMN eleven_voice_id VARCHAR"))
+
+
+def _backfill_users_from_profiles(conn):
+    """Create User rows for phones that exist in profiles but not in users."""
+    profiles, users = table("profiles", column("phone")), table("users", column("phone"))
+    missing = (
+        select(profiles.c.phone).distinct()
+        .where(profiles.c.phone.isnot(None), profiles.c.phone != "")
+        # apple_<id> is an Apple user's label, not a phone; that user already exists
+        .where(~profiles.c.phone.like("apple\\_%", escape="\\"))
+        .where(~exists().where(users.c.phone == profiles.c.phone))
+    )
+    created = conn.execute(insert(users).from_select(["phone"], missing)).rowcount
+    if created:
+        print(f"🔄 Migrated {created} existing phone users to users table")
+
+
+DAILY_USAGE_TABLES = [("call_usage", "seconds_used"), ("chat_usage", "message_count"),
+                      ("manual_unblock_usage", "unblock_count")]
+OWNED_TABLES = ["todos", "profiles", "call_sessions"] + [t for t, _ in DAILY_USAGE_TABLES]
+BACKFILL_BATCH_SIZE = 1000
+
+
+def _fold_duplicate_days(conn, t: str, column: str, owner: str):
+    """Sum rows sharing (owner, usage_date) into the oldest one and delete the rest."""
+    keepers = f"SELECT MIN(id) FROM {t} WHERE {owner} IS NOT NULL GROUP BY {owner}, usage_date"
+    conn.execute(text(
+        f"UPDATE {t} SET {column} = (SELECT SUM(d.{column}) FROM {t} d "
+        f"WHERE d.{owner} = {t}.{owner} AND d.usage_date = {t}.usage_date) "
+        f"WHERE id IN ({keepers} HAVING COUNT(*) > 1)"
+    ))
+    removed = conn.execute(text(
+        f"DELETE FROM {t} WHERE {owner} IS NOT NULL AND id NOT IN ({keepers})"
+    )).rowcount
+    if removed:
+        print(f"🔄 Folded {removed} duplicate {t} rows")
+
+
+def _unique_daily_usage(conn):
+    """Fold duplicate (phone, usage_date) rows into the oldest one, then enforce uniqueness."""
+    for t, column in DAILY_USAGE_TABLES:
+        _fold_duplicate_days(conn, t, column, "phone")
+        conn.execute(text(f"CREATE UNIQUE INDEX IF NOT EXISTS uq_{t}_phone_day ON {t} (phone, usage_date)"))
+
+
+def _backfill_user_id(conn, t: str):
+    """
+    Resolve each row's phone / apple_<id> label to users.id. Rows are read
+    BACKFILL_BATCH_SIZE at a time to bound memory and statement size; all
+    batches commit together with the migration.
+    """
+    users = table("users", column("id"), column("phone"))
+    last_id, filled, orphans = 0, 0, 0
+    while True:
+        rows = conn.execute(
+            text(f"SELECT id, phone FROM {t} WHERE user_id IS NULL AND id > :last_id ORDER BY id LIMIT :n"),
+            {"last_id": last_id, "n": BACKFILL_BATCH_SIZE},
+        ).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+
+        labels = {r.phone for r in rows if r.phone}
+        apple_ids = {int(p[6:]) for p in labels if p.startswith("apple_") and p[6:].isdigit()}
+        owners = dict(conn.execute(select(users.c.phone, users.c.id).where(users.c.phone.in_(labels))).all())
+        if apple_ids:
+            owners.update({f"apple_{uid}": uid for (uid,) in
+                           conn.execute(select(users.c.id).where(users.c.id.in_(apple_ids)))})
+
+        updates = [{"row_id": r.id, "owner": owners[r.phone]} for r in rows if r.phone in owners]
+        if updates:
+            conn.execute(text(f"UPDATE {t} SET user_id = :owner WHERE id = :row_id"), updates)
+        filled += len(updates)
+        orphans += len(rows) - len(updates)
+    if filled or orphans:
+        print(f"🔄 Backfilled user_id on {filled} {t} rows ({orphans} without a matching user)")
+
+
+def _rekey_owned_tables(conn):
+    """Add an integer user_id FK to every user-owned table and move the indexes onto it."""
+    for t in OWNED_TABLES:
+        if not _has_column(conn, t, "user_id"):
+            conn.execute(text(f"ALTER TABLE {t} ADD COLUMN user_id INTEGER REFERENCES users(id) ON DELETE CASCADE"))
+        _backfill_user_id(conn, t)
+
+    # A user may still own two profiles from before merges moved them. Keep the
+    # oldest, folding in premium and a cloned voice as account_merge does, and
+    # detach the others.
+    keepers = "SELECT MIN(id) FROM profiles WHERE user_id IS NOT NULL GROUP BY user_id"
+    conn.execute(text(
+        "UPDATE profiles SET "
+        "is_premium = EXISTS (SELECT 1 FROM profiles d WHERE d.user_id = profiles.user_id AND d.is_premium), "
+        "eleven_voice_id = COALESCE(eleven_voice_id, (SELECT d.eleven_voice_id FROM profiles d "
+        "WHERE d.user_id = profiles.user_id AND d.eleven_voice_id IS NOT NULL ORDER BY d.id DESC LIMIT 1)) "
+        f"WHERE id IN ({keepers} HAVING COUNT(*) > 1)"
+    ))
+    conn.execute(text(
+        "UPDATE profiles SET user_id = NULL WHERE user_id IS NOT NULL AND id NOT IN "
+        f"({keepers})"
+    ))
+    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS uq_profiles_user_id ON profiles (user_id)"))
+
+    for t, column in DAILY_USAGE_TABLES:
+        _fold_duplicate_days(conn, t, column, "user_id")
+        conn.execute(text(f"DROP INDEX IF EXISTS uq_{t}_phone_day"))
+        conn.execute(text(f"DROP INDEX IF EXISTS ix_{t}_phone"))
+        conn.execute(text(f"CREATE UNIQUE INDEX IF NOT EXISTS uq_{t}_user_day ON {t} (user_id, usage_date)"))
+
+    conn.execute(text("DROP INDEX IF EXISTS ix_todos_phone"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_todos_user_created ON todos (user_id, created_at)"))
+    conn.execute(text("DROP INDEX IF EXISTS ix_call_sessions_phone"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_call_sessions_user_started ON call_sessions (user_id, started_at)"))
+
+
+def _todo_delta_sync(conn):
+    """Tombstones and a per-user change sequence on todos (seeded from the row id)."""
+    if not _has_column(conn, "users", "todo_seq"):
+        conn.execute(text("ALTER TABLE users ADD COLUMN todo_seq INTEGER NOT NULL DEFAULT 0"))
+    if not _has_column(conn, "todos", "change_seq"):
+        conn.execute(text("ALTER TABLE todos ADD COLUMN change_seq INTEGER"))
+    if not _has_column(conn, "todos", "deleted_at"):
+        conn.execute(text("ALTER TABLE todos ADD COLUMN deleted_at TIMESTAMP WITH TIME ZONE"
+                          if conn.dialect.name == "postgresql" else
+                          "ALTER TABLE todos ADD COLUMN deleted_at DATETIME"))
+    # ids are already increasing, so they make a valid starting sequence
+    conn.execute(text("UPDATE todos SET change_seq = id WHERE change_seq IS NULL"))
+    conn.execute(text(
+        "UPDATE users SET todo_seq = (SELECT MAX(change_seq) FROM todos WHERE todos.user_id = users.id) "
+        "WHERE EXISTS (SELECT 1 FROM todos WHERE todos.user_id = users.id)"
+    ))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_todos_user_seq ON todos (user_id, change_seq)"))
+
+
+def _todo_keyset_index(conn):
+    """GET /todos pages by (created_at, id); widen the listing index to match."""
+    conn.execute(text("DROP INDEX IF EXISTS ix_todos_user_created"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_todos_user_created_id ON todos (user_id, created_at, id)"))
+
+
+def _todo_full_text_search(conn):
+    """Replace the B-tree on todos.task with a full-text index (GIN on Postgres, FTS5 on SQLite)."""
+    conn.execute(text("DROP INDEX IF EXISTS ix_todos_task"))
+    if conn.dialect.name == "postgresql":
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_todos_task_fts ON todos "
+            "USING GIN (to_tsvector('simple', coalesce(task, '')))"
+        ))
+        return
+    # External-content FTS5 table kept in step with todos by triggers
+    conn.execute(text(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS todos_fts USING fts5(task, content='todos', content_rowid='id')"
+    ))
+    conn.execute(text(
+        "CREATE TRIGGER IF NOT EXISTS todos_fts_insert AFTER INSERT ON todos BEGIN "
+        "INSERT INTO todos_fts(rowid, task) VALUES (new.id, new.task); END"
+    ))
+    conn.execute(text(
+        "CREATE TRIGGER IF NOT EXISTS todos_fts_delete AFTER DELETE ON todos BEGIN "
+        "INSERT INTO todos_fts(todos_fts, rowid, task) VALUES ('delete', old.id, old.task); END"
+    ))
+    conn.execute(text(
+        "CREATE TRIGGER IF NOT EXISTS todos_fts_update AFTER UPDATE OF task ON todos BEGIN "
+        "INSERT INTO todos_fts(todos_fts, rowid, task) VALUES ('delete', old.id, old.task); "
+        "INSERT INTO todos_fts(rowid, task) VALUES (new.id, new.task); END"
+    ))
+    conn.execute(text("INSERT INTO todos_fts(todos_fts) VALUES ('rebuild')"))
+
+
+def _todo_completion_stats(conn):
+    """Completion events plus their per-user daily rollup."""
+    Base.metadata.create_all(bind=conn, tables=[TodoCompletion.__table__, TodoCompletionDaily.__table__])
+
+
+def _todo_tombstone_purge(conn):
+    """Per-user high-water mark of purged tombstones, and an index to find old ones."""
+    if not _has_column(conn, "users", "todo_purged_seq"):
+        conn.execute(text("ALTER TABLE users ADD COLUMN todo_purged_seq INTEGER NOT NULL DEFAULT 0"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_todos_deleted_at ON todos (deleted_at)"))
+
+
+MIGRATIONS = [
+    (1, "create_base_schema", _create_base_schema),
+    (2, "add_profiles_eleven_voice_id", _add_profiles_eleven_voice_id),
+    (3, "backfill_users_from_profiles", _backfill_users_from_profiles),
+    (4, "unique_daily_usage", _unique_daily_usage),
+    (5, "rekey_owned_tables_on_user_id", _rekey_owned_tables),
+    (6, "todo_delta_sync", _todo_delta_sync),
+    (7, "todo_keyset_index", _todo_keyset_index),
+    (8, "todo_full_text_search", _todo_full_text_search),
+    (9, "todo_completion_stats", _todo_completion_stats),
+    (10, "todo_tombstone_purge", _todo_tombstone_purge),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(engine) -> int:
+    """Highest applied version, or 0 when schema_migrations does not exist yet."""
+    try:
+        with engine.connect() as conn:
+            return conn.execute(select(schema_migrations.c.version).order_by(
+                schema_migrations.c.version.desc()).limit(1)).scalar() or 0
+    except Exception:
+        return 0
+
+
+def run_migrations(engine) -> list:
+    """Apply pending migrations in one transaction. Returns the versions applied."""
+    if current_version(engine) >= LATEST_VERSION:
+        print(f"✅ Schema up to date (version {LATEST_VERSION})")
+        return []
+
+    with engine.begin() as conn:
+        if conn.dialect.name == "postgresql":
+            conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": MIGRATION_LOCK_ID})
+        schema_migrations.create(bind=conn, checkfirst=True)
+        # Re-read under the lock: another worker may have just finished
+        done = set(conn.execute(select(schema_migrations.c.version)).scalars())
+        applied = []
+        for version, name, migrate in MIGRATIONS:
+            if version in done:
+                continue
+            migrate(conn)
+            conn.execute(insert(schema_migrations).values(
+                version=version, name=name, applied_at=datetime.now(timezone.utc)))
+            applied.append(version)
+            print(f"🔄 Applied migration {version}: {name}")
+
+    if not applied:
+        print(f"✅ Schema up to date (version {LATEST_VERSION})")
+    return applied
+
+
+if __name__ == "__main__":
+    from db import engine
+
+    if "--status" in sys.argv:
+        version = current_version(engine)
+        pending = [f"{v}: {n}" for v, n, _ in MIGRATIONS if v > version]
+        print(f"Schema version {version}, pending: {pending or 'none'}")
+    else:
+        run_migrations(engine)
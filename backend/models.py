@@ -1,6 +1,6 @@
 # models.py
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, func, Date, Float
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, func, Date, Float, Index, ForeignKey
 
 Base = declarative_base()
 
@@ -13,6 +13,8 @@ class User(Base):
     apple_id = Column(String, unique=True, index=True, nullable=True)
     email = Column(String, nullable=True)
     full_name = Column(String, nullable=True)
+    todo_seq = Column(Integer, default=0, server_default="0", nullable=False)  # last todo change_seq issued
+    todo_purged_seq = Column(Integer, default=0, server_default="0", nullable=False)  # newest purged tombstone's change_seq
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
 
@@ -21,19 +23,30 @@ class Todo(Base):
     __tablename__ = "todos"
 
     id = Column(Integer, primary_key=True, index=True)
-    task = Column(String, index=True)
-    phone = Column(String, index=True)  # 🔑 link each todo to a phone
+    task = Column(String)  # searched through the full-text index from migration 8, not a B-tree
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=True)  # owner
+    phone = Column(String)  # owner's phone or apple_<id> (label returned to the app)
     apple_id = Column(String, index=True, nullable=True)  # Apple ID for user identification
     # Sync fields
     synced_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+    change_seq = Column(Integer, nullable=True)  # per-user, from User.todo_seq; delta sync cursor
+    deleted_at = Column(DateTime(timezone=True), nullable=True)  # tombstone for delta sync
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
+    __table_args__ = (
+        Index("ix_todos_user_created_id", "user_id", "created_at", "id"),
+        Index("ix_todos_user_seq", "user_id", "change_seq"),
+    )
+    # Load server defaults (id, synced_at, created_at) in the INSERT/UPDATE itself, no refresh
+    __mapper_args__ = {"eager_defaults": True}
+
 
 # New profiles table for premium status
 class Profile(Base):
     __tablename__ = "profiles"
 
     id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=True)  # owner
     phone = Column(String, unique=True, index=True, nullable=False)
     is_premium = Column(Boolean, default=False, nullable=False)
     eleven_voice_id = Column(String, nullable=True)
@@ -41,20 +54,26 @@ class Profile(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
 
+    __table_args__ = (
+        Index("uq_profiles_user_id", "user_id", unique=True),
+    )
+
 
 # Call usage tracking for daily limits
 class CallUsage(Base):
     __tablename__ = "call_usage"
 
     id = Column(Integer, primary_key=True, index=True)
-    phone = Column(String, index=True, nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=True)  # owner
+    phone = Column(String, nullable=False)
     usage_date = Column(Date, nullable=False, index=True)  # Date only (no time)
     seconds_used = Column(Float, default=0.0, nullable=False)  # Total seconds used today
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
     
-    # Unique constraint: one record per phone per day
+    # Unique constraint: one record per user per day (ON CONFLICT target for usage_counters)
     __table_args__ = (
+        Index("uq_call_usage_user_day", "user_id", "usage_date", unique=True),
         {'sqlite_autoincrement': True},
     )
 
@@ -64,14 +83,16 @@ class ChatUsage(Base):
     __tablename__ = "chat_usage"
 
     id = Column(Integer, primary_key=True, index=True)
-    phone = Column(String, index=True, nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=True)  # owner
+    phone = Column(String, nullable=False)
     usage_date = Column(Date, nullable=False, index=True)  # Date only (no time)
     message_count = Column(Integer, default=0, nullable=False)  # Total messages sent today
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
     
-    # Unique constraint: one record per phone per day
+    # Unique constraint: one record per user per day (ON CONFLICT target for usage_counters)
     __table_args__ = (
+        Index("uq_chat_usage_user_day", "user_id", "usage_date", unique=True),
         {'sqlite_autoincrement': True},
     )
 
@@ -81,24 +102,69 @@ class CallSession(Base):
     __tablename__ = "call_sessions"
 
     id = Column(Integer, primary_key=True, index=True)
-    phone = Column(String, index=True, nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=True)  # owner
+    phone = Column(String, nullable=False)
     started_at = Column(DateTime(timezone=True), nullable=False)
     ended_at = Column(DateTime(timezone=True), nullable=True)
     duration_seconds = Column(Float, nullable=True)
 
+    __table_args__ = (
+        Index("ix_call_sessions_user_started", "user_id", "started_at"),
+    )
+
 
 # Manual unblock usage tracking for daily limits
 class ManualUnblockUsage(Base):
     __tablename__ = "manual_unblock_usage"
 
     id = Column(Integer, primary_key=True, index=True)
-    phone = Column(String, index=True, nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=True)  # owner
+    phone = Column(String, nullable=False)
     usage_date = Column(Date, nullable=False, index=True)  # Date only (no time)
     unblock_count = Column(Integer, default=0, nullable=False)  # Total manual unblocks today
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
     
-    # Unique constraint: one record per phone per day
+    # Unique constraint: one record per user per day (ON CONFLICT target for usage_counters)
+    __table_args__ = (
+        Index("uq_manual_unblock_usage_user_day", "user_id", "usage_date", unique=True),
+        {'sqlite_autoincrement': True},
+    )
+
+
+# Todo completion events (one per todo), recorded by POST /todos/{id}/complete
+class TodoCompletion(Base):
+    __tablename__ = "todo_completions"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=True)  # owner
+    phone = Column(String, nullable=False)
+    todo_id = Column(Integer, nullable=False)
+    task = Column(String, nullable=True)  # copied, the todo may be deleted later
+    completed_at = Column(DateTime(timezone=True), nullable=False)
+    usage_date = Column(Date, nullable=False)  # the user's calendar day of completion
+
+    # Completing the same todo twice records one event
+    __table_args__ = (
+        Index("uq_todo_completions_todo", "todo_id", unique=True),
+        Index("ix_todo_completions_user_completed", "user_id", "completed_at"),
+    )
+
+
+# Per-user daily completion rollup (folded from TodoCompletion as events arrive)
+class TodoCompletionDaily(Base):
+    __tablename__ = "todo_completion_daily"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=True)  # owner
+    phone = Column(String, nullable=False)
+    usage_date = Column(Date, nullable=False)
+    completed_count = Column(Integer, default=0, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    # One row per user per day (ON CONFLICT target for usage_counters.increment_daily_counter)
     __table_args__ = (
+        Index("uq_todo_completion_daily_user_day", "user_id", "usage_date", unique=True),
         {'sqlite_autoincrement': True},
     )
@@ -1,43 +1,28 @@
 from fastapi import APIRouter, HTTPException, Header, Depends
 from pydantic import BaseModel
-from typing import Optional
-import redis
+from typing import NamedTuple, Optional
 import os
 import jwt
 import time
-from twilio.rest import Client
 from dotenv import load_dotenv
-from sqlalchemy.orm import Session
-from db import get_db
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from db import get_async_db, AsyncSessionLocal
 from models import User
+from identity_cache import identity_cache
+from rate_limit import RateLimiter
+from twilio_verify import twilio_verify, TwilioUnavailable, unavailable_error
 
 load_dotenv(override=True)
 
-REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
-
 router = APIRouter(prefix="/otp", tags=["otp"])
 
-try:
-    r = redis.from_url(
-        REDIS_HOST,
-        decode_responses=True,
-        socket_connect_timeout=5,
-        socket_keepalive=True,
-        retry_on_timeout=True
-    )
-    r.ping()
-    print(f"✅ Connected to Redis/Valkey at {REDIS_HOST}")
-except Exception as e:
-    print(f"⚠️ Redis connection failed: {str(e)}")
-    r = None
-
 RATE_LIMIT = 3          # per hour per phone
+otp_send_limiter = RateLimiter("otp_send", limit=RATE_LIMIT, window_seconds=3600)
 _secret = os.getenv("SECRET_KEY")
 if not _secret:
     raise RuntimeError("SECRET_KEY environment variable must be set")
 SECRET_KEY: str = _secret
-t_client = Client(os.getenv("TWILIO_ACCOUNT_SID"), os.getenv("TWILIO_AUTH_TOKEN"))
-VERIFY_SID = os.getenv("TWILIO_VERIFY_SID")
 
 _test_phone = os.getenv("TEST_PHONE")
 _test_otp = os.getenv("TEST_OTP")
@@ -84,93 +69,110 @@ def verify_token(authorization: Optional[str] = Header(default=None)) -> str:
         raise HTTPException(status_code=401, detail="Invalid token")
 
 
-def get_user_identifier(user_id: str, db: Session) -> str:
-    """Resolve user_id (from verify_token) to the string identifier used in legacy tables.
-    For phone users returns their phone number; for Apple-only users returns 'apple_<id>'.
+class Owner(NamedTuple):
+    """The caller's users.id plus the phone / 'apple_<id>' label stored alongside it."""
+    id: int
+    identifier: str
+
+
+async def get_owner(user_id: str, db: AsyncSession) -> Owner:
+    """Resolve user_id (from verify_token) to the owner key of user-owned rows.
+    For phone users the label is their phone number; for Apple-only users 'apple_<id>'.
     Also handles legacy tokens that contain 'phone:<number>' by auto-creating a User row.
+    Results are cached in identity_cache; merges and deletions invalidate them.
     """
+    # Lets get_async_db pin this user to the primary after a write
+    db.info["user_id"] = user_id
+
+    cached = await identity_cache.get(user_id)
+    if cached is not None:
+        pk, identifier = cached.split(":", 1)
+        return Owner(int(pk), identifier)
+
     if user_id.startswith("phone:"):
         phone = user_id[6:]
-        user = db.query(User).filter(User.phone == phone).first()
+        user = (await db.execute(select(User).where(User.phone == phone))).scalars().first()
+        if not user and db.info.get("replica"):
+            return await _resolve_on_primary(user_id)
         if not user:
             user = User(phone=phone)
             db.add(user)
-            db.commit()
-            db.refresh(user)
-        return phone
+            await db.commit()
+            await db.refresh(user)
+            # A new row now owns this phone; drop anything cached for it
+            await identity_cache.invalidate(user_id, str(user.id))
+    else:
+        user = await db.get(User, int(user_id))
+        if not user and db.info.get("replica"):
+            # Brand-new users may not have replicated yet
+            return await _resolve_on_primary(user_id)
+        if not user:
+            raise HTTPException(status_code=401, detail="User not found")
 
-    uid = int(user_id)
-    user = db.query(User).filter(User.id == uid).first()
-    if not user:
-        raise HTTPException(status_code=401, detail="User not found")
-    return user.phone if user.phone else f"apple_{user.id}"
+    owner = Owner(user.id, user.phone if user.phone else f"apple_{user.id}")
+    await identity_cache.set(user_id, f"{owner.id}:{owner.identifier}")
+    return owner
+
+
+async def _resolve_on_primary(user_id: str) -> Owner:
+    async with AsyncSessionLocal() as primary:
+        return await get_owner(user_id, primary)
 
 
-def get_user(user_id: str, db: Session) -> User:
+async def get_user(user_id: str, db: AsyncSession) -> User:
     """Resolve user_id to User ORM object."""
     if user_id.startswith("phone:"):
-        phone = user_id[6:]
-        user = db.query(User).filter(User.phone == phone).first()
-        if not user:
-            user = User(phone=phone)
-            db.add(user)
-            db.commit()
-            db.refresh(user)
-        return user
+        return await _find_or_create_user_by_phone(user_id[6:], db)
 
     uid = int(user_id)
-    user = db.query(User).filter(User.id == uid).first()
+    user = await db.get(User, uid)
     if not user:
         raise HTTPException(status_code=401, detail="User not found")
     return user
 
 
-def _find_or_create_user_by_phone(phone: str, db: Session) -> User:
+async def _find_or_create_user_by_phone(phone: str, db: AsyncSession) -> User:
     """Find existing user by phone or create a new one."""
-    user = db.query(User).filter(User.phone == phone).first()
+    user = (await db.execute(select(User).where(User.phone == phone))).scalars().first()
     if not user:
         user = User(phone=phone)
         db.add(user)
-        db.commit()
-        db.refresh(user)
+        await db.commit()
+        await db.refresh(user)
     return user
 
 
 @router.post("/send")
-def send_otp(data: PhoneRequest):
+async def send_otp(data: PhoneRequest):
     phone = data.phone
 
     if TEST_PHONE and phone == TEST_PHONE:
         return {"status": "pending"}
 
-    if r:
-        try:
-            attempts_key = f"attempts:{phone}"
-            attempts = r.get(attempts_key)
-            if attempts and int(attempts) >= RATE_LIMIT:
-                raise HTTPException(status_code=429, detail="Too many OTP requests, try later")
-            else:
-                r.incr(attempts_key, 1)
-                r.expire(attempts_key, 3600)
-        except Exception as e:
-            print(f"⚠️ Redis error during rate limit check: {str(e)}")
+    await otp_send_limiter.enforce(phone, detail="Too many OTP requests, try later")
 
-    v = t_client.verify.v2.services(VERIFY_SID).verifications.create(to=phone, channel="sms")
-    return {"status": v.status}
+    try:
+        v = await twilio_verify.send_verification(phone, channel="sms")
+    except TwilioUnavailable as e:
+        raise unavailable_error(e)
+    return {"status": v.get("status")}
 
 
 @router.post("/verify")
-def verify_otp(data: VerifyRequest, db: Session = Depends(get_db)):
+async def verify_otp(data: VerifyRequest, db: AsyncSession = Depends(get_async_db)):
     if TEST_PHONE and data.phone == TEST_PHONE:
         if TEST_OTP and data.otp == TEST_OTP:
-            user = _find_or_create_user_by_phone(data.phone, db)
+            user = await _find_or_create_user_by_phone(data.phone, db)
             token = create_jwt(user.id)
             return {"token": token, "user_id": str(user.id)}
         raise HTTPException(status_code=401, detail="Invalid or expired code")
 
-    check = t_client.verify.v2.services(VERIFY_SID).verification_checks.create(to=data.phone, code=data.otp)
-    if check.status == "approved":
-        user = _find_or_create_user_by_phone(data.phone, db)
+    try:
+        check = await twilio_verify.check_verification(data.phone, data.otp)
+    except TwilioUnavailable as e:
+        raise unavailable_error(e)
+    if check.get("status") == "approved":
+        user = await _find_or_create_user_by_phone(data.phone, db)
         token = create_jwt(user.id)
         return {"token": token, "user_id": str(user.id)}
     raise HTTPException(status_code=401, detail="Invalid or expired code")
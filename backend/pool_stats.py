@@ -0,0 +1,140 @@
+# pool_stats.py - Live connection-pool statistics from SQLAlchemy pool events
+import bisect
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+
+# Checkout wait-time histogram bucket upper bounds, in milliseconds
+WAIT_BUCKETS_MS = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+
+class PoolStats:
+    """Counters for one engine's pool: checkouts, waiters, wait-time histogram."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.pool = None
+        self.waiting = 0
+        self.max_waiting = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.connects = 0
+        self.invalidations = 0
+        self.checkout_failures = 0  # pool timeouts and connect errors
+        self.wait_total_ms = 0.0
+        self.wait_max_ms = 0.0
+        self.wait_buckets = [0] * (len(WAIT_BUCKETS_MS) + 1)
+        self._lock = threading.Lock()
+
+    def attach(self, engine):
+        """Subscribe to the engine's pool events."""
+        self.pool = engine.pool
+        self.pool._pool_stats = self
+        event.listen(engine.pool, "connect", self._on_connect)
+        event.listen(engine.pool, "checkout", self._on_checkout)
+        event.listen(engine.pool, "checkin", self._on_checkin)
+        event.listen(engine.pool, "invalidate", self._on_invalidate)
+
+    def begin_wait(self, blocking: bool) -> float:
+        if blocking:
+            with self._lock:
+                self.waiting += 1
+                self.max_waiting = max(self.max_waiting, self.waiting)
+        return time.perf_counter()
+
+    def end_wait(self, started: float, blocking: bool, failed: bool):
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            if blocking:
+                self.waiting -= 1
+            if failed:
+                self.checkout_failures += 1
+            self.wait_total_ms += elapsed_ms
+            self.wait_max_ms = max(self.wait_max_ms, elapsed_ms)
+            self.wait_buckets[bisect.bisect_left(WAIT_BUCKETS_MS, elapsed_ms)] += 1
+
+    def snapshot(self) -> dict:
+        pool = self.pool
+        with self._lock:
+            waits = sum(self.wait_buckets)
+            histogram = {f"le_{b}ms": n for b, n in zip(WAIT_BUCKETS_MS, self.wait_buckets)}
+            histogram["inf"] = self.wait_buckets[-1]
+            return {
+                "size": pool.size() if hasattr(pool, "size") else None,
+                "checked_out": pool.checkedout() if hasattr(pool, "checkedout") else None,
+                # QueuePool.overflow() counts from -pool_size; report connections beyond pool_size
+                "overflow": max(0, pool.overflow()) if hasattr(pool, "overflow") else None,
+                "idle": pool.checkedin() if hasattr(pool, "checkedin") else None,
+                "waiting": self.waiting,
+                "max_waiting": self.max_waiting,
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "connects": self.connects,
+                "invalidations": self.invalidations,
+                "checkout_failures": self.checkout_failures,
+                "wait_avg_ms": self.wait_total_ms / waits if waits else 0.0,
+                "wait_max_ms": self.wait_max_ms,
+                "wait_histogram": histogram,
+            }
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self._lock:
+            self.checkouts += 1
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.checkins += 1
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        with self._lock:
+            self.invalidations += 1
+
+
+class _TimedCheckoutMixin:
+    """
+    Pool events fire only once a connection has been obtained, so the time a
+    caller spends queued for a connection is measured around the pool's own
+    checkout (_do_get). Only callers that find no idle connection and no
+    overflow room left count as waiting.
+    """
+
+    def _must_wait(self) -> bool:
+        return self.checkedin() == 0 and -1 < self._max_overflow <= self._overflow
+
+    def _do_get(self):
+        stats = getattr(self, "_pool_stats", None)
+        if stats is None:
+            return super()._do_get()
+        blocking = self._must_wait()
+        started = stats.begin_wait(blocking)
+        failed = False
+        try:
+            return super()._do_get()
+        except Exception:
+            failed = True
+            raise
+        finally:
+            stats.end_wait(started, blocking, failed)
+
+    def recreate(self):
+        # engine.dispose() swaps in a recreated pool; keep counting on it
+        pool = super().recreate()
+        stats = getattr(self, "_pool_stats", None)
+        if stats is not None:
+            pool._pool_stats = stats
+            stats.pool = pool
+        return pool
+
+
+class TimedQueuePool(_TimedCheckoutMixin, QueuePool):
+    pass
+
+
+class TimedAsyncAdaptedQueuePool(_TimedCheckoutMixin, AsyncAdaptedQueuePool):
+    pass
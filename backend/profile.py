@@ -1,16 +1,27 @@
 # profile.py - Handles user profiles and premium status
-from fastapi import APIRouter, HTTPException, Depends
-from pydantic import BaseModel
-from typing import Optional
-from sqlalchemy.orm import Session
-from db import get_db
+from fastapi import APIRouter, HTTPException, Depends, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field
+from typing import List, Optional
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from db import get_async_db, AsyncSessionLocal, pin_to_primary
+from read_routing import get_read_db
 from models import Profile
-from otp import verify_token, get_user_identifier
-from datetime import datetime, timezone
-from apple_store import verify_app_store_jws
+from otp import verify_token, get_owner
+import activity
+import state_version
+from apple_store import verify_app_store_jws_batch
 
 router = APIRouter(prefix="/profile", tags=["profile"])
 
+_INSERTS = {"postgresql": pg_insert, "sqlite": sqlite_insert}
+
+# Each token costs a signature verification; longer lists are rejected (422)
+MAX_TRANSACTIONS_PER_SYNC = 50
+
 
 class PremiumStatusResponse(BaseModel):
     phone: str
@@ -23,18 +34,35 @@ class SyncPremiumRequest(BaseModel):
     # Required when is_premium=True: the signed JWS from StoreKit 2
     # transaction.jsonRepresentation converted to a UTF-8 string.
     transaction_jws: Optional[str] = None
+    # Restore-purchases flows may send several transactions at once; premium
+    # is granted if any one of them verifies.
+    transaction_jws_list: Optional[List[str]] = Field(default=None, max_length=MAX_TRANSACTIONS_PER_SYNC)
 
 
 @router.get("/premium-status")
-def get_premium_status(db: Session = Depends(get_db), user_id: str = Depends(verify_token)):
-    phone = get_user_identifier(user_id, db)
-    profile = db.query(Profile).filter(Profile.phone == phone).first()
+async def get_premium_status(request: Request, response: Response,
+                             db: AsyncSession = Depends(get_read_db), user_id: str = Depends(verify_token)):
+    owner = await get_owner(user_id, db)
+    cached = await state_version.not_modified(request, response, owner.id)
+    if cached:
+        return cached
+    profile = (await db.execute(select(Profile).where(Profile.user_id == owner.id))).scalars().first()
     
     if not profile:
-        profile = Profile(phone=phone, is_premium=False)
-        db.add(profile)
-        db.commit()
-        db.refresh(profile)
+        # First visit: create the profile on the primary (db may be a replica).
+        # Hand the read connection back first so concurrent first visits cannot
+        # exhaust the pool while each holds one connection and waits for another.
+        await db.close()
+        async with AsyncSessionLocal() as primary:
+            # Concurrent first visits race to create it; the losers keep the winner's row
+            insert = _INSERTS[primary.get_bind().dialect.name]
+            await primary.execute(insert(Profile.__table__).values(
+                user_id=owner.id, phone=owner.identifier, is_premium=False).on_conflict_do_nothing())
+            await primary.commit()
+            await pin_to_primary(user_id)
+            profile = (await primary.execute(select(Profile).where(Profile.user_id == owner.id))).scalars().first()
+        if not profile:
+            raise HTTPException(status_code=409, detail="Another profile already uses this phone")
     
     return {
         "phone": profile.phone,
@@ -44,9 +72,9 @@ def get_premium_status(db: Session = Depends(get_db), user_id: str = Depends(ver
 
 
 @router.post("/sync-premium")
-def sync_premium_status(
+async def sync_premium_status(
     request: SyncPremiumRequest,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     user_id: str = Depends(verify_token)
 ):
     """
@@ -57,33 +85,42 @@ def sync_premium_status(
     - Revoking premium (is_premium=False): accepted without a JWS (no security risk).
     """
     if request.is_premium:
-        if not request.transaction_jws:
+        jws_tokens = list(request.transaction_jws_list or [])
+        if request.transaction_jws:
+            jws_tokens.insert(0, request.transaction_jws)
+        if not jws_tokens:
             raise HTTPException(
                 status_code=400,
                 detail="transaction_jws is required to grant premium status"
             )
-        try:
-            payload = verify_app_store_jws(request.transaction_jws)
-            print(f"✅ [sync-premium] JWS verified — productId={payload.get('productId')}, bundleId={payload.get('bundleId')}")
-        except ValueError as e:
-            print(f"❌ [sync-premium] JWS verification failed: {e}")
+        # x5c chain and signature checks are CPU-bound; keep them off the event loop
+        results = await run_in_threadpool(verify_app_store_jws_batch, jws_tokens)
+        verified = [r["payload"] for r in results if r["ok"]]
+        if not verified:
+            error = results[0]["error"]
+            print(f"❌ [sync-premium] JWS verification failed: {error}")
             raise HTTPException(
                 status_code=403,
-                detail=f"Apple receipt verification failed: {e}"
+                detail=f"Apple receipt verification failed: {error}"
             )
+        payload = verified[0]
+        print(f"✅ [sync-premium] JWS verified ({len(verified)}/{len(results)}) — productId={payload.get('productId')}, bundleId={payload.get('bundleId')}")
 
-    phone = get_user_identifier(user_id, db)
-    profile = db.query(Profile).filter(Profile.phone == phone).first()
+    owner = await get_owner(user_id, db)
+    profile = (await db.execute(select(Profile).where(Profile.user_id == owner.id))).scalars().first()
     
+    changed = profile is None or profile.is_premium != request.is_premium
     if not profile:
-        profile = Profile(phone=phone, is_premium=request.is_premium)
+        profile = Profile(user_id=owner.id, phone=owner.identifier, is_premium=request.is_premium)
         db.add(profile)
     else:
-        profile.is_premium = request.is_premium
-        profile.last_active = datetime.now(timezone.utc)
+        profile.is_premium = request.is_premium  # no UPDATE at all when unchanged
     
-    db.commit()
-    db.refresh(profile)
+    await db.commit()
+    if changed:
+        # Periodic re-syncs usually repeat the stored value; keep clients' ETags valid
+        await state_version.bump(owner.id)
+    activity.touch(owner)
     
     return {
         "message": "Premium status synced",
@@ -0,0 +1,153 @@
+# rate_limit.py - Sliding-window rate limiting backed by Redis (single Lua round trip)
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Callable, Dict
+
+from fastapi import Depends, HTTPException
+
+import redis_pool
+
+# Sliding-window log: drop entries older than the window, then admit the
+# request only if fewer than `limit` remain. Runs atomically inside Redis.
+# Returns {allowed, count, retry_after_ms}.
+_SLIDING_WINDOW_LUA = """
+local key = KEYS[1]
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+redis.call('ZREMRANGEBYSCORE', key, '-inf', now - window)
+local count = redis.call('ZCARD', key)
+if count < limit then
+    redis.call('ZADD', key, now, ARGV[4])
+    redis.call('PEXPIRE', key, window)
+    return {1, count + 1, 0}
+end
+local oldest = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+return {0, count, math.max(0, tonumber(oldest[2]) + window - now)}
+"""
+
+_script = redis_pool.redis.register_script(_SLIDING_WINDOW_LUA) if redis_pool.redis else None
+
+
+class RateLimiter:
+    """
+    Allows `limit` hits per `window_seconds` per key.
+
+    Uses Redis when available so the window is shared across workers; if Redis
+    is not configured or a call fails, the decision is made from an in-process
+    window instead (per worker, so effectively a looser limit).
+    """
+
+    def __init__(self, name: str, limit: int, window_seconds: float):
+        self.name = name
+        self.limit = limit
+        self.window_ms = int(window_seconds * 1000)
+        self._local: Dict[str, deque] = {}
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.denied = 0
+        self.fallback_decisions = 0
+        self.redis_errors = 0
+        self.redis_calls = 0
+        self.redis_latency_total_ms = 0.0
+        self.redis_latency_max_ms = 0.0
+        limiters[name] = self
+
+    async def hit(self, key: str) -> tuple:
+        """Record one hit for key. Returns (allowed, retry_after_seconds)."""
+        now_ms = int(time.time() * 1000)
+        allowed, retry_after_ms = None, 0
+
+        if _script is not None and redis_pool.available():
+            started = time.perf_counter()
+            try:
+                allowed, _, retry_after_ms = await _script(
+                    keys=[f"ratelimit:{self.name}:{key}"],
+                    args=[now_ms, self.window_ms, self.limit, f"{now_ms}-{uuid.uuid4().hex}"],
+                )
+                allowed = bool(allowed)
+            except Exception as e:
+                self.redis_errors += 1
+                allowed = None
+                redis_pool.mark_error(f"rate limit check ({self.name})", e)
+            finally:
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                self.redis_calls += 1
+                self.redis_latency_total_ms += elapsed_ms
+                self.redis_latency_max_ms = max(self.redis_latency_max_ms, elapsed_ms)
+
+        if allowed is None:
+            self.fallback_decisions += 1
+            allowed, retry_after_ms = self._hit_local(key, now_ms)
+
+        if allowed:
+            self.allowed += 1
+        else:
+            self.denied += 1
+        return allowed, int(retry_after_ms) / 1000
+
+    async def enforce(self, key: str, detail: str = "Too many requests, try later"):
+        allowed, retry_after = await self.hit(key)
+        if not allowed:
+            raise HTTPException(
+                status_code=429,
+                detail=detail,
+                headers={"Retry-After": str(max(1, int(retry_after + 0.999)))},
+            )
+
+    def dependency(self, key_dependency: Callable) -> Callable:
+        """
+        Build a FastAPI dependency that rate limits on the value returned by
+        key_dependency (e.g. verify_token) and passes that value through.
+        """
+        async def _enforce(key: str = Depends(key_dependency)) -> str:
+            await self.enforce(key)
+            return key
+        return _enforce
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "window_seconds": self.window_ms / 1000,
+            "allowed": self.allowed,
+            "denied": self.denied,
+            "fallback_decisions": self.fallback_decisions,
+            "redis_errors": self.redis_errors,
+            "redis_calls": self.redis_calls,
+            "redis_latency_avg_ms": self.redis_latency_total_ms / self.redis_calls if self.redis_calls else 0.0,
+            "redis_latency_max_ms": self.redis_latency_max_ms,
+        }
+
+    def _hit_local(self, key: str, now_ms: int) -> tuple:
+        with self._lock:
+            if len(self._local) > 10000:
+                self._prune_local(now_ms)
+            window = self._local.setdefault(key, deque())
+            while window and window[0] <= now_ms - self.window_ms:
+                window.popleft()
+            if len(window) < self.limit:
+                window.append(now_ms)
+                return True, 0
+            return False, window[0] + self.window_ms - now_ms
+
+    def _prune_local(self, now_ms: int):
+        for k in [k for k, w in self._local.items() if not w or w[-1] <= now_ms - self.window_ms]:
+            del self._local[k]
+
+
+limiters: Dict[str, RateLimiter] = {}
+
+
+def stats() -> dict:
+    return {
+        "backend": "redis" if _script is not None else "in-process",
+        "limiters": {name: limiter.stats() for name, limiter in limiters.items()},
+    }
+
+
+# Per-user limiters shared by the expensive routes
+chat_message_limiter = RateLimiter("chat_message", limit=20, window_seconds=60)
+evaluate_transcript_limiter = RateLimiter("evaluate_transcript", limit=10, window_seconds=60)
+create_session_limiter = RateLimiter("create_session", limit=5, window_seconds=60)
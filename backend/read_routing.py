@@ -0,0 +1,15 @@
+# read_routing.py - Session dependency for read-only routes (replica-aware)
+from fastapi import Depends
+from db import open_read_session
+from otp import verify_token
+
+
+async def get_read_db(user_id: str = Depends(verify_token)):
+    """
+    Dependency for read-only routes. Yields a replica session when replicas
+    are configured, or a primary session if this user wrote in the last
+    READ_YOUR_WRITES_SECONDS (or no replicas exist).
+    """
+    session = await open_read_session(user_id)
+    async with session:
+        yield session
@@ -0,0 +1,60 @@
+# redis_pool.py - Shared async Redis/Valkey connection pool
+import os
+import time
+
+from dotenv import load_dotenv
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # redis<4.2
+    aioredis = None
+
+load_dotenv(override=True)
+
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "20"))
+REDIS_RETRY_AFTER_ERROR_SECONDS = 30  # skip Redis this long after a failure
+
+try:
+    redis = aioredis.from_url(
+        REDIS_HOST,
+        decode_responses=True,
+        socket_connect_timeout=5,
+        socket_timeout=2,
+        socket_keepalive=True,
+        max_connections=REDIS_MAX_CONNECTIONS,
+    ) if aioredis else None
+except Exception as e:
+    print(f"⚠️ Redis connection failed: {str(e)}")
+    redis = None
+
+_down_until = 0.0
+
+
+def available() -> bool:
+    """True when Redis is configured and has not failed in the last few seconds."""
+    return redis is not None and time.monotonic() >= _down_until
+
+
+def mark_error(context: str, e: Exception):
+    """Record a Redis failure; callers fall back to in-process state for a while."""
+    global _down_until
+    _down_until = time.monotonic() + REDIS_RETRY_AFTER_ERROR_SECONDS
+    print(f"⚠️ Redis error during {context}: {str(e)}")
+
+
+async def ping():
+    """Log whether Redis is reachable (called once at startup)."""
+    if redis is None:
+        print("⚠️ Redis not configured, using in-process fallbacks")
+        return
+    try:
+        await redis.ping()
+        print(f"✅ Connected to Redis/Valkey at {REDIS_HOST}")
+    except Exception as e:
+        mark_error("startup ping", e)
+
+
+async def close():
+    if redis is not None:
+        await redis.aclose()
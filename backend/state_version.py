@@ -0,0 +1,99 @@
+# state_version.py - Per-user version stamps for ETag / If-None-Match on polled GETs
+import hashlib
+import os
+import time
+import uuid
+from typing import Optional
+
+from dotenv import load_dotenv
+from fastapi import Request, Response
+
+import redis_pool
+from db import READ_YOUR_WRITES_SECONDS, replica_engines
+
+load_dotenv(override=True)
+
+STATE_VERSION_TTL_SECONDS = int(os.getenv("STATE_VERSION_TTL_SECONDS", str(7 * 24 * 3600)))
+
+_REDIS_PREFIX = "state_ver:"
+
+# Users whose bump failed while Redis was unreachable; retried on the next
+# successful call (a stale stamp would otherwise keep answering 304)
+_pending_bumps = set()
+
+_stats = {"not_modified": 0, "tagged": 0, "untagged": 0, "bumps": 0, "bump_failures": 0}
+
+
+def _new_stamp() -> str:
+    # The timestamp lets readers skip tagging while replicas may still lag
+    return f"{time.time():.3f}-{uuid.uuid4().hex[:12]}"
+
+
+async def _retry_pending():
+    if _pending_bumps:
+        owner_ids = list(_pending_bumps)
+        _pending_bumps.clear()
+        await bump(*owner_ids)
+
+
+async def bump(*owner_ids: int):
+    """Invalidate every ETag issued for these users. Call after the write commits."""
+    if redis_pool.redis is None or not owner_ids:
+        return
+    if not redis_pool.available():
+        _pending_bumps.update(owner_ids)
+        return
+    try:
+        async with redis_pool.redis.pipeline(transaction=False) as pipe:
+            for owner_id in owner_ids:
+                pipe.set(_REDIS_PREFIX + str(owner_id), _new_stamp(), ex=STATE_VERSION_TTL_SECONDS)
+            await pipe.execute()
+        _stats["bumps"] += len(owner_ids)
+    except Exception as e:
+        _stats["bump_failures"] += 1
+        _pending_bumps.update(owner_ids)
+        redis_pool.mark_error("state version bump", e)
+
+
+async def current(owner_id: int) -> Optional[str]:
+    """The user's stamp, or None when responses should not be tagged."""
+    if not redis_pool.available():
+        return None
+    try:
+        await _retry_pending()
+        key = _REDIS_PREFIX + str(owner_id)
+        stamp = await redis_pool.redis.get(key)
+        if stamp is None:
+            await redis_pool.redis.set(key, _new_stamp(), ex=STATE_VERSION_TTL_SECONDS, nx=True)
+            stamp = await redis_pool.redis.get(key)
+    except Exception as e:
+        redis_pool.mark_error("state version read", e)
+        return None
+    if replica_engines and stamp and time.time() - float(stamp.split("-", 1)[0]) < READ_YOUR_WRITES_SECONDS:
+        return None  # a replica may not have this write yet
+    return stamp
+
+
+async def not_modified(request: Request, response: Response, owner_id: int, *extra) -> Optional[Response]:
+    """
+    Conditional GET helper. Returns a 304 response when If-None-Match holds
+    the current ETag for (owner, path, query, extra); otherwise sets the
+    ETag header on response and returns None so the route builds the body.
+    Pass anything else the body depends on (e.g. the current day) as extra.
+    """
+    stamp = await current(owner_id)
+    if stamp is None:
+        _stats["untagged"] += 1
+        return None
+    key = "|".join([stamp, request.url.path, request.url.query, *map(str, extra)])
+    etag = f'"{hashlib.sha1(key.encode()).hexdigest()}"'
+    if etag in [t.strip() for t in request.headers.get("if-none-match", "").split(",")]:
+        _stats["not_modified"] += 1
+        return Response(status_code=304, headers={"ETag": etag})
+    _stats["tagged"] += 1
+    response.headers["ETag"] = etag
+    return None
+
+
+def stats() -> dict:
+    return {"enabled": redis_pool.available(), "pending_bumps": len(_pending_bumps), **_stats}
@@ -0,0 +1,50 @@
+# conftest.py - Shared fixtures: the app on a throwaway SQLite database, no network
+import os
+import sys
+import tempfile
+
+import pytest
+
+_tmpdir = tempfile.mkdtemp(prefix="backend_tests_")
+os.environ["DB_BACKEND"] = "sqlite"
+os.environ["SQLITE_PATH"] = os.path.join(_tmpdir, "test.db")
+os.environ.pop("DATABASE_URL", None)
+os.environ.pop("DATABASE_REPLICA_URLS", None)
+os.environ.setdefault("SECRET_KEY", "test-secret-key-test-secret-key!!")
+os.environ.setdefault("TEST_PHONE", "+15550000000")
+os.environ.setdefault("TEST_OTP", "000000")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture(scope="session")
+def app():
+    """main.app with migrations applied (the lifespan's network prefetches are skipped)."""
+    import db
+    import main
+
+    db.init_db()
+    return main.app
+
+
+@pytest.fixture
+async def client(app):
+    import httpx
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+        yield http
+
+
+@pytest.fixture
+async def auth_headers(client):
+    import otp
+
+    response = await client.post("/otp/verify", json={"phone": otp.TEST_PHONE, "otp": otp.TEST_OTP})
+    assert response.status_code == 200, response.text
+    return {"Authorization": f"Bearer {response.json()['token']}"}
@@ -0,0 +1,77 @@
+# test_chat_stream.py - /chat/message/stream against a stand-in Gemini stream
+import json
+
+import httpx
+import pytest
+from sqlalchemy import text
+
+pytestmark = pytest.mark.anyio
+
+
+def gemini_sse(*chunks: str) -> bytes:
+    return "".join(
+        f"data: {json.dumps({'candidates': [{'content': {'parts': [{'text': c}]}}]})}\r\n\r\n" for c in chunks
+    ).encode()
+
+
+def sse_events(body: str) -> list:
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+@pytest.fixture
+async def premium_headers(client, auth_headers):
+    import db
+
+    await client.get("/profile/premium-status", headers=auth_headers)
+    with db.engine.begin() as conn:
+        conn.execute(text("UPDATE profiles SET is_premium = :yes"), {"yes": True})
+    return auth_headers
+
+
+@pytest.fixture
+def gemini(monkeypatch):
+    import chat
+    import upstreams
+
+    monkeypatch.setattr(chat, "GEMINI_API_KEY", "test-key")
+    monkeypatch.setitem(upstreams._clients, "gemini", httpx.AsyncClient(transport=httpx.MockTransport(
+        lambda request: httpx.Response(200, content=gemini_sse("Hello ", "there."),
+                                       headers={"Content-Type": "text/event-stream"})
+    )))
+
+
+async def test_stream_relays_deltas_then_done(client, premium_headers, gemini):
+    import conversation_store
+    import otp
+
+    response = await client.post("/chat/message/stream", json={"message": "hi", "todos": ["a"],
+                                                               "is_new_conversation": True}, headers=premium_headers)
+    assert response.status_code == 200
+    events = sse_events(response.text)
+    assert events[:-1] == [("delta", {"text": "Hello "}), ("delta", {"text": "there."})]
+    assert events[-1] == ("done", {"response": "Hello there.", "conversation_ended": False})
+
+    stored = await conversation_store.get(otp.verify_token(premium_headers["Authorization"]))
+    assert [m["parts"][0]["text"] for m in stored["history"][-2:]] == ["hi", "Hello there."]
+
+
+async def test_stream_reports_save_failure(client, premium_headers, gemini, monkeypatch):
+    import chat
+    import conversation_store
+    import otp
+
+    async def failing_record(db, owner):
+        raise RuntimeError("database is down")
+
+    monkeypatch.setattr(chat, "record_chat_message", failing_record)
+    response = await client.post("/chat/message/stream", json={"message": "hi again", "todos": ["a"],
+                                                               "is_new_conversation": True}, headers=premium_headers)
+    events = sse_events(response.text)
+    assert events[-1][0] == "error"
+    assert all(event != "done" for event, _ in events)
+    stored = await conversation_store.get(otp.verify_token(premium_headers["Authorization"]))
+    assert stored is None or stored["history"][-2]["parts"][0]["text"] != "hi again"
@@ -0,0 +1,33 @@
+# test_conversation_store.py - optimistic saves on the in-process store
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+def entry(text: str) -> dict:
+    return {"role": "user", "parts": [{"text": text}]}
+
+
+async def test_concurrent_creates_merge_instead_of_overwriting(monkeypatch):
+    import conversation_store
+
+    monkeypatch.setattr(conversation_store, "store", conversation_store.MemoryConversationStore(60))
+    first = conversation_store.new_conversation([], [entry("system")])
+    second = conversation_store.new_conversation([], [entry("system")])
+
+    await conversation_store.append("u1", first, [entry("from worker 1")])
+    await conversation_store.append("u1", second, [entry("from worker 2")])
+
+    stored = await conversation_store.get("u1")
+    assert [m["parts"][0]["text"] for m in stored["history"]] == ["system", "from worker 1", "from worker 2"]
+    assert stored["version"] == 2
+
+
+async def test_create_does_not_replace_a_stored_conversation():
+    import conversation_store
+
+    store = conversation_store.MemoryConversationStore(60)
+    assert await store.save("u1", conversation_store.new_conversation([], [entry("old")]))
+    assert not await store.save("u1", conversation_store.new_conversation([], [entry("new")]))
+    await store.pop("u1")
+    assert await store.save("u1", conversation_store.new_conversation([], [entry("new")]))
@@ -0,0 +1,74 @@
+# test_event_loop.py - The event loop stays responsive while routes hit the database
+import asyncio
+import time
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+# Longest the loop may go without running a ready task
+MAX_LOOP_LAG_SECONDS = 0.1
+CONCURRENT_REQUESTS = 50
+
+
+class LoopLagMonitor:
+    """Sleeps in short ticks and records how late each wake-up was."""
+
+    def __init__(self, tick: float = 0.005):
+        self.tick = tick
+        self.max_lag = 0.0
+        self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.tick)
+            self.max_lag = max(self.max_lag, time.perf_counter() - started - self.tick)
+
+    async def __aenter__(self):
+        self._task = asyncio.create_task(self._run())
+        await asyncio.sleep(0)
+        return self
+
+    async def __aexit__(self, *exc):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+async def test_loop_responsive_under_concurrent_db_requests(client, auth_headers):
+    async def one(i: int):
+        if i % 3 == 0:
+            response = await client.post("/todos", json={"task": f"load {i}"}, headers=auth_headers)
+        elif i % 3 == 1:
+            response = await client.get("/todos", headers=auth_headers)
+        else:
+            response = await client.get("/profile/premium-status", headers=auth_headers)
+        assert response.status_code == 200, response.text
+
+    async with LoopLagMonitor() as monitor:
+        await asyncio.gather(*(one(i) for i in range(CONCURRENT_REQUESTS)))
+
+    assert monitor.max_lag < MAX_LOOP_LAG_SECONDS, f"event loop stalled for {monitor.max_lag * 1000:.0f} ms"
+
+
+async def test_sync_premium_verifies_receipts_off_the_loop(client, auth_headers, monkeypatch):
+    import profile
+
+    def slow_verify(jws_tokens):
+        time.sleep(0.3)  # stands in for CPU-bound chain and signature checks
+        return [{"ok": True, "payload": {"productId": "premium"}} for _ in jws_tokens]
+
+    monkeypatch.setattr(profile, "verify_app_store_jws_batch", slow_verify)
+
+    async def sync():
+        response = await client.post("/profile/sync-premium",
+                                     json={"is_premium": True, "transaction_jws": "token"}, headers=auth_headers)
+        assert response.status_code == 200, response.text
+
+    async with LoopLagMonitor() as monitor:
+        await asyncio.gather(sync(), *(client.get("/todos", headers=auth_headers) for _ in range(10)))
+
+    assert monitor.max_lag < MAX_LOOP_LAG_SECONDS, f"event loop stalled for {monitor.max_lag * 1000:.0f} ms"
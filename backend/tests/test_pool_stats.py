@@ -0,0 +1,48 @@
+# test_pool_stats.py - waiter accounting and surviving engine.dispose()
+import threading
+import time
+
+from sqlalchemy import create_engine, text
+
+from pool_stats import PoolStats, TimedQueuePool
+
+
+def make_engine(tmp_path, stats):
+    engine = create_engine(f"sqlite:///{tmp_path / 'pool.db'}", poolclass=TimedQueuePool,
+                           pool_size=1, max_overflow=0, pool_timeout=5)
+    stats.attach(engine)
+    return engine
+
+
+def test_only_blocked_checkouts_count_as_waiting(tmp_path):
+    stats = PoolStats("test")
+    engine = make_engine(tmp_path, stats)
+    for _ in range(3):
+        with engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+    assert stats.max_waiting == 0
+
+    held = engine.connect()
+    waiter = threading.Thread(target=lambda: engine.connect().close())
+    waiter.start()
+    deadline = time.monotonic() + 5
+    while stats.waiting == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert stats.waiting == 1
+    held.close()
+    waiter.join()
+    assert stats.waiting == 0 and stats.max_waiting == 1
+    assert stats.checkouts == 5
+
+
+def test_stats_follow_the_pool_across_dispose(tmp_path):
+    stats = PoolStats("test")
+    engine = make_engine(tmp_path, stats)
+    with engine.connect():
+        pass
+    engine.dispose()
+    with engine.connect():
+        pass
+    assert stats.pool is engine.pool
+    assert sum(stats.wait_buckets) == 2
+    assert stats.snapshot()["checkouts"] == 2
@@ -0,0 +1,21 @@
+# test_premium_sync.py - /profile/sync-premium invalidates ETags only on a change
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_unchanged_sync_does_not_bump_the_state_version(client, auth_headers, monkeypatch):
+    import state_version
+
+    bumps = []
+
+    async def record_bump(*owner_ids):
+        bumps.append(owner_ids)
+
+    monkeypatch.setattr(state_version, "bump", record_bump)
+    revoke = {"is_premium": False}
+    assert (await client.post("/profile/sync-premium", json=revoke, headers=auth_headers)).status_code == 200
+    bumps.clear()
+
+    assert (await client.post("/profile/sync-premium", json=revoke, headers=auth_headers)).status_code == 200
+    assert bumps == []
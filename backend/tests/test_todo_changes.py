@@ -0,0 +1,43 @@
+# test_todo_changes.py - /todos/changes delta sync across a tombstone purge
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import text
+
+pytestmark = pytest.mark.anyio
+
+
+async def sync(client, headers, since: int) -> dict:
+    response = await client.get("/todos/changes", params={"since": since}, headers=headers)
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+async def test_stale_cursor_resets_after_tombstones_are_purged(client, auth_headers):
+    import db
+    import todo
+
+    keep = (await client.post("/todos", json={"task": "keep"}, headers=auth_headers)).json()["todo"]["id"]
+    gone = (await client.post("/todos", json={"task": "gone"}, headers=auth_headers)).json()["todo"]["id"]
+    cursor = (await sync(client, auth_headers, 0))["cursor"]
+
+    assert (await client.delete(f"/todos/{gone}", headers=auth_headers)).status_code == 200
+    fresh = await sync(client, auth_headers, cursor)
+    assert fresh["reset"] is False
+    assert [(c["id"], c["deleted"]) for c in fresh["changes"]] == [(gone, True)]
+
+    # Age the tombstone past retention and purge it
+    old = datetime.now(timezone.utc) - timedelta(days=todo.TOMBSTONE_RETENTION_DAYS + 1)
+    with db.engine.begin() as conn:
+        conn.execute(text("UPDATE todos SET deleted_at = :old WHERE id = :id"), {"old": old, "id": gone})
+    assert await todo.purge_tombstones() == 1
+
+    # A client that never saw the deletion gets a full resync instead
+    stale = await sync(client, auth_headers, cursor)
+    assert stale["reset"] is True
+    ids = [c["id"] for c in stale["changes"]]
+    assert keep in ids and gone not in ids
+
+    # A client that already synced past the tombstone is unaffected
+    current = await sync(client, auth_headers, fresh["cursor"])
+    assert current == {"changes": [], "cursor": fresh["cursor"], "has_more": False, "reset": False}
@@ -0,0 +1,140 @@
+# test_twilio_verify.py - Deadlines and the circuit breaker against a stand-in Verify API
+import asyncio
+import time
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+from twilio_verify import CircuitBreaker, TwilioUnavailable, TwilioVerifyClient
+
+pytestmark = pytest.mark.anyio
+
+
+class StandInVerify:
+    """httpx.MockTransport handler playing the Verify API; behaviour is switchable per test."""
+
+    def __init__(self):
+        self.calls = 0
+        self.status = 201
+        self.delay = 0.0
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.calls += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if request.url.path.endswith("/VerificationCheck") and self.status == 404:
+            return httpx.Response(404, json={"code": 20404})
+        return httpx.Response(self.status, json={"status": "pending", "to": "+15550000001"})
+
+
+def make_client(api: StandInVerify, deadline=1.0, failures=3, reset=0.05) -> TwilioVerifyClient:
+    return TwilioVerifyClient(
+        base_url="http://verify.test", account_sid="AC", auth_token="token", service_sid="VA",
+        deadline_seconds=deadline, breaker=CircuitBreaker(failures, reset),
+        transport=httpx.MockTransport(api),
+    )
+
+
+async def test_send_and_check_succeed():
+    api = StandInVerify()
+    client = make_client(api)
+    assert (await client.send_verification("+15550000001"))["status"] == "pending"
+    api.status = 404
+    assert (await client.check_verification("+15550000001", "123456"))["status"] == "not_found"
+    assert client.breaker.state == "closed"
+    await client.aclose()
+
+
+async def test_deadline_expiry_is_a_failure():
+    api = StandInVerify()
+    api.delay = 1.0
+    client = make_client(api, deadline=0.05)
+    started = time.perf_counter()
+    with pytest.raises(TwilioUnavailable):
+        await client.send_verification("+15550000001")
+    assert time.perf_counter() - started < 0.5
+    assert client.breaker.failures == 1
+    await client.aclose()
+
+
+async def test_server_errors_open_the_breaker():
+    api = StandInVerify()
+    api.status = 503
+    client = make_client(api, failures=3, reset=60)
+    for _ in range(3):
+        with pytest.raises(TwilioUnavailable):
+            await client.send_verification("+15550000001")
+    assert client.breaker.state == "open"
+
+    # Open: rejected without reaching Twilio
+    with pytest.raises(TwilioUnavailable):
+        await client.send_verification("+15550000001")
+    assert api.calls == 3
+    assert client.breaker.rejected == 1
+    await client.aclose()
+
+
+async def test_rate_limited_number_does_not_open_the_breaker():
+    api = StandInVerify()
+    api.status = 429
+    client = make_client(api, failures=2, reset=60)
+    for _ in range(5):
+        with pytest.raises(HTTPException) as excinfo:
+            await client.send_verification("+15550000001")
+        assert excinfo.value.status_code == 429
+    assert client.breaker.state == "closed"
+    assert client.breaker.failures == 0
+    await client.aclose()
+
+
+async def test_half_open_probe_recovers():
+    api = StandInVerify()
+    api.status = 500
+    client = make_client(api, failures=2, reset=0.05)
+    for _ in range(2):
+        with pytest.raises(TwilioUnavailable):
+            await client.send_verification("+15550000001")
+    assert client.breaker.state == "open"
+
+    await asyncio.sleep(0.06)
+    assert client.breaker.state == "half_open"
+    api.status = 201
+    assert (await client.send_verification("+15550000001"))["status"] == "pending"
+    assert client.breaker.state == "closed"
+    await client.aclose()
+
+
+async def test_failed_probe_reopens():
+    api = StandInVerify()
+    api.status = 500
+    client = make_client(api, failures=1, reset=0.05)
+    with pytest.raises(TwilioUnavailable):
+        await client.send_verification("+15550000001")
+    await asyncio.sleep(0.06)
+    with pytest.raises(TwilioUnavailable):
+        await client.send_verification("+15550000001")
+    assert client.breaker.state == "open"
+    await client.aclose()
+
+
+async def test_cancelled_probe_releases_the_slot():
+    api = StandInVerify()
+    api.status = 500
+    client = make_client(api, failures=1, reset=0.05)
+    with pytest.raises(TwilioUnavailable):
+        await client.send_verification("+15550000001")
+    await asyncio.sleep(0.06)
+
+    api.status, api.delay = 201, 1.0
+    probe = asyncio.create_task(client.send_verification("+15550000001"))
+    await asyncio.sleep(0.02)
+    probe.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await probe
+
+    # The next call becomes the probe instead of being rejected forever
+    api.delay = 0.0
+    assert (await client.send_verification("+15550000001"))["status"] == "pending"
+    assert client.breaker.state == "closed"
+    await client.aclose()
@@ -1,28 +1,180 @@
-from fastapi import APIRouter, HTTPException, Depends
+import asyncio
+import os
+import re
+from datetime import date, datetime, timedelta, timezone
+from typing import List, Literal, Optional
+from fastapi import APIRouter, HTTPException, Depends, Query, Request, Response
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
-from db import get_db
-from models import Todo, Profile
-from otp import verify_token, get_user_identifier
+from sqlalchemy import select, update, insert, delete, and_, or_, func, literal_column, table, column
+from sqlalchemy.ext.asyncio import AsyncSession
+from db import get_async_db, AsyncSessionLocal
+from read_routing import get_read_db
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from models import Todo, User, TodoCompletion, TodoCompletionDaily
+from usage_counters import increment_daily_counter
+from call_usage import EASTERN
+from otp import verify_token, get_owner
+import activity
+import state_version
 
 router = APIRouter(prefix="/todos", tags=["todos"])
 
+MAX_TODOS_PAGE_SIZE = 200
+MAX_CHANGES_PER_PAGE = 500
+MAX_SEARCH_PAGE_SIZE = 50
+MAX_SEARCH_TERMS = 8
+MAX_STATS_RANGE_DAYS = 366
+STREAK_PAGE_DAYS = 400
+# Deleted todos stay as tombstones this long; a client whose cursor predates a
+# purged tombstone gets a full resync (reset) from GET /todos/changes instead
+TOMBSTONE_RETENTION_DAYS = int(os.getenv("TODO_TOMBSTONE_RETENTION_DAYS", "30"))
+TOMBSTONE_PURGE_INTERVAL_SECONDS = int(os.getenv("TODO_TOMBSTONE_PURGE_INTERVAL_SECONDS", "3600"))
+TOMBSTONE_PURGE_BATCH_SIZE = 1000
+
+_INSERTS = {"postgresql": pg_insert, "sqlite": sqlite_insert}
+MAX_BATCH_OPERATIONS = 500
+
 
 class TodoItem(BaseModel):
     task: str
     apple_id: str | None = None
 
 
+class TodoOperation(BaseModel):
+    op: Literal["create", "update", "delete"]
+    id: Optional[int] = None  # server id of an existing todo
+    client_id: Optional[str] = None  # names a create; later operations may target it
+    task: Optional[str] = None
+    apple_id: Optional[str] = None
+
+
+class TodoBatch(BaseModel):
+    operations: List[TodoOperation]
+
+
+class CompleteRequest(BaseModel):
+    completed_at: Optional[datetime] = None  # when completed offline; defaults to now
+    local_date: Optional[date] = None  # the user's calendar day; defaults to the Eastern date
+
+
 class TodoResponse(BaseModel):
     id: int
     task: str
     phone: str
 
 
+async def _next_change_seq(db: AsyncSession, owner_id: int, count: int = 1) -> int:
+    """
+    Issue the user's next todo change sequence number (the last of `count`
+    consecutive ones). The row lock on the user is held until commit, so a
+    user's changes commit in sequence order.
+    """
+    return (await db.execute(
+        update(User).where(User.id == owner_id).values(todo_seq=User.todo_seq + count).returning(User.todo_seq)
+    )).scalar_one()
+
+
+async def _current_cursor(db: AsyncSession, owner_id: int) -> int:
+    return (await db.execute(select(User.todo_seq).where(User.id == owner_id))).scalar() or 0
+
+
+# Response key -> column, for GET /todos?fields=
+TODO_FIELDS = {
+    "id": Todo.id,
+    "task": Todo.task,
+    "phone": Todo.phone,
+    "appleId": Todo.apple_id,
+    "syncedAt": Todo.synced_at,
+}
+
+
 @router.get("")
-def get_todos(db: Session = Depends(get_db), user_id: str = Depends(verify_token)):
-    phone = get_user_identifier(user_id, db)
-    todos = db.query(Todo).filter(Todo.phone == phone).order_by(Todo.created_at.desc()).all()
+async def get_todos(
+    request: Request,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_TODOS_PAGE_SIZE, description="page size (omit for the full list)"),
+    after: Optional[int] = Query(None, description="X-Next-Cursor from the previous page"),
+    fields: Optional[str] = Query(None, description="comma-separated subset of " + ",".join(TODO_FIELDS)),
+    db: AsyncSession = Depends(get_read_db),
+    user_id: str = Depends(verify_token),
+):
+    """
+    The user's todos, newest first. With limit/after this pages by keyset on
+    (created_at, id) over ix_todos_user_created_id, and the cursor for the
+    next page is sent in the X-Next-Cursor header. The body stays
+    {"todos": [...]}, which is the shape the iOS client decodes. Answers 304
+    when If-None-Match matches (see state_version).
+    """
+    names = [f.strip() for f in fields.split(",") if f.strip()] if fields else list(TODO_FIELDS)
+    unknown = [f for f in names if f not in TODO_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+
+    owner = await get_owner(user_id, db)
+    cached = await state_version.not_modified(request, response, owner.id)
+    if cached:
+        return cached
+    query = (
+        select(Todo.id.label("_id"), *[TODO_FIELDS[f].label(f) for f in names])
+        .where(Todo.user_id == owner.id, Todo.deleted_at.is_(None))
+        .order_by(Todo.created_at.desc(), Todo.id.desc())
+    )
+    if after is not None:
+        # Compare against the stored created_at, not a value round-tripped through the cursor
+        boundary = select(Todo.created_at).where(Todo.id == after, Todo.user_id == owner.id).scalar_subquery()
+        query = query.where(or_(Todo.created_at < boundary, and_(Todo.created_at == boundary, Todo.id < after)))
+    if limit is not None:
+        query = query.limit(limit + 1)
+
+    rows = (await db.execute(query)).all()
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        response.headers["X-Next-Cursor"] = str(rows[-1]._id)
+    return {
+        "todos": [
+            {f: (v.isoformat() if v else None) if f == "syncedAt" else v
+             for f, v in zip(names, row[1:])}
+            for row in rows
+        ]
+    }
+
+
+@router.get("/search")
+async def search_todos(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=MAX_SEARCH_PAGE_SIZE),
+    offset: int = Query(0, ge=0),
+    db: AsyncSession = Depends(get_read_db),
+    user_id: str = Depends(verify_token),
+):
+    """
+    Ranked full-text search over the user's todos. Every word of q must
+    match, as a prefix ("gro" finds "groceries"). Uses the index from
+    migration 8: to_tsvector GIN on Postgres, the todos_fts FTS5 table on
+    SQLite. Pass next_offset back as offset for the next page.
+    """
+    terms = re.findall(r"\w+", q.lower())[:MAX_SEARCH_TERMS]
+    if not terms:
+        return {"todos": [], "next_offset": None}
+
+    owner = await get_owner(user_id, db)
+    query = select(Todo.id, Todo.task, Todo.phone, Todo.apple_id, Todo.synced_at).where(
+        Todo.user_id == owner.id, Todo.deleted_at.is_(None)
+    )
+    if db.get_bind().dialect.name == "postgresql":
+        # Literals, not bind parameters, so the expression matches ix_todos_task_fts
+        document = func.to_tsvector(literal_column("'simple'"), func.coalesce(Todo.task, literal_column("''")))
+        ts_query = func.to_tsquery(literal_column("'simple'"), " & ".join(f"{t}:*" for t in terms))
+        query = query.where(document.op("@@")(ts_query)).order_by(func.ts_rank(document, ts_query).desc())
+    else:
+        fts = table("todos_fts", column("rowid"))
+        query = (
+            query.join(fts, fts.c.rowid == Todo.id)
+            .where(literal_column("todos_fts").op("MATCH")(" ".join(f'"{t}"*' for t in terms)))
+            .order_by(func.bm25(literal_column("todos_fts")))  # lower is better
+        )
+    rows = (await db.execute(query.order_by(Todo.id.desc()).offset(offset).limit(limit + 1))).all()
     return {
         "todos": [
             {
@@ -32,28 +184,69 @@ def get_todos(db: Session = Depends(get_db), user_id: str = Depends(verify_token
                 "appleId": t.apple_id,
                 "syncedAt": t.synced_at.isoformat() if t.synced_at else None
             }
-            for t in todos
-        ]
+            for t in rows[:limit]
+        ],
+        "next_offset": offset + limit if len(rows) > limit else None,
+    }
+
+
+@router.get("/changes")
+async def get_todo_changes(
+    since: int = Query(0, ge=0, description="cursor from the previous sync (0 = full sync)"),
+    limit: int = Query(MAX_CHANGES_PER_PAGE, ge=1, le=MAX_CHANGES_PER_PAGE),
+    db: AsyncSession = Depends(get_read_db),
+    user_id: str = Depends(verify_token),
+):
+    """
+    Delta sync: todos created, updated or deleted after `since`, oldest
+    change first. Deleted todos come back once as tombstones
+    ({"id", "deleted": true}). Call again with the returned cursor while
+    has_more is true. reset is true when tombstones newer than `since` have
+    been purged: the changes are then a full sync that replaces the
+    client's copy.
+    """
+    owner = await get_owner(user_id, db)
+    reset = False
+    if since > 0:
+        purged_seq = (await db.execute(select(User.todo_purged_seq).where(User.id == owner.id))).scalar() or 0
+        if since < purged_seq:
+            since, reset = 0, True
+    query = select(Todo).where(Todo.user_id == owner.id, Todo.change_seq > since)
+    if since == 0:
+        query = query.where(Todo.deleted_at.is_(None))
+    rows = (await db.execute(query.order_by(Todo.change_seq).limit(limit + 1))).scalars().all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "changes": [
+            {"id": t.id, "deleted": True, "changeSeq": t.change_seq}
+            if t.deleted_at is not None else
+            {
+                "id": t.id,
+                "deleted": False,
+                "task": t.task,
+                "phone": t.phone,
+                "appleId": t.apple_id,
+                "syncedAt": t.synced_at.isoformat() if t.synced_at else None,
+                "changeSeq": t.change_seq,
+            }
+            for t in rows
+        ],
+        "cursor": rows[-1].change_seq if rows else since,
+        "has_more": has_more,
+        "reset": reset,
     }
 
 
 @router.post("")
-def add_todo(item: TodoItem, db: Session = Depends(get_db), user_id: str = Depends(verify_token)):
-    phone = get_user_identifier(user_id, db)
-    todo = Todo(task=item.task, phone=phone, apple_id=item.apple_id)
+async def add_todo(item: TodoItem, db: AsyncSession = Depends(get_async_db), user_id: str = Depends(verify_token)):
+    owner = await get_owner(user_id, db)
+    todo = Todo(task=item.task, user_id=owner.id, phone=owner.identifier, apple_id=item.apple_id,
+                change_seq=await _next_change_seq(db, owner.id))
     db.add(todo)
-    db.commit()
-    db.refresh(todo)
-    
-    profile = db.query(Profile).filter(Profile.phone == phone).first()
-    if profile:
-        from datetime import datetime
-        profile.last_active = datetime.utcnow()
-        db.commit()
-    else:
-        profile = Profile(phone=phone, is_premium=False)
-        db.add(profile)
-        db.commit()
+    await db.commit()  # id and server defaults come back via RETURNING (eager_defaults)
+    await state_version.bump(owner.id)
+    activity.touch(owner)
     
     return {
         "message": "Todo added",
@@ -68,17 +261,20 @@ def add_todo(item: TodoItem, db: Session = Depends(get_db), user_id: str = Depen
 
 
 @router.put("/{todo_id}")
-def update_todo(todo_id: int, item: TodoItem, db: Session = Depends(get_db), user_id: str = Depends(verify_token)):
-    phone = get_user_identifier(user_id, db)
-    todo = db.query(Todo).filter(Todo.id == todo_id, Todo.phone == phone).first()
+async def update_todo(todo_id: int, item: TodoItem, db: AsyncSession = Depends(get_async_db), user_id: str = Depends(verify_token)):
+    owner = await get_owner(user_id, db)
+    todo = (await db.execute(select(Todo).where(
+        Todo.id == todo_id, Todo.user_id == owner.id, Todo.deleted_at.is_(None)
+    ))).scalars().first()
     if not todo:
         raise HTTPException(status_code=404, detail="Invalid id")
 
     todo.task = item.task
     if item.apple_id is not None:
         todo.apple_id = item.apple_id
-    db.commit()
-    db.refresh(todo)
+    todo.change_seq = await _next_change_seq(db, owner.id)
+    await db.commit()
+    await state_version.bump(owner.id)
     return {
         "message": f"Updated todo {todo_id}",
         "todo": {
@@ -92,17 +288,273 @@ def update_todo(todo_id: int, item: TodoItem, db: Session = Depends(get_db), use
 
 
 @router.delete("/{todo_id}")
-def delete_todo(todo_id: int, db: Session = Depends(get_db), user_id: str = Depends(verify_token)):
-    phone = get_user_identifier(user_id, db)
-    todo = db.query(Todo).filter(Todo.id == todo_id, Todo.phone == phone).first()
+async def delete_todo(todo_id: int, db: AsyncSession = Depends(get_async_db), user_id: str = Depends(verify_token)):
+    owner = await get_owner(user_id, db)
+    todo = (await db.execute(select(Todo).where(
+        Todo.id == todo_id, Todo.user_id == owner.id, Todo.deleted_at.is_(None)
+    ))).scalars().first()
     if not todo:
         raise HTTPException(status_code=404, detail="Invalid id")
 
     task_text = todo.task
-    db.delete(todo)
-    db.commit()
+    # Tombstone rather than delete, so delta sync can report the removal
+    todo.deleted_at = datetime.now(timezone.utc)
+    todo.change_seq = await _next_change_seq(db, owner.id)
+    await db.commit()
+    await state_version.bump(owner.id)
     
+    remaining = (await db.execute(
+        select(Todo).where(Todo.user_id == owner.id, Todo.deleted_at.is_(None))
+    )).scalars().all()
     return {
         "message": f"Removed '{task_text}'",
-        "todos": [{"id": t.id, "task": t.task, "phone": t.phone} for t in db.query(Todo).filter(Todo.phone == phone).all()],
+        "todos": [{"id": t.id, "task": t.task, "phone": t.phone} for t in remaining],
     }
+
+
+@router.post("/batch")
+async def batch_todos(batch: TodoBatch, db: AsyncSession = Depends(get_async_db), user_id: str = Depends(verify_token)):
+    """
+    Apply an ordered list of creates, updates and deletes (e.g. an offline
+    replay) in one transaction. Updates and deletes target a server `id` or
+    the `client_id` of a create earlier in the batch. Each todo ends up as
+    one bulk insert or update row with one new changeSeq. Operations on
+    unknown ids report "not_found" and the rest still apply.
+    """
+    ops = batch.operations
+    if len(ops) > MAX_BATCH_OPERATIONS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_OPERATIONS} operations per batch")
+    for i, op in enumerate(ops):
+        if op.op != "delete" and op.task is None:
+            raise HTTPException(status_code=400, detail=f"Operation {i}: task is required for {op.op}")
+        if op.op == "create" and op.id is not None:
+            raise HTTPException(status_code=400, detail=f"Operation {i}: create cannot carry an id")
+        if op.op != "create" and op.id is None and op.client_id is None:
+            raise HTTPException(status_code=400, detail=f"Operation {i}: id or client_id is required for {op.op}")
+    client_ids = [op.client_id for op in ops if op.op == "create" and op.client_id is not None]
+    if len(client_ids) != len(set(client_ids)):
+        raise HTTPException(status_code=400, detail="client_id must be unique among creates")
+
+    owner = await get_owner(user_id, db)
+    ids = {op.id for op in ops if op.id is not None}
+    existing = {t.id: t for t in (await db.execute(select(Todo).where(
+        Todo.id.in_(ids), Todo.user_id == owner.id, Todo.deleted_at.is_(None)
+    ))).scalars()} if ids else {}
+
+    # Fold the operations into the final state of each todo they touch
+    created = {}  # client_id -> insert values (None once deleted again)
+    changed = {}  # server id -> values for the bulk update
+    targets = []  # per operation: ("new", client_id) / ("existing", id) / None
+    for op in ops:
+        if op.op == "create":
+            key = op.client_id or f"#{len(targets)}"
+            created[key] = {"task": op.task, "user_id": owner.id, "phone": owner.identifier, "apple_id": op.apple_id}
+            targets.append(("new", key))
+        elif op.id is None:
+            values = created.get(op.client_id)
+            if values is None:
+                targets.append(None)
+                continue
+            if op.op == "delete":
+                created[op.client_id] = None
+            else:
+                values["task"] = op.task
+                if op.apple_id is not None:
+                    values["apple_id"] = op.apple_id
+            targets.append(("new", op.client_id))
+        else:
+            values = changed.setdefault(op.id, {"id": op.id})
+            if op.id not in existing or "deleted_at" in values:
+                targets.append(None)
+                continue
+            if op.op == "delete":
+                values["deleted_at"] = datetime.now(timezone.utc)
+            else:
+                values["task"] = op.task
+                if op.apple_id is not None:
+                    values["apple_id"] = op.apple_id
+            targets.append(("existing", op.id))
+
+    inserts = [(key, values) for key, values in created.items() if values is not None]
+    updates = [values for values in changed.values() if len(values) > 1]
+    seq = None
+    new_ids = {}
+    if inserts or updates:
+        seq = await _next_change_seq(db, owner.id, len(inserts) + len(updates))
+        for n, (_, values) in enumerate(inserts + [(None, v) for v in updates]):
+            values["change_seq"] = seq - len(inserts) - len(updates) + 1 + n
+    if inserts:
+        rows = (await db.execute(
+            insert(Todo).returning(Todo.id, sort_by_parameter_order=True), [values for _, values in inserts]
+        )).scalars().all()
+        new_ids = {key: row_id for (key, _), row_id in zip(inserts, rows)}
+    # Bulk UPDATE by primary key, one statement per distinct column set
+    for columns in {tuple(sorted(v)) for v in updates}:
+        await db.execute(update(Todo), [v for v in updates if tuple(sorted(v)) == columns])
+
+    await db.commit()
+    if inserts or updates:
+        await state_version.bump(owner.id)
+    if inserts:
+        activity.touch(owner)
+
+    results = []
+    for op, target in zip(ops, targets):
+        result = {"op": op.op, "client_id": op.client_id, "id": op.id}
+        if target is None:
+            result["status"] = "not_found"
+        elif target[0] == "new":
+            values = created[target[1]]
+            result.update(status="ok", id=new_ids.get(target[1]),
+                          changeSeq=values["change_seq"] if values is not None else None)
+        else:
+            result.update(status="ok", changeSeq=changed[target[1]]["change_seq"])
+        results.append(result)
+    print(f"📦 Todo batch for user {user_id}: {len(ops)} operations, {len(inserts)} inserts, {len(updates)} updates")
+    return {"results": results, "cursor": seq if seq is not None else await _current_cursor(db, owner.id)}
+
+
+@router.post("/{todo_id}/complete")
+async def complete_todo(
+    todo_id: int,
+    item: Optional[CompleteRequest] = None,
+    db: AsyncSession = Depends(get_async_db),
+    user_id: str = Depends(verify_token),
+):
+    """
+    Record that a todo was completed. The event row and the +1 on that day's
+    rollup commit together; completing the same todo again is a no-op.
+    """
+    item = item or CompleteRequest()
+    owner = await get_owner(user_id, db)
+    todo = (await db.execute(select(Todo.id, Todo.task).where(
+        Todo.id == todo_id, Todo.user_id == owner.id
+    ))).first()
+    if not todo:
+        raise HTTPException(status_code=404, detail="Invalid id")
+
+    completed_at = item.completed_at or datetime.now(timezone.utc)
+    if completed_at.tzinfo is None:
+        completed_at = completed_at.replace(tzinfo=timezone.utc)
+    day = item.local_date or completed_at.astimezone(EASTERN).date()
+
+    insert = _INSERTS[db.get_bind().dialect.name]
+    event_id = (await db.execute(
+        insert(TodoCompletion).values(
+            user_id=owner.id, phone=owner.identifier, todo_id=todo.id, task=todo.task,
+            completed_at=completed_at, usage_date=day,
+        ).on_conflict_do_nothing(index_elements=[TodoCompletion.todo_id]).returning(TodoCompletion.id)
+    )).scalar()
+    if event_id is None:
+        return {"message": f"Todo {todo_id} already completed", "recorded": False}
+
+    count = await increment_daily_counter(db, TodoCompletionDaily, "completed_count", owner, day)
+    await db.commit()
+    await state_version.bump(owner.id)
+    return {"message": f"Completed todo {todo_id}", "recorded": True, "date": day.isoformat(), "day_count": count}
+
+
+async def _current_streak(db: AsyncSession, owner_id: int, today: date) -> int:
+    """Consecutive days with a completion ending today (or yesterday, if today has none yet)."""
+    streak, expected, before = 0, None, today
+    while True:
+        days = (await db.execute(
+            select(TodoCompletionDaily.usage_date)
+            .where(TodoCompletionDaily.user_id == owner_id, TodoCompletionDaily.usage_date <= before)
+            .order_by(TodoCompletionDaily.usage_date.desc()).limit(STREAK_PAGE_DAYS)
+        )).scalars().all()
+        for day in days:
+            if expected is None:
+                if day < today - timedelta(days=1):
+                    return 0
+                expected = day
+            if day != expected:
+                return streak
+            streak += 1
+            expected = day - timedelta(days=1)
+        if len(days) < STREAK_PAGE_DAYS:
+            return streak
+        before = expected
+
+
+@router.get("/stats")
+async def get_todo_stats(
+    request: Request,
+    response: Response,
+    start: Optional[date] = Query(None, description="first day (default: 29 days before end)"),
+    end: Optional[date] = Query(None, description="last day (default: today)"),
+    today: Optional[date] = Query(None, description="the user's current calendar day (default: Eastern)"),
+    db: AsyncSession = Depends(get_read_db),
+    user_id: str = Depends(verify_token),
+):
+    """
+    Completions per day for a date range (days without completions are
+    omitted) and the current streak, read from the daily rollup only.
+    """
+    today = today or datetime.now(EASTERN).date()
+    end = end or today
+    start = start or end - timedelta(days=29)
+    if start > end or (end - start).days >= MAX_STATS_RANGE_DAYS:
+        raise HTTPException(status_code=400, detail=f"Range must be 1 to {MAX_STATS_RANGE_DAYS} days")
+
+    owner = await get_owner(user_id, db)
+    cached = await state_version.not_modified(request, response, owner.id, today)
+    if cached:
+        return cached
+    rows = (await db.execute(
+        select(TodoCompletionDaily.usage_date, TodoCompletionDaily.completed_count)
+        .where(TodoCompletionDaily.user_id == owner.id,
+               TodoCompletionDaily.usage_date.between(start, end))
+        .order_by(TodoCompletionDaily.usage_date)
+    )).all()
+    return {
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "days": [{"date": d.isoformat(), "count": count} for d, count in rows],
+        "total": sum(count for _, count in rows),
+        "current_streak": await _current_streak(db, owner.id, today),
+    }
+
+
+async def purge_tombstones() -> int:
+    """
+    Delete tombstones older than TOMBSTONE_RETENTION_DAYS, raising each
+    owner's todo_purged_seq first so their stale cursors are answered with
+    a reset. Returns the number of todos removed.
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(days=TOMBSTONE_RETENTION_DAYS)
+    purged = 0
+    while True:
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(
+                select(Todo.id, Todo.user_id, Todo.change_seq)
+                .where(Todo.deleted_at.isnot(None), Todo.deleted_at < cutoff)
+                .limit(TOMBSTONE_PURGE_BATCH_SIZE)
+            )).all()
+            if not rows:
+                break
+            high_water = {}
+            for _, owner_id, change_seq in rows:
+                if owner_id is not None and change_seq is not None:
+                    high_water[owner_id] = max(high_water.get(owner_id, 0), change_seq)
+            for owner_id, change_seq in high_water.items():
+                await db.execute(update(User).where(User.id == owner_id, User.todo_purged_seq < change_seq)
+                                 .values(todo_purged_seq=change_seq))
+            await db.execute(delete(Todo).where(Todo.id.in_([r.id for r in rows])))
+            await db.commit()
+        purged += len(rows)
+        if len(rows) < TOMBSTONE_PURGE_BATCH_SIZE:
+            break
+    if purged:
+        print(f"🧹 Purged {purged} todo tombstones older than {TOMBSTONE_RETENTION_DAYS} days")
+    return purged
+
+
+async def purge_tombstones_forever():
+    """Background loop started from main.lifespan."""
+    while True:
+        await asyncio.sleep(TOMBSTONE_PURGE_INTERVAL_SECONDS)
+        try:
+            await purge_tombstones()
+        except Exception as e:
+            print(f"❌ Tombstone purge error: {str(e)}")
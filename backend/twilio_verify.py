@@ -0,0 +1,178 @@
+# twilio_verify.py - Async Twilio Verify client with deadlines and a circuit breaker
+import asyncio
+import os
+import time
+from typing import Optional
+
+import httpx
+from fastapi import HTTPException
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
+TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
+VERIFY_SID = os.getenv("TWILIO_VERIFY_SID")
+# Overridable so a local stand-in for the Verify API can be used
+TWILIO_VERIFY_BASE_URL = os.getenv("TWILIO_VERIFY_BASE_URL", "https://verify.twilio.com")
+TWILIO_DEADLINE_SECONDS = float(os.getenv("TWILIO_DEADLINE_SECONDS", "6"))
+TWILIO_BREAKER_FAILURES = int(os.getenv("TWILIO_BREAKER_FAILURES", "5"))
+TWILIO_BREAKER_RESET_SECONDS = float(os.getenv("TWILIO_BREAKER_RESET_SECONDS", "30"))
+
+
+class TwilioUnavailable(Exception):
+    """Twilio failed, timed out, or the breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures and rejects calls
+    until `reset_seconds` have passed; then lets a single probe through
+    (half-open). A successful probe closes it, a failed one re-opens it.
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probe_in_flight = False
+        self.rejected = 0
+        self.times_opened = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return "half_open"
+        return "open"
+
+    def retry_after(self) -> float:
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.reset_seconds - (time.monotonic() - self.opened_at))
+
+    def before_call(self):
+        state = self.state
+        if state == "open" or (state == "half_open" and self._probe_in_flight):
+            self.rejected += 1
+            raise TwilioUnavailable("Twilio circuit breaker is open")
+        if state == "half_open":
+            self._probe_in_flight = True
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probe_in_flight = False
+
+    def release_probe(self):
+        """The call ended without a verdict (cancelled, unexpected error): free the half-open slot."""
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                self.times_opened += 1
+                print(f"⚠️ Twilio circuit breaker opened after {self.failures} failures")
+            self.opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "rejected": self.rejected,
+            "times_opened": self.times_opened,
+        }
+
+
+class TwilioVerifyClient:
+    """Talks to the Twilio Verify REST API over one reused HTTP connection pool."""
+
+    def __init__(self, base_url: str, account_sid: Optional[str], auth_token: Optional[str],
+                 service_sid: Optional[str], deadline_seconds: float, breaker: CircuitBreaker,
+                 transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.service_sid = service_sid
+        self.deadline_seconds = deadline_seconds
+        self.breaker = breaker
+        self._client = httpx.AsyncClient(
+            base_url=base_url,
+            auth=(account_sid or "", auth_token or ""),
+            timeout=httpx.Timeout(deadline_seconds, connect=min(3.0, deadline_seconds)),
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+            transport=transport,
+        )
+
+    async def send_verification(self, phone: str, channel: str = "sms") -> dict:
+        return await self._post("Verifications", {"To": phone, "Channel": channel})
+
+    async def check_verification(self, phone: str, code: str) -> dict:
+        """
+        Returns the VerificationCheck resource. Twilio answers 404 when there is
+        no pending verification (expired / already used); that is reported as
+        status "not_found" rather than as an upstream failure.
+        """
+        return await self._post("VerificationCheck", {"To": phone, "Code": code}, not_found_ok=True)
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    async def _post(self, resource: str, data: dict, not_found_ok: bool = False) -> dict:
+        self.breaker.before_call()
+        url = f"/v2/Services/{self.service_sid}/{resource}"
+        try:
+            response = await asyncio.wait_for(
+                self._client.post(url, data=data), timeout=self.deadline_seconds
+            )
+        except (asyncio.TimeoutError, httpx.HTTPError) as e:
+            self.breaker.record_failure()
+            raise TwilioUnavailable(f"Twilio {resource} request failed: {type(e).__name__}")
+        except BaseException:
+            # Cancelled (client went away, shutdown) or unexpected: not Twilio's
+            # fault, but a half-open probe slot must not stay taken forever
+            self.breaker.release_probe()
+            raise
+
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+            raise TwilioUnavailable(f"Twilio {resource} returned {response.status_code}")
+
+        # Anything else means Twilio is healthy, even if it rejected the request
+        self.breaker.record_success()
+        if response.status_code == 429:
+            # Usually a per-number limit (e.g. 60203 max send attempts): this caller only
+            print(f"⚠️ Twilio {resource} rate limited: {response.text}")
+            raise HTTPException(status_code=429, detail="Too many verification attempts, please try again later")
+        if not_found_ok and response.status_code == 404:
+            return {"status": "not_found"}
+        if response.status_code >= 400:
+            print(f"❌ Twilio {resource} error {response.status_code}: {response.text}")
+            raise HTTPException(status_code=400, detail="Verification request rejected")
+        return response.json()
+
+
+def unavailable_error(e: TwilioUnavailable) -> HTTPException:
+    """Structured 503 so the app can tell the user to retry shortly."""
+    retry_after = max(1, int(twilio_verify.breaker.retry_after() + 0.999))
+    print(f"⚠️ {str(e)}")
+    return HTTPException(
+        status_code=503,
+        detail={
+            "error": "sms_provider_unavailable",
+            "message": "SMS verification is temporarily unavailable, please try again shortly.",
+            "retry_after_seconds": retry_after,
+        },
+        headers={"Retry-After": str(retry_after)},
+    )
+
+
+twilio_verify = TwilioVerifyClient(
+    base_url=TWILIO_VERIFY_BASE_URL,
+    account_sid=TWILIO_ACCOUNT_SID,
+    auth_token=TWILIO_AUTH_TOKEN,
+    service_sid=VERIFY_SID,
+    deadline_seconds=TWILIO_DEADLINE_SECONDS,
+    breaker=CircuitBreaker(TWILIO_BREAKER_FAILURES, TWILIO_BREAKER_RESET_SECONDS),
+)
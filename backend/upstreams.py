@@ -0,0 +1,150 @@
+# upstreams.py - Long-lived, pooled HTTP clients for third-party APIs (Gemini, Hume, ElevenLabs)
+"""
+One httpx.AsyncClient per upstream, created on first use and closed from
+main.lifespan, so requests reuse keep-alive connections (HTTP/2 when the h2
+package is installed) instead of paying a TCP + TLS handshake each time.
+
+Per-upstream overrides: UPSTREAM_<NAME>_MAX_CONNECTIONS, _MAX_KEEPALIVE,
+_TIMEOUT, _CONNECT_TIMEOUT (e.g. UPSTREAM_GEMINI_TIMEOUT=20).
+"""
+import os
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+import httpx
+from dotenv import load_dotenv
+
+try:
+    import h2  # noqa: F401  (enables httpx HTTP/2)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+load_dotenv(override=True)
+
+# name -> defaults; timeouts are per request unless the call overrides them
+UPSTREAM_DEFAULTS = {
+    "gemini": {"max_connections": 20, "max_keepalive": 10, "timeout": 30.0, "connect_timeout": 5.0},
+    "hume": {"max_connections": 10, "max_keepalive": 5, "timeout": 10.0, "connect_timeout": 5.0},
+    "elevenlabs": {"max_connections": 10, "max_keepalive": 5, "timeout": 10.0, "connect_timeout": 5.0},
+}
+KEEPALIVE_EXPIRY_SECONDS = 60.0
+LATENCY_SAMPLES = 1000  # recent requests kept per upstream for percentiles
+
+
+def upstream_settings(name: str) -> dict:
+    """Settings for one upstream, with UPSTREAM_<NAME>_* environment overrides."""
+    defaults = UPSTREAM_DEFAULTS[name]
+    env = lambda key: os.getenv(f"UPSTREAM_{name.upper()}_{key.upper()}")  # noqa: E731
+    return {key: type(value)(env(key)) if env(key) else value for key, value in defaults.items()}
+
+
+def percentile(samples: list, fraction: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class UpstreamStats:
+    """Connection reuse, handshake time and latency (to response headers) for one upstream."""
+
+    def __init__(self):
+        self.requests = 0
+        self.responses = 0
+        self.new_connections = 0
+        self.handshake_total_ms = 0.0
+        self.handshake_max_ms = 0.0
+        self.http_versions = {}
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)  # (ms, reused connection?)
+        self._lock = threading.Lock()
+
+    async def on_request(self, request: httpx.Request):
+        state = {"started": time.perf_counter(), "new_connection": False, "handshake_ms": 0.0}
+
+        async def trace(event: str, info: dict):
+            # connect_tcp / start_tls only happen when no pooled connection was free
+            if event in ("connection.connect_tcp.started", "connection.start_tls.started"):
+                state["step_started"] = time.perf_counter()
+                state["new_connection"] = True
+            elif event in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+                state["handshake_ms"] += (time.perf_counter() - state.pop("step_started")) * 1000
+
+        request.extensions["trace"] = trace
+        request.extensions["upstream_state"] = state
+        with self._lock:
+            self.requests += 1
+
+    async def on_response(self, response: httpx.Response):
+        state = response.request.extensions.get("upstream_state")
+        if state is None:
+            return
+        elapsed_ms = (time.perf_counter() - state["started"]) * 1000
+        with self._lock:
+            self.responses += 1
+            self.http_versions[response.http_version] = self.http_versions.get(response.http_version, 0) + 1
+            if state["new_connection"]:
+                self.new_connections += 1
+                self.handshake_total_ms += state["handshake_ms"]
+                self.handshake_max_ms = max(self.handshake_max_ms, state["handshake_ms"])
+            self._latencies.append((elapsed_ms, not state["new_connection"]))
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            latencies = list(self._latencies)
+            reused = self.responses - self.new_connections
+            snapshot = {
+                "requests": self.requests,
+                "responses": self.responses,
+                "new_connections": self.new_connections,
+                "reused_connections": reused,
+                "reuse_rate": reused / self.responses if self.responses else 0.0,
+                "handshake_avg_ms": self.handshake_total_ms / self.new_connections if self.new_connections else 0.0,
+                "handshake_max_ms": self.handshake_max_ms,
+                "http_versions": dict(self.http_versions),
+            }
+        for label, samples in (
+            ("all", [ms for ms, _ in latencies]),
+            ("reused", [ms for ms, was_reused in latencies if was_reused]),
+            ("new", [ms for ms, was_reused in latencies if not was_reused]),
+        ):
+            snapshot[f"latency_{label}_p50_ms"] = percentile(samples, 0.50)
+            snapshot[f"latency_{label}_p99_ms"] = percentile(samples, 0.99)
+        return snapshot
+
+
+_clients = {}
+_stats = {name: UpstreamStats() for name in UPSTREAM_DEFAULTS}
+
+
+def client(name: str) -> httpx.AsyncClient:
+    """The shared client for this upstream. Do not close it (or use it in `async with`)."""
+    existing = _clients.get(name)
+    if existing is not None and not existing.is_closed:
+        return existing
+    settings = upstream_settings(name)
+    stats = _stats[name]
+    _clients[name] = httpx.AsyncClient(
+        http2=HTTP2_AVAILABLE,
+        timeout=httpx.Timeout(settings["timeout"], connect=settings["connect_timeout"]),
+        limits=httpx.Limits(
+            max_connections=settings["max_connections"],
+            max_keepalive_connections=settings["max_keepalive"],
+            keepalive_expiry=KEEPALIVE_EXPIRY_SECONDS,
+        ),
+        event_hooks={"request": [stats.on_request], "response": [stats.on_response]},
+    )
+    return _clients[name]
+
+
+async def aclose_all():
+    """Close every upstream client (called on shutdown)."""
+    for http_client in list(_clients.values()):
+        await http_client.aclose()
+    _clients.clear()
+
+
+def stats() -> dict:
+    return {"http2": HTTP2_AVAILABLE, **{name: s.snapshot() for name, s in _stats.items()}}
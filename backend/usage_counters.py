@@ -0,0 +1,275 @@
+# usage_counters.py - Per-user daily usage counters (Redis hot tier, Postgres of record)
+import asyncio
+import os
+import uuid
+from datetime import date, datetime, timedelta, timezone
+from typing import Optional
+
+from dotenv import load_dotenv
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import redis_pool
+from db import AsyncSessionLocal
+from models import User, CallUsage, ChatUsage, ManualUnblockUsage
+from otp import Owner
+
+load_dotenv(override=True)
+
+USAGE_FLUSH_SECONDS = float(os.getenv("USAGE_FLUSH_SECONDS", "5"))
+USAGE_KEY_TTL_SECONDS = 2 * 24 * 3600  # day buckets outlive their day, then expire
+
+# kind -> (model, counter column)
+COUNTERS = {
+    "call": (CallUsage, "seconds_used"),
+    "chat": (ChatUsage, "message_count"),
+    "manual_unblock": (ManualUnblockUsage, "unblock_count"),
+}
+
+_INSERTS = {"postgresql": pg_insert, "sqlite": sqlite_insert}
+
+
+async def increment_daily_counter(db: AsyncSession, model, column: str, owner: Owner,
+                                  usage_date: date, amount=1,
+                                  now: Optional[datetime] = None):
+    """
+    Add amount to model.column for (owner, usage_date) and return the new
+    total. One INSERT ... ON CONFLICT DO UPDATE ... RETURNING statement, so
+    concurrent increments never create duplicate day rows or lose updates.
+    Does not commit; the caller owns the transaction.
+    """
+    stmt = _upsert(db, model, column, [(owner.id, owner.identifier, usage_date, amount)], now)
+    return (await db.execute(stmt.returning(model.__table__.c[column]))).scalar_one()
+
+
+async def get_daily_counter(db: AsyncSession, model, column: str, owner_id: int, usage_date: date):
+    """Current value of model.column for (owner_id, usage_date), or None if no row yet."""
+    return (await db.execute(
+        select(model.__table__.c[column]).where(model.user_id == owner_id, model.usage_date == usage_date)
+    )).scalar()
+
+
+def _upsert(db: AsyncSession, model, column: str, rows: list, now: Optional[datetime] = None):
+    """Multi-row increment statement for [(user_id, phone label, usage_date, amount), ...]."""
+    table = model.__table__
+    now = now or datetime.now(timezone.utc)
+    insert = _INSERTS[db.get_bind().dialect.name]
+    stmt = insert(table).values([
+        {"user_id": user_id, "phone": phone, "usage_date": usage_date, "updated_at": now, column: amount}
+        for user_id, phone, usage_date, amount in rows
+    ])
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c.user_id, table.c.usage_date],
+        set_={column: table.c[column] + stmt.excluded[column], "updated_at": stmt.excluded.updated_at},
+    )
+
+
+# ------------------------------------------------------------------
+# Hot tier: today's totals live in Redis (usage:<kind>:<date>:<user_id>)
+# and increments not yet persisted accumulate in the usage_dirty:<kind>
+# hash (field "<date>:<user_id>:<phone label>"). flush_usage drains that
+# hash into the tables. A missing total (expired, or Redis lost its data) is reseeded
+# from the table plus any still-pending delta.
+# ------------------------------------------------------------------
+
+# KEYS: total, dirty hash. ARGV: field, amount, ttl, seed ('' = not loaded).
+# Returns the new total, or false when the key needs seeding first.
+_ADD_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    if ARGV[4] == '' then return false end
+    local pending = redis.call('HGET', KEYS[2], ARGV[1]) or '0'
+    redis.call('SET', KEYS[1], tostring(tonumber(ARGV[4]) + tonumber(pending)), 'EX', ARGV[3])
+end
+local total = redis.call('INCRBYFLOAT', KEYS[1], ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+if tonumber(ARGV[2]) ~= 0 then
+    redis.call('HINCRBYFLOAT', KEYS[2], ARGV[1], ARGV[2])
+end
+return total
+"""
+
+# Atomically take the dirty hash for flushing. KEYS: dirty, batch.
+_TAKE_BATCH_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return 0 end
+redis.call('RENAME', KEYS[1], KEYS[2])
+redis.call('EXPIRE', KEYS[2], 86400)
+return 1
+"""
+
+_add_script = redis_pool.redis.register_script(_ADD_LUA) if redis_pool.redis else None
+_take_batch_script = redis_pool.redis.register_script(_TAKE_BATCH_LUA) if redis_pool.redis else None
+
+# Totals this worker bumped in the database while Redis was down; dropped
+# from Redis on the next successful call so they reseed.
+_stale_keys = set()
+
+_stats = {"redis_ops": 0, "seeds": 0, "db_fallbacks": 0, "flushes": 0, "rows_flushed": 0, "flush_failures": 0,
+          "rows_dropped": 0}
+
+
+def _total_key(kind: str, owner_id: int, usage_date: date) -> str:
+    return f"usage:{kind}:{usage_date.isoformat()}:{owner_id}"
+
+
+def _cast(kind: str, value):
+    return float(value) if COUNTERS[kind][1] == "seconds_used" else int(float(value))
+
+
+async def _redis_add(kind: str, owner: Owner, usage_date: date, amount):
+    if _stale_keys:
+        stale = list(_stale_keys)
+        _stale_keys.clear()
+        await redis_pool.redis.delete(*stale)
+    keys = [_total_key(kind, owner.id, usage_date), f"usage_dirty:{kind}"]
+    field = f"{usage_date.isoformat()}:{owner.id}:{owner.identifier}"
+    _stats["redis_ops"] += 1
+    total = await _add_script(keys=keys, args=[field, amount, USAGE_KEY_TTL_SECONDS, ""])
+    if total is None:
+        model, column = COUNTERS[kind]
+        # Seed from the primary: the caller's session may be a lagging replica,
+        # and the seeded total is kept for the key's whole TTL
+        async with AsyncSessionLocal() as primary:
+            seed = await get_daily_counter(primary, model, column, owner.id, usage_date) or 0
+        _stats["seeds"] += 1
+        total = await _add_script(keys=keys, args=[field, amount, USAGE_KEY_TTL_SECONDS, seed])
+    return _cast(kind, total)
+
+
+async def add_usage(db: AsyncSession, kind: str, owner: Owner, usage_date: date, amount=1,
+                    now: Optional[datetime] = None):
+    """
+    Add amount to today's counter and return the new total. With Redis this
+    is one script call and the database is updated by the flusher; without
+    it the row is upserted in db (caller commits).
+    """
+    if _add_script is not None and redis_pool.available():
+        try:
+            return await _redis_add(kind, owner, usage_date, amount)
+        except Exception as e:
+            redis_pool.mark_error(f"usage counter add ({kind})", e)
+    model, column = COUNTERS[kind]
+    _stats["db_fallbacks"] += 1
+    _stale_keys.add(_total_key(kind, owner.id, usage_date))
+    return _cast(kind, await increment_daily_counter(db, model, column, owner, usage_date, amount, now=now))
+
+
+async def read_usage(db: AsyncSession, kind: str, owner: Owner, usage_date: date):
+    """Current counter value (0 if nothing recorded that day)."""
+    if _add_script is not None and redis_pool.available():
+        try:
+            return await _redis_add(kind, owner, usage_date, 0)
+        except Exception as e:
+            redis_pool.mark_error(f"usage counter read ({kind})", e)
+    model, column = COUNTERS[kind]
+    _stats["db_fallbacks"] += 1
+    return _cast(kind, await get_daily_counter(db, model, column, owner.id, usage_date) or 0)
+
+
+async def _write_rows(model, column: str, rows: list) -> int:
+    """
+    Upsert flushed rows, skipping users that no longer exist (deleted or
+    merged away after the increment was queued). Returns rows written.
+    """
+    for attempt in range(2):
+        async with AsyncSessionLocal() as db:
+            alive = set((await db.execute(
+                select(User.id).where(User.id.in_({user_id for user_id, _, _, _ in rows}))
+            )).scalars())
+            kept = [row for row in rows if row[0] in alive]
+            if len(kept) < len(rows):
+                _stats["rows_dropped"] += len(rows) - len(kept)
+                print(f"⚠️ Dropped {len(rows) - len(kept)} {model.__tablename__} increments for deleted users")
+            rows = kept
+            if not rows:
+                return 0
+            try:
+                await db.execute(_upsert(db, model, column, rows))
+                await db.commit()
+                return len(rows)
+            except IntegrityError:
+                # A user was deleted between the lookup and the upsert; look again
+                await db.rollback()
+                if attempt:
+                    raise
+    return 0
+
+
+async def flush_usage() -> int:
+    """Persist pending Redis increments to the usage tables. Returns rows written."""
+    if _take_batch_script is None or not redis_pool.available():
+        return 0
+    written = 0
+    for kind, (model, column) in COUNTERS.items():
+        batch_key = f"usage_flushing:{kind}:{uuid.uuid4().hex}"
+        try:
+            if not await _take_batch_script(keys=[f"usage_dirty:{kind}", batch_key]):
+                continue
+            pending = await redis_pool.redis.hgetall(batch_key)
+        except Exception as e:
+            redis_pool.mark_error(f"usage flush ({kind})", e)
+            return written
+
+        rows = []
+        for field, amount in pending.items():
+            day, owner_id, phone = field.split(":", 2)
+            if float(amount):
+                rows.append((int(owner_id), phone, date.fromisoformat(day), _cast(kind, amount)))
+        try:
+            if rows:
+                written += await _write_rows(model, column, rows)
+            await redis_pool.redis.delete(batch_key)
+        except IntegrityError as e:
+            # Retrying cannot fix a constraint violation; drop the batch rather than block the kind
+            _stats["flush_failures"] += 1
+            _stats["rows_dropped"] += len(rows)
+            print(f"❌ Usage flush dropped {len(rows)} {kind} rows: {str(e)}")
+            try:
+                await redis_pool.redis.delete(batch_key)
+            except Exception as e2:
+                redis_pool.mark_error(f"usage flush cleanup ({kind})", e2)
+        except Exception as e:
+            # Transient (connection, timeout): hand the deltas back so the next flush retries them
+            _stats["flush_failures"] += 1
+            print(f"❌ Usage flush failed for {kind} ({len(rows)} rows): {str(e)}")
+            try:
+                async with redis_pool.redis.pipeline(transaction=True) as pipe:
+                    for field, amount in pending.items():
+                        pipe.hincrbyfloat(f"usage_dirty:{kind}", field, amount)
+                    pipe.delete(batch_key)
+                    await pipe.execute()
+            except Exception as e2:
+                redis_pool.mark_error(f"usage flush requeue ({kind})", e2)
+    _stats["flushes"] += 1
+    _stats["rows_flushed"] += written
+    return written
+
+
+async def forget_usage(*owner_ids: int):
+    """Drop cached totals for these users (after their rows were moved or deleted)."""
+    if _add_script is None or not owner_ids or not redis_pool.available():
+        return
+    # Only "today" is ever read; UTC +/- 1 day covers today in every timezone
+    today = datetime.now(timezone.utc).date()
+    days = [today + timedelta(days=offset) for offset in (-1, 0, 1)]
+    keys = [_total_key(kind, owner_id, day) for owner_id in owner_ids for kind in COUNTERS for day in days]
+    try:
+        await redis_pool.redis.delete(*keys)
+    except Exception as e:
+        redis_pool.mark_error("usage counter invalidation", e)
+
+
+async def flush_forever():
+    """Background write-behind loop started from main.lifespan."""
+    while True:
+        await asyncio.sleep(USAGE_FLUSH_SECONDS)
+        try:
+            await flush_usage()
+        except Exception as e:
+            print(f"❌ Usage flusher error: {str(e)}")
+
+
+def stats() -> dict:
+    return {"backend": "redis" if redis_pool.available() else "database", **_stats}
@@ -1,11 +1,15 @@
 import os
-import httpx
 from datetime import datetime, timezone
-from fastapi import APIRouter, Depends, UploadFile, File, Form, HTTPException
-from sqlalchemy.orm import Session
-from db import get_db
+from fastapi import APIRouter, Depends, UploadFile, File, Form, HTTPException, Request, Response
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from db import get_async_db
+from read_routing import get_read_db
 from models import Profile, CallSession
-from otp import verify_token, get_user_identifier
+from otp import verify_token, get_owner
+from rate_limit import create_session_limiter
+import state_version
+import upstreams
 
 router = APIRouter(tags=["voice"])
 
@@ -18,7 +22,7 @@ async def clone_voice(
     audio: UploadFile = File(...),
     name: str = Form(default="My Voice"),
     user_id: str = Depends(verify_token),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
     if not ELEVENLABS_API_KEY:
         raise HTTPException(status_code=500, detail="ElevenLabs API key not configured")
@@ -26,78 +30,84 @@ async def clone_voice(
     if audio.size and audio.size > 50 * 1024 * 1024:
         raise HTTPException(status_code=413, detail="File too large (max 50MB)")
 
-    phone = get_user_identifier(user_id, db)
-    profile = db.query(Profile).filter(Profile.phone == phone).first()
+    owner = await get_owner(user_id, db)
+    profile = (await db.execute(select(Profile).where(Profile.user_id == owner.id))).scalars().first()
 
     audio_data = await audio.read()
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            "https://api.elevenlabs.io/v1/voices/add",
-            headers={"xi-api-key": ELEVENLABS_API_KEY},
-            files={"files": (audio.filename or "voice_sample.m4a", audio_data, audio.content_type or "audio/m4a")},
-            data={"name": name},
-            timeout=60.0,
-        )
-        if response.status_code != 200:
-            raise HTTPException(status_code=response.status_code, detail=f"ElevenLabs error: {response.text}")
-
-        eleven_voice_id = response.json().get("voice_id")
-        if not eleven_voice_id:
-            raise HTTPException(status_code=500, detail="No voice_id returned from ElevenLabs")
+    client = upstreams.client("elevenlabs")
+    response = await client.post(
+        "https://api.elevenlabs.io/v1/voices/add",
+        headers={"xi-api-key": ELEVENLABS_API_KEY},
+        files={"files": (audio.filename or "voice_sample.m4a", audio_data, audio.content_type or "audio/m4a")},
+        data={"name": name},
+        timeout=60.0,
+    )
+    if response.status_code != 200:
+        raise HTTPException(status_code=response.status_code, detail=f"ElevenLabs error: {response.text}")
+
+    eleven_voice_id = response.json().get("voice_id")
+    if not eleven_voice_id:
+        raise HTTPException(status_code=500, detail="No voice_id returned from ElevenLabs")
 
     # Delete previous clone from ElevenLabs if one exists
     if profile and profile.eleven_voice_id:
         await _delete_elevenlabs_voice(profile.eleven_voice_id)
 
     if not profile:
-        profile = Profile(phone=phone, eleven_voice_id=eleven_voice_id)
+        profile = Profile(user_id=owner.id, phone=owner.identifier, eleven_voice_id=eleven_voice_id)
         db.add(profile)
     else:
         profile.eleven_voice_id = eleven_voice_id
 
-    db.commit()
+    await db.commit()
+    await state_version.bump(owner.id)
     return {"voice_id": eleven_voice_id, "message": "Voice cloned successfully"}
 
 
 @router.get("/voice/status")
-def get_voice_status(user_id: str = Depends(verify_token), db: Session = Depends(get_db)):
-    phone = get_user_identifier(user_id, db)
-    profile = db.query(Profile).filter(Profile.phone == phone).first()
+async def get_voice_status(request: Request, response: Response,
+                           user_id: str = Depends(verify_token), db: AsyncSession = Depends(get_read_db)):
+    owner = await get_owner(user_id, db)
+    cached = await state_version.not_modified(request, response, owner.id)
+    if cached:
+        return cached
+    profile = (await db.execute(select(Profile).where(Profile.user_id == owner.id))).scalars().first()
     if profile and profile.eleven_voice_id:
         return {"has_cloned_voice": True, "voice_id": profile.eleven_voice_id}
     return {"has_cloned_voice": False, "voice_id": None}
 
 
 @router.delete("/voice/clone")
-async def delete_cloned_voice(user_id: str = Depends(verify_token), db: Session = Depends(get_db)):
-    phone = get_user_identifier(user_id, db)
-    profile = db.query(Profile).filter(Profile.phone == phone).first()
+async def delete_cloned_voice(user_id: str = Depends(verify_token), db: AsyncSession = Depends(get_async_db)):
+    owner = await get_owner(user_id, db)
+    profile = (await db.execute(select(Profile).where(Profile.user_id == owner.id))).scalars().first()
 
     if not profile or not profile.eleven_voice_id:
         raise HTTPException(status_code=404, detail="No cloned voice found")
 
     await _delete_elevenlabs_voice(profile.eleven_voice_id)
     profile.eleven_voice_id = None
-    db.commit()
+    await db.commit()
+    await state_version.bump(owner.id)
     return {"message": "Voice deleted successfully"}
 
 
 @router.post("/elevenlabs/create-session")
 async def create_elevenlabs_session(
     payload: dict,
-    user_id: str = Depends(verify_token),
-    db: Session = Depends(get_db),
+    user_id: str = Depends(create_session_limiter.dependency(verify_token)),
+    db: AsyncSession = Depends(get_async_db),
 ):
     if not ELEVENLABS_API_KEY or not ELEVENLABS_AGENT_ID:
         raise HTTPException(status_code=500, detail="ElevenLabs not configured")
 
-    from call_usage import _check_limit_by_phone
+    from call_usage import _check_limit_for_owner
     from main import _close_open_session
 
     now = datetime.now(timezone.utc)
-    phone = get_user_identifier(user_id, db)
-    profile = db.query(Profile).filter(Profile.phone == phone).first()
+    owner = await get_owner(user_id, db)
+    profile = (await db.execute(select(Profile).where(Profile.user_id == owner.id))).scalars().first()
 
     if not profile or not profile.is_premium:
         raise HTTPException(status_code=403, detail="Premium subscription required to use AI calls.")
@@ -105,29 +115,28 @@ async def create_elevenlabs_session(
     if not profile.eleven_voice_id:
         raise HTTPException(status_code=404, detail="No cloned voice found")
 
-    _close_open_session(db, phone, now)
+    await _close_open_session(db, owner, now)
 
-    limit_info = _check_limit_by_phone(db, phone)
+    limit_info = await _check_limit_for_owner(db, owner)
     if not limit_info.can_call:
         raise HTTPException(
             status_code=429,
             detail=f"Daily call limit reached. You've used {limit_info.used_seconds:.1f}s of {limit_info.limit_seconds:.0f}s today."
         )
 
-    session_row = CallSession(phone=phone, started_at=now)
+    session_row = CallSession(user_id=owner.id, phone=owner.identifier, started_at=now)
     db.add(session_row)
-    db.commit()
-
-    async with httpx.AsyncClient() as client:
-        response = await client.get(
-            "https://api.elevenlabs.io/v1/convai/conversation/get-signed-url",
-            headers={"xi-api-key": ELEVENLABS_API_KEY},
-            params={"agent_id": ELEVENLABS_AGENT_ID},
-            timeout=10.0,
-        )
-        if response.status_code != 200:
-            raise HTTPException(status_code=response.status_code, detail=f"ElevenLabs error: {response.text}")
-        signed_url = response.json().get("signed_url")
+    await db.commit()
+
+    client = upstreams.client("elevenlabs")
+    response = await client.get(
+        "https://api.elevenlabs.io/v1/convai/conversation/get-signed-url",
+        headers={"xi-api-key": ELEVENLABS_API_KEY},
+        params={"agent_id": ELEVENLABS_AGENT_ID},
+    )
+    if response.status_code != 200:
+        raise HTTPException(status_code=response.status_code, detail=f"ElevenLabs error: {response.text}")
+    signed_url = response.json().get("signed_url")
 
     todos = payload.get("todos", [])
     minutes = payload.get("minutes", 15)
@@ -148,11 +157,10 @@ async def _delete_elevenlabs_voice(voice_id: str):
     if not ELEVENLABS_API_KEY:
         return
     try:
-        async with httpx.AsyncClient() as client:
-            await client.delete(
-                f"https://api.elevenlabs.io/v1/voices/{voice_id}",
-                headers={"xi-api-key": ELEVENLABS_API_KEY},
-                timeout=10.0,
-            )
+        client = upstreams.client("elevenlabs")
+        await client.delete(
+            f"https://api.elevenlabs.io/v1/voices/{voice_id}",
+            headers={"xi-api-key": ELEVENLABS_API_KEY},
+        )
     except Exception as e:
         print(f"⚠️ Failed to delete ElevenLabs voice {voice_id}: {e}")